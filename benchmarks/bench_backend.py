@@ -0,0 +1,47 @@
+'''
+Throughput of derive_many() against the offline MockBackend.
+
+    python benchmarks/bench_backend.py [--equations 200] [--latency 0.05]
+
+Every request sleeps for --latency seconds, so the equations per second
+reported for each concurrency level show how well requests overlap. The
+result cache is bypassed.
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from derive_eq.functions.backends import MockBackend, derive_many
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark derive_many() on the mock backend")
+    parser.add_argument("--equations", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Requests per second limit, none by default")
+    parser.add_argument("--fail-every", type=int, default=0,
+                        help="Make every n-th request fail to exercise retries")
+    args = parser.parse_args()
+
+    equations = [f"x_{{{i}}} = {i} y" for i in range(args.equations)]
+    for concurrency in args.concurrency:
+        backend = MockBackend(latency=args.latency, fail_every=args.fail_every)
+        start = time.perf_counter()
+        results = asyncio.run(derive_many(equations, backend=backend, concurrency=concurrency,
+                                          requests_per_second=args.rate, backoff=0.01,
+                                          use_cache=False))
+        elapsed = time.perf_counter() - start
+        failed = sum(result is None for result in results)
+        print(f"concurrency {concurrency:>4}: {len(equations) / elapsed:8.1f} eq/s "
+              f"({elapsed:.2f}s, {backend.calls} requests, {failed} failed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+'''
+How many derivations equation fingerprints save.
+
+    python benchmarks/bench_dedup.py [--papers 200] [--equations 40] [--reuse 0.5]
+
+Generates papers whose equations are drawn from a shared pool, the way
+well-known equations recur across papers. Each use of a pooled equation is
+typeset differently: spacing, \\left and \\right, \\, and \\!, alignment
+marks and line breaks, \\frac12 against \\frac{1}{2}, \\le against \\leq,
+trailing punctuation, labels and macros the paper defines. The equations
+are parsed, fingerprinted with the paper's macros expanded and compared
+with the pool they came from. Reports:
+
+- the dedup ratio, the share of derivation requests left out because an
+  equation with the same fingerprint was derived already, next to what
+  comparing the raw text would save;
+- recall, the share of the repeated equations that were collapsed;
+- false merges, fingerprints shared by different equations of the pool
+  or by one of the DISTINCT pairs, which fail the run with exit status 1;
+- the canonicalization throughput.
+
+Real sources in benchmarks/corpus/ (see bench_extract.py) are reported as
+well, with their dedup ratio only, as nothing is known of their equations.
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from bench_extract import PREAMBLE, real_corpus
+from derive_eq.functions.canonical import document_macros, fingerprint
+from derive_eq.functions.get_tex_eq_better import format_equation, parse_equations
+
+# Ways of writing each term and operator of a pooled equation. \pmu and
+# \half are defined by every generated paper.
+TERMS = (
+    ('\\alpha',), ('\\beta',), ('\\hbar',),
+    ('\\partial_\\mu', '\\partial_{\\mu}', '\\pmu'),
+    ('\\frac{1}{2}', '\\frac12', '\\tfrac{1}{2}', '\\half'),
+    ('\\int d^4x', '\\int d^{4}x', '\\int\\! d^4 x'),
+    ('(x + y)', '\\left( x+y \\right)', '\\bigl(x + y\\bigr)'),
+    ('g_{\\mu\\nu}', 'g_{\\mu \\nu}'),
+    ('e^{i k x}', 'e^{ikx}', 'e^{i\\,k\\,x}'),
+    ('\\phi^2', '\\phi^{2}'),
+    ('x_i', 'x_{i}'),
+)
+OPERATORS = (('+',), ('-',), ('=', '&=', '& ='), ('\\leq', '\\le'), ('\\cdot',))
+
+# Equations that differ only in their row and column separators, which must
+# not share a fingerprint
+DISTINCT = (
+    ('\\begin{pmatrix} a \\\\ b \\end{pmatrix}', '\\begin{pmatrix} a & b \\end{pmatrix}'),
+    ('\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}',
+     '\\begin{pmatrix} a & b & c & d \\end{pmatrix}'),
+    ('\\begin{bmatrix} a & b \\\\ c & d \\end{bmatrix}',
+     '\\begin{bmatrix} a \\\\ b \\\\ c \\\\ d \\end{bmatrix}'),
+    ('f(x) = \\begin{cases} 1 & x > 0 \\\\ 0 \\end{cases}',
+     'f(x) = \\begin{cases} 1 & x > 0 & 0 \\end{cases}'),
+    ('\\left( \\begin{array}{cc} a & b \\\\ c & d \\end{array} \\right)',
+     '\\left( \\begin{array}{cc} a & b & c \\\\ d \\end{array} \\right)'),
+    ('\\begin{aligned} x &= 1 \\\\ y &= 2 \\end{aligned}',
+     '\\begin{aligned} x &= 1 y &= 2 \\end{aligned}'),
+)
+
+DEFINITIONS = '\\newcommand{\\pmu}{\\partial_\\mu}\n\\def\\half{\\frac{1}{2}}\n'
+
+
+def pooled_equation(rng):
+    '''An equation of the pool, as (term, operator) indices, the last without an operator.'''
+    terms = rng.randint(3, 7)
+    return tuple((rng.randrange(len(TERMS)), rng.randrange(len(OPERATORS)) if i else None)
+                 for i in reversed(range(terms)))
+
+
+def typeset(rng, equation, number):
+    '''One way of writing a pooled equation.'''
+    parts = []
+    split = False
+    for i, (term, operator) in enumerate(equation):
+        parts.append(rng.choice(TERMS[term]))
+        if i < len(equation) - 1:
+            parts.append(rng.choice(OPERATORS[operator]))
+            if rng.random() < 0.1:
+                parts.append('\\\\\n')
+                split = True
+    spacing = rng.choice((' ', '', '\n  '))
+    text = spacing.join(parts) if spacing else ' '.join(parts).replace(' + ', '+')
+    if split:
+        text = f'\\begin{{split}}\n{text}\n\\end{{split}}'
+    text += rng.choice(('', '', ',', '.', ' \\, .'))
+    if rng.random() < 0.5:
+        text += f' \\label{{eq:{number}}}'
+    return f'\\begin{{equation}}\n{text}\n\\end{{equation}}\n'
+
+
+def build_papers(papers, equations, reuse, seed):
+    '''Generate the papers, returning [(source, [pooled equation of each number])].'''
+    rng = random.Random(seed)
+    pool = []
+    known = set()
+    generated = []
+    for _ in range(papers):
+        parts = [PREAMBLE, DEFINITIONS, '\\begin{document}\n']
+        drawn = []
+        for number in range(equations):
+            if pool and rng.random() < reuse:
+                equation = rng.choice(pool)
+            else:
+                equation = pooled_equation(rng)
+                if equation not in known:
+                    known.add(equation)
+                    pool.append(equation)
+            drawn.append(equation)
+            parts.append('Some text before the equation.\n' + typeset(rng, equation, number))
+        parts.append('\\end{document}\n')
+        generated.append((''.join(parts), drawn))
+    return generated
+
+
+def fingerprints(source):
+    '''(raw LaTeX, fingerprint) of every equation of a paper, and the time taken.'''
+    entries = [format_equation(equation.body()) for equation in parse_equations(source)]
+    start = time.perf_counter()
+    macros = document_macros(source)
+    prints = [fingerprint(latex, macros) for latex in entries]
+    return list(zip(entries, prints)), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark equation deduplication")
+    parser.add_argument("--papers", type=int, default=200)
+    parser.add_argument("--equations", type=int, default=40, help="equations per paper")
+    parser.add_argument("--reuse", type=float, default=0.5,
+                        help="share of equations drawn again from the pool")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    raw = set()
+    prints = {}
+    pooled = set()
+    total = 0
+    elapsed = 0.0
+    for source, drawn in build_papers(args.papers, args.equations, args.reuse, args.seed):
+        entries, seconds = fingerprints(source)
+        elapsed += seconds
+        if len(entries) != len(drawn):
+            print(f"parsed {len(entries)} equations where {len(drawn)} were written")
+            return 1
+        for (latex, key), equation in zip(entries, drawn):
+            raw.add(latex)
+            prints.setdefault(key, set()).add(equation)
+            pooled.add(equation)
+        total += len(entries)
+
+    merged = sum(1 for equations in prints.values() if len(equations) > 1)
+    for first, second in DISTINCT:
+        if fingerprint(first) == fingerprint(second):
+            print(f"same fingerprint for {first} and {second}")
+            merged += 1
+    repeated = len(raw) - len(pooled)
+    recall = (len(raw) - len(prints)) / repeated if repeated else 1.0
+    print(f"{total} equations, {len(pooled)} distinct, {len(raw)} distinct as written, "
+          f"{len(prints)} fingerprints")
+    print(f"dedup ratio      {1 - len(prints) / total:6.1%}  "
+          f"(raw text {1 - len(raw) / total:.1%}, best possible {1 - len(pooled) / total:.1%})")
+    print(f"recall           {recall:6.1%}")
+    print(f"false merges     {merged:6d}")
+    print(f"canonicalization {total / elapsed:8.0f} equations/s")
+
+    for name, path in real_corpus():
+        with open(path, 'rb') as file:
+            entries, seconds = fingerprints(file.read())
+        if entries:
+            unique = len({key for latex, key in entries})
+            print(f"{name}: {len(entries)} equations, dedup ratio {1 - unique / len(entries):.1%}")
+
+    return 1 if merged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
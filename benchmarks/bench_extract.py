@@ -0,0 +1,276 @@
+'''
+Benchmarks for the LaTeX extraction hot path.
+
+    python benchmarks/bench_extract.py [--quick] [--save-baseline] [--tolerance 0.25]
+
+Runs extract_equations_from_tex() and get_tex_eq() over a corpus and
+reports throughput in MB/s, equations per second and peak traced memory
+for each document. The corpus is made of:
+
+- synthetic papers generated with a fixed seed, from 16 KB to 32 MB;
+- a paper defining hundreds of environment macros with \\def and
+  \\newcommand and using them throughout;
+- a paper made almost entirely of subequations blocks;
+- any real sources placed in benchmarks/corpus/, either as single .tex
+  files or as one directory per paper (its main file is detected as for a
+  downloaded e-print).
+
+The results are compared with benchmarks/baseline.json. The run fails
+with exit status 1 if the throughput of a document drops by more than
+--tolerance, or if its peak memory grows by more than that. Timings depend
+on the machine, so record a baseline with --save-baseline on the machine
+the comparison runs on.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from derive_eq.functions.get_tex_eq_better import extract_equations_from_tex, get_tex_eq
+from derive_eq.functions.tex_project import find_main_file
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, 'baseline.json')
+CORPUS_DIR = os.path.join(HERE, 'corpus')
+
+KB = 1024
+MB = 1024 ** 2
+SIZES = [16 * KB, 256 * KB, 4 * MB, 32 * MB]
+QUICK_SIZES = SIZES[:3]
+
+PREAMBLE = '\\documentclass{article}\n\\usepackage{amsmath}\n'
+
+WORDS = ('the', 'field', 'energy', 'we', 'obtain', 'where', 'is', 'given', 'by', 'and',
+         'using', 'integral', 'follows', 'from', 'which', 'limit', 'of', 'a', 'small')
+
+SYMBOLS = ('\\alpha', '\\beta', '\\partial_\\mu', '\\phi', 'x', 'y', '\\frac{1}{2}',
+           '\\int d^4x', '\\sum_{n=0}^{\\infty}', 'g_{\\mu\\nu}', 'e^{i k x}', '\\hbar')
+
+
+def _formula(rng, terms=6):
+    return ' '.join(rng.choice(SYMBOLS) + rng.choice((' +', ' -', '', ' =')) for _ in range(terms))
+
+
+def _paragraph(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(20, 60))]
+    words.insert(rng.randint(0, len(words)), f'${_formula(rng, 2)}$')
+    text = ' '.join(words) + '.\n'
+    if rng.random() < 0.2:
+        text += f'% {rng.choice(WORDS)} {rng.choice(WORDS)}\n'
+    return text + '\n'
+
+
+def _equation(rng, number):
+    kind = rng.random()
+    if kind < 0.4:
+        return (f'\\begin{{equation}}\n{_formula(rng)} \\label{{eq:{number}}}\n'
+                '\\end{equation}\n')
+    if kind < 0.7:
+        rows = [f'{_formula(rng, 2)} &= {_formula(rng, 4)}' for _ in range(rng.randint(2, 4))]
+        rows[0] += ' \\nonumber'
+        return '\\begin{align}\n' + ' \\\\\n'.join(rows) + '\n\\end{align}\n'
+    if kind < 0.85:
+        return (f'\\begin{{equation}}\n\\begin{{split}}\n{_formula(rng, 3)} &= {_formula(rng)} '
+                f'\\\\\n&= {_formula(rng, 3)}\n\\end{{split}}\n\\end{{equation}}\n')
+    return f'\\begin{{equation*}}\n{_formula(rng)}\n\\end{{equation*}}\n'
+
+
+def synthetic_document(size, seed=0):
+    '''A paper of about size bytes mixing prose, comments and equation environments.'''
+    rng = random.Random(seed)
+    parts = [PREAMBLE, '\\begin{document}\n']
+    length = 0
+    number = 0
+    while length < size:
+        part = _paragraph(rng) if rng.random() < 0.6 else _equation(rng, number)
+        number += 1
+        parts.append(part)
+        length += len(part)
+    parts.append('\\end{document}\n')
+    return ''.join(parts)
+
+
+def macro_document(size, macros=400, seed=1):
+    '''A paper using hundreds of \\def and \\newcommand shortcuts for its environments.'''
+    rng = random.Random(seed)
+    names = []
+    definitions = [PREAMBLE]
+    for i in range(macros):
+        name = 'm' + ''.join(chr(97 + (i // 26 ** k) % 26) for k in range(3))
+        env = rng.choice(('equation', 'align'))
+        if i % 2:
+            definitions.append(f'\\def\\b{name}{{\\begin{{{env}}}}}\n\\def\\e{name}{{\\end{{{env}}}}}\n')
+        else:
+            definitions.append(f'\\newcommand{{\\b{name}}}{{\\begin{{{env}}}}}\n'
+                               f'\\newcommand{{\\e{name}}}{{\\end{{{env}}}}}\n')
+        names.append(name)
+    parts = definitions + ['\\begin{document}\n']
+    length = sum(map(len, parts))
+    while length < size:
+        name = rng.choice(names)
+        part = _paragraph(rng) + f'\\b{name}\n{_formula(rng)}\n\\e{name}\n'
+        parts.append(part)
+        length += len(part)
+    parts.append('\\end{document}\n')
+    return ''.join(parts)
+
+
+def subequation_document(size, seed=2):
+    '''A paper made of subequations blocks, each numbering several align rows.'''
+    rng = random.Random(seed)
+    parts = [PREAMBLE, '\\begin{document}\n']
+    length = 0
+    while length < size:
+        rows = [f'{_formula(rng, 2)} &= {_formula(rng, 3)}' for _ in range(rng.randint(2, 6))]
+        part = ('\\begin{subequations}\n\\begin{align}\n' + ' \\\\\n'.join(rows)
+                + '\n\\end{align}\n\\end{subequations}\n' + _paragraph(rng))
+        parts.append(part)
+        length += len(part)
+    parts.append('\\end{document}\n')
+    return ''.join(parts)
+
+
+def _size_name(size):
+    return f'{size // MB}MB' if size >= MB else f'{size // KB}KB'
+
+
+def build_corpus(work_dir, sizes):
+    '''Write the synthetic documents to work_dir and return [(name, path)].'''
+    documents = [(f'synthetic-{_size_name(size)}', synthetic_document(size)) for size in sizes]
+    documents.append(('macros-1MB', macro_document(MB)))
+    documents.append(('subequations-1MB', subequation_document(MB)))
+
+    corpus = []
+    for name, text in documents:
+        path = os.path.join(work_dir, name + '.tex')
+        with open(path, 'w', encoding='utf8') as file:
+            file.write(text)
+        corpus.append((name, path))
+    return corpus + real_corpus()
+
+
+def real_corpus():
+    '''Papers in benchmarks/corpus/, as (name, path to the main tex file).'''
+    if not os.path.isdir(CORPUS_DIR):
+        return []
+    corpus = []
+    for entry in sorted(os.listdir(CORPUS_DIR)):
+        path = os.path.join(CORPUS_DIR, entry)
+        if os.path.isfile(path) and entry.endswith('.tex'):
+            corpus.append(('corpus-' + entry[:-4], path))
+        elif os.path.isdir(path):
+            members = {}
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    if file.endswith('.tex'):
+                        full = os.path.join(root, file)
+                        with open(full, 'rb') as f:
+                            members[os.path.relpath(full, path).replace(os.sep, '/')] = f.read()
+            main = find_main_file(members)
+            if main is not None:
+                corpus.append(('corpus-' + entry, os.path.join(path, *main.split('/'))))
+    return corpus
+
+
+def measure(path, repeat):
+    '''Time and trace extraction of one document, returning its metrics.'''
+    size = os.path.getsize(path)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        equations = extract_equations_from_tex(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    extract_equations_from_tex(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # get_tex_eq() stops at the equation asked for, the last one is its worst case
+    numbers = [equation.number for equation in equations if equation.number is not None]
+    lookup = None
+    if numbers:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            get_tex_eq(path, numbers[-1])
+        lookup = time.perf_counter() - start
+
+    return {
+        'bytes': size,
+        'equations': len(equations),
+        'seconds': round(best, 6),
+        'mb_per_s': round(size / MB / best, 3),
+        'eq_per_s': round(len(equations) / best, 1),
+        'peak_mb': round(peak / MB, 3),
+        'lookup_last_s': None if lookup is None else round(lookup, 6),
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''Return a list of regressions of results against baseline.'''
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('mb_per_s', 'eq_per_s'):
+            if base[key] and result[key] < base[key] * (1 - tolerance):
+                failures.append(f"{name}: {key} {result[key]} is below the baseline {base[key]}")
+        if base['peak_mb'] and result['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            failures.append(f"{name}: peak_mb {result['peak_mb']} is above the baseline "
+                            f"{base['peak_mb']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LaTeX equation extraction")
+    parser.add_argument("--quick", action="store_true",
+                        help="Leave out the largest synthetic document")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per document, the fastest one counts")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative regression against the baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store these results as the new baseline")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, path in build_corpus(work_dir, QUICK_SIZES if args.quick else SIZES):
+            result = measure(path, args.repeat)
+            results[name] = result
+            print(f"{name:<22} {result['bytes'] / MB:8.2f} MB {result['equations']:>8} eqs "
+                  f"{result['mb_per_s']:8.2f} MB/s {result['eq_per_s']:>10} eq/s "
+                  f"peak {result['peak_mb']:8.2f} MB", flush=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with, run with --save-baseline first")
+        return
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    failures = compare(results, baseline, args.tolerance)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
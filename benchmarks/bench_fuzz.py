@@ -0,0 +1,226 @@
+'''
+Adversarial inputs for the equation parser.
+
+    python benchmarks/bench_fuzz.py [--quick] [--size-kb 64] [--mutations 100]
+
+Generates sources made to defeat the parser's scans: environments,
+labels, macro bodies and arguments left unclosed, definitions, macro
+arguments and superscripts nested thousands deep, macros that double
+each other and thousands of distinct commands, along with random
+mutations of synthetic papers (see bench_extract.py) cut short and with
+braces, environment boundaries and definitions inserted or deleted at
+random. Each goes through all that indexing a paper does:
+parse_equations(), the text of every equation, document_macros() and
+fingerprint().
+
+Every pathological input is timed at --size-kb and at four times that,
+and the run fails with exit status 1 if:
+
+- its time grows faster than linearly, more than 4 * --slack times from
+  the small size to the large one (a quadratic scan grows 16 times);
+- it takes more than --max-slowdown times as long per byte as a synthetic
+  paper, for the pathological inputs and the mutations alike;
+- it raises an exception;
+- a ParseBudget of BUDGET_SECONDS does not stop parsing one of the
+  pathological inputs, made 16 times larger, within twice that time
+  plus BUDGET_SLACK.
+'''
+import argparse
+import os
+import random
+import sys
+import time
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from bench_extract import KB, PREAMBLE, synthetic_document
+from derive_eq.functions.canonical import document_macros, fingerprint
+from derive_eq.functions.get_tex_eq_better import ParseBudget, format_equation, parse_equations
+
+# Time limit of the ParseBudget each pathological input is parsed with, and
+# the overrun allowed beyond twice that for the clock to be looked at
+BUDGET_SECONDS = 0.05
+BUDGET_SLACK = 0.02
+
+
+def _repeat(unit, size):
+    return unit * max(1, size // len(unit))
+
+
+def _letters(i):
+    # Control words take letters only, so numbers are spelt with them
+    return ''.join(chr(97 + (i // 26 ** k) % 26) for k in range(4))
+
+
+def _doubling_macros(size):
+    # Each macro uses the one before twice, so the last expands to 2**n tokens
+    names = ['m' + _letters(i) for i in range(max(2, size // 24))]
+    parts = [f'\\def\\{names[0]}{{\\\\}}']
+    parts += [f'\\def\\{name}{{\\{previous}\\{previous}}}'
+              for previous, name in zip(names, names[1:])]
+    return ''.join(parts) + f'\\begin{{align}}\\{names[-1]}\\end{{align}}'
+
+
+def _distinct_definitions(size):
+    # Every command has a name of its own, so the macro table grows with the
+    # source, and each is used once in an equation after its definition
+    parts = []
+    for i in range(max(1, size // 60)):
+        name = _letters(i)
+        parts.append(f'\\def\\n{name}{{\\\\}}'
+                     f'\\begin{{align}} a & b \\n{name} c \\end{{align}}\n')
+    return ''.join(parts)
+
+
+def _nested(opening, inner, closing, size, before='', after=''):
+    depth = max(1, (size - len(before) - len(after)) // (len(opening) + len(closing)))
+    return before + opening * depth + inner + closing * depth + after
+
+
+# Inputs of about size characters built to make a scan run again and again
+PATHOLOGICAL = {
+    'unclosed-begin': lambda size: _repeat('\\begin{equation} a + b ', size),
+    'unclosed-begin-name': lambda size: _repeat('\\begin{abc ', size),
+    'unclosed-label': lambda size: ('\\begin{equation}' + _repeat('\\label{x ', size)
+                                    + '\\end{equation}'),
+    'unclosed-label-line': lambda size: _repeat('\\label{a', size),
+    'unclosed-def': lambda size: _repeat('\\def\\a{', size),
+    'unclosed-newcommand': lambda size: _repeat('\\newcommand{\\a}[1]{', size),
+    'unclosed-newenvironment': lambda size: _repeat('\\newenvironment{abc', size),
+    'unclosed-argument': lambda size: '\\newcommand\\m[1]{#1}' + _repeat('\\m{', size),
+    'unclosed-fraction': lambda size: ('\\begin{equation}' + _repeat('\\frac{', size)
+                                       + '\\end{equation}'),
+    'nested-definitions': lambda size: _nested('\\def\\a{', '\\\\', '}', size),
+    'nested-arguments': lambda size: _nested('\\m{', 'x', '}', size,
+                                             '\\newcommand\\m[1]{#1}\\begin{equation}',
+                                             '\\end{equation}'),
+    'nested-superscripts': lambda size: _nested('x^{', 'y', '}', size, '\\begin{equation}',
+                                                '\\end{equation}'),
+    'repeated-arguments': lambda size: _nested('\\r{', 'x', '}', size,
+                                               '\\newcommand\\r[1]{#1#1#1#1#1#1#1#1}'
+                                               '\\begin{equation}', '\\end{equation}'),
+    'doubling-macros': _doubling_macros,
+    'distinct-definitions': _distinct_definitions,
+    'long-row': lambda size: '\\begin{align}' + _repeat('a & b ', size) + '\\end{align}',
+    'line-breaks': lambda size: '\\begin{align}' + _repeat('a \\\\ ', size) + '\\end{align}',
+    'many-equations': lambda size: _repeat('\\begin{equation} a \\\\ b & c \\end{equation}\n',
+                                           size),
+}
+
+# Pieces the mutations insert
+FRAGMENTS = (
+    '{', '}', '\\begin{equation}', '\\end{equation}', '\\begin{align}', '\\end{align}',
+    '\\begin{', '\\end{', '\\\\', '&', '\\label{', '\\def\\x{', '\\def\\be{\\begin{equation}}',
+    '\\newcommand\\m[1]{#1}', '\\m{', '\\newenvironment{e}{\\begin{align}}{\\end{align}}',
+    '\\begin{e}', '%', '\\frac{', '^{', '\\notag', '\\begin{subequations}',
+)
+
+
+def mutate(source, rng, edits):
+    '''A copy of source with edits random insertions and deletions, cut short at random.'''
+    parts = list(source[len(PREAMBLE):rng.randint(len(source) // 2, len(source))])
+    for _ in range(edits):
+        pos = rng.randrange(len(parts) + 1)
+        if rng.random() < 0.3:
+            del parts[pos:pos + rng.randint(1, 200)]
+        else:
+            parts.insert(pos, rng.choice(FRAGMENTS))
+    return PREAMBLE + ''.join(parts)
+
+
+def index_time(source):
+    '''Seconds taken to do with source all that indexing a paper does.'''
+    start = time.perf_counter()
+    # Without a time limit, which would hide how the time grows
+    budget = ParseBudget(max_seconds=float('inf'))
+    entries = [format_equation(equation.body()) for equation in parse_equations(source, budget)]
+    macros = document_macros(source)
+    for latex in entries:
+        fingerprint(latex, macros)
+    return time.perf_counter() - start
+
+
+def best_time(source, repeat):
+    return min(index_time(source) for _ in range(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz the equation parser with adversarial inputs")
+    parser.add_argument("--quick", action="store_true", help="small inputs and few mutations")
+    parser.add_argument("--size-kb", type=int, default=64)
+    parser.add_argument("--mutations", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--slack", type=float, default=2.0,
+                        help="growth allowed over linear from one size to four times it")
+    parser.add_argument("--max-slowdown", type=float, default=50.0,
+                        help="time per byte allowed, relative to a synthetic paper")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.quick:
+        args.size_kb = min(args.size_kb, 16)
+        args.mutations = min(args.mutations, 20)
+
+    small = args.size_kb * KB
+    large = 4 * small
+    paper = synthetic_document(large, seed=args.seed).encode('utf8')
+    per_byte = best_time(paper, args.repeat) / len(paper)
+    print(f"synthetic paper: {per_byte * 1e9:.0f} ns/byte")
+
+    failures = []
+    print(f"{'input':26} {'small s':>9} {'large s':>9} {'growth':>7} {'slowdown':>9}")
+    for name, make in PATHOLOGICAL.items():
+        try:
+            times = [best_time(make(size).encode('utf8'), args.repeat) for size in (small, large)]
+        except Exception:
+            traceback.print_exc()
+            failures.append(f"{name} raised an exception")
+            continue
+        growth = times[1] / times[0] if times[0] else 0.0
+        slowdown = times[1] / len(make(large)) / per_byte
+        print(f"{name:26} {times[0]:9.4f} {times[1]:9.4f} {growth:7.1f} {slowdown:9.1f}")
+        # Below a few milliseconds the timer and the machine's noise dominate
+        if growth > 4 * args.slack and times[1] > 0.005:
+            failures.append(f"{name} grows {growth:.1f} times from {small} to {large} bytes")
+        if slowdown > args.max_slowdown:
+            failures.append(f"{name} is {slowdown:.0f} times slower per byte than a paper")
+
+    rng = random.Random(args.seed)
+    worst = 0.0
+    for i in range(args.mutations):
+        source = mutate(synthetic_document(large, seed=args.seed + i + 1), rng,
+                        rng.randint(1, 200)).encode('utf8')
+        try:
+            slowdown = best_time(source, 1) / len(source) / per_byte
+        except Exception:
+            traceback.print_exc()
+            failures.append(f"mutation {i} raised an exception")
+            continue
+        worst = max(worst, slowdown)
+        if slowdown > args.max_slowdown:
+            failures.append(f"mutation {i} is {slowdown:.0f} times slower per byte than a paper")
+    print(f"{args.mutations} mutations, at worst {worst:.1f} times slower per byte than a paper")
+
+    worst = (0.0, None)
+    for name, make in PATHOLOGICAL.items():
+        # Large enough that parsing it in full takes well over the limit
+        source = make(16 * large).encode('utf8')
+        budget = ParseBudget(max_seconds=BUDGET_SECONDS)
+        start = time.perf_counter()
+        for equation in parse_equations(source, budget):
+            pass
+        elapsed = time.perf_counter() - start
+        worst = max(worst, (elapsed, name))
+        if elapsed > 2 * BUDGET_SECONDS + BUDGET_SLACK:
+            failures.append(f"a {BUDGET_SECONDS} s ParseBudget let {name} run for {elapsed:.3f} s")
+    print(f"with a {BUDGET_SECONDS} s budget, at worst {worst[0]:.3f} s for {worst[1]}")
+
+    for failure in failures:
+        print("FAIL", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+'''
+Query latency of the equation search index.
+
+    python benchmarks/bench_search.py [--papers 500] [--paper-kb 64]
+
+Indexes synthetic papers (see bench_extract.py) into a temporary
+equation index, builds the search index over them and reports the build
+time and the latency of a few queries over the whole index and over a
+single paper.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from bench_extract import synthetic_document
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.functions.equation_search import EquationSearch
+from derive_eq.functions.get_tex_eq_better import parse_equations
+
+QUERIES = [
+    '\\frac{1}{2} g_{\\mu\\nu}',
+    '\\int d^4x \\phi',
+    'e^{i k x} = \\hbar',
+    '\\sum_{n=0}^{\\infty} \\alpha',
+    'x',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark equation search")
+    parser.add_argument("--papers", type=int, default=500)
+    parser.add_argument("--paper-kb", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        index = EquationIndex(os.path.join(work_dir, 'equations.sqlite'))
+        start = time.perf_counter()
+        equations = 0
+        for i in range(args.papers):
+            entries = list(parse_equations(synthetic_document(args.paper_kb * 1024, seed=i)))
+            equations += len(entries)
+            index.store(f'2401.{i:05d}', entries, file_hash=str(i))
+        print(f"parsed {args.papers} papers, {equations} equations in "
+              f"{time.perf_counter() - start:.2f}s")
+
+        search = EquationSearch(index)
+        start = time.perf_counter()
+        search.update()
+        print(f"built search index in {time.perf_counter() - start:.2f}s")
+
+        for arxiv_id in (None, '2401.00007'):
+            scope = 'all papers' if arxiv_id is None else arxiv_id
+            for query in QUERIES:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    results = search.search(query, k=10, arxiv_id=arxiv_id)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                print(f"{scope:>12} {best * 1000:8.2f} ms {len(results):>3} results  {query}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+'''
+Startup budget check for the command line tool.
+
+    python benchmarks/bench_startup.py [--budget-ms 60] [--runs 5]
+
+Runs `derive_eq --help` and a bare import of derive_eq.derive_equation in
+fresh interpreters with -X importtime, and fails (exit status 1) if
+either of them imports a module that should only load on use, or if the
+best-of-runs import time of derive_eq is over the budget. Run it after
+touching imports. The time budget is generous, the module list is what
+catches regressions.
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that must stay out of `derive_eq --help`
+HELP_FORBIDDEN = (
+    'rich', 'openai', 'feedparser', 'numpy', 'tarfile', 'gzip', 'asyncio',
+    'urllib.request', 'sqlite3', 'derive_eq.derive_equation',
+)
+
+# Modules that must stay out of a bare import of the derivation pipeline
+PIPELINE_FORBIDDEN = (
+    'rich', 'openai', 'feedparser', 'numpy', 'tarfile', 'asyncio', 'urllib.request',
+)
+
+HELP_CODE = (
+    "import sys\n"
+    "sys.argv = ['derive_eq', '--help']\n"
+    "from derive_eq.cli import main\n"
+    "try:\n"
+    "    main()\n"
+    "except SystemExit:\n"
+    "    pass\n"
+)
+
+PIPELINE_CODE = "import derive_eq.derive_equation"
+
+
+def import_times(code):
+    '''
+    Run code in a fresh interpreter and return {module: cumulative
+    microseconds}, plus the total for the derive_eq modules it imported
+    directly.
+    '''
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, env=env)
+    times = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+        # Nested imports are indented by two spaces per level
+        top_level = len(name) - len(name.lstrip()) == 1
+        if top_level and name.strip().split('.')[0] == 'derive_eq':
+            total += int(cumulative)
+    return times, total
+
+
+def check(label, code, forbidden, runs, budget_ms):
+    best = None
+    for _ in range(runs):
+        times, total = import_times(code)
+        best = total if best is None else min(best, total)
+
+    failures = []
+    for name in forbidden:
+        if any(module == name or module.startswith(name + '.') for module in times):
+            failures.append(f"{label}: imports {name}")
+    if best / 1000 > budget_ms:
+        failures.append(f"{label}: derive_eq import took {best / 1000:.1f} ms, "
+                        f"budget is {budget_ms} ms")
+    print(f"{label:<10} {best / 1000:7.1f} ms, {len(times)} modules")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the derive_eq startup import budget")
+    parser.add_argument("--budget-ms", type=float, default=60.0,
+                        help="Allowed import time of the derive_eq package")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Runs per check, the fastest one counts")
+    args = parser.parse_args()
+
+    failures = check('--help', HELP_CODE, HELP_FORBIDDEN, args.runs, args.budget_ms)
+    failures += check('pipeline', PIPELINE_CODE, PIPELINE_FORBIDDEN, args.runs,
+                      args.budget_ms * 2)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from derive_eq.derive_equation import index_paper
+from derive_eq.functions.ask_chat import bot
+from derive_eq.functions.async_download import AsyncDownloader, BackgroundLoop
+from derive_eq.functions.canonical import fingerprint
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.functions.get_tex_eq_better import format_equation
+from derive_eq.functions.source_cache import SourceCache
+
+def read_requests(lines):
+    '''
+    Parse "arxiv_id eq_number" pairs, one per line. Commas are accepted as
+    separators, and blank lines and lines starting with # are skipped.
+    '''
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = re.split(r'[\s,]+', line)
+        if len(parts) != 2:
+            yield parts[0], None
+            continue
+        yield parts[0], parts[1].strip('()')
+
+def run_batch(requests, download_workers=4, llm_workers=8, index=None, downloader=None,
+              use_cache=True):
+    '''
+    Derive many equations at once and yield a result dict for each as soon as
+    it is ready.
+
+    Requests are grouped by paper so every paper is fetched and parsed once.
+    Sources missing from the cache are fetched concurrently by an
+    AsyncDownloader over pooled connections, papers are parsed into the index
+    on a pool of download_workers threads, and each of a paper's equations is
+    handed to a pool of llm_workers threads as soon as the paper is ready.
+    Duplicate requests are only derived once, and so are equations of
+    different papers with the same fingerprint, that is equations that only
+    differ in how they are typeset. Derivations already in the result cache
+    are not requested again unless use_cache is False.
+    '''
+    if index is None:
+        index = EquationIndex()
+    if downloader is None:
+        downloader = AsyncDownloader(max_connections_per_host=download_workers)
+    cache = SourceCache()
+
+    papers = {}
+    for arxiv_id, eq_number in requests:
+        if eq_number is None:
+            yield {'arxiv_id': arxiv_id, 'equation': None, 'error': 'missing equation number'}
+            continue
+        numbers = papers.setdefault(arxiv_id, [])
+        if eq_number not in numbers:
+            numbers.append(eq_number)
+
+    def store_and_index(arxiv_id, archive):
+        if archive is not None:
+            cache.put_bytes(arxiv_id, archive)
+        return index_paper(arxiv_id, index)
+
+    def derive(latex):
+        return bot(latex, use_cache=use_cache)
+
+    # Requests waiting on the derivation of each fingerprint, and the
+    # derivations finished so far
+    waiting = {}
+    derived = {}
+
+    loop = BackgroundLoop()
+    try:
+        with ThreadPoolExecutor(download_workers) as parsers, \
+                ThreadPoolExecutor(llm_workers) as llm_calls:
+            pending = {}
+            for arxiv_id in papers:
+                if index.is_current(arxiv_id) or cache.get(arxiv_id) is not None:
+                    job = parsers.submit(store_and_index, arxiv_id, None)
+                    pending[job] = ('index', arxiv_id, None)
+                else:
+                    job = loop.submit(downloader.fetch_source(arxiv_id))
+                    pending[job] = ('fetch', arxiv_id, None)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, arxiv_id, eq_number = pending.pop(future)
+
+                    if stage == 'derive':
+                        # arxiv_id holds the fingerprint that was derived
+                        try:
+                            derived[arxiv_id] = {'derivation': future.result()}
+                        except Exception as e:
+                            derived[arxiv_id] = {'error': str(e)}
+                        for paper, number, latex in waiting.pop(arxiv_id):
+                            yield {'arxiv_id': paper, 'equation': number, 'latex': latex,
+                                   **derived[arxiv_id]}
+                        continue
+
+                    try:
+                        result = future.result()
+                        if stage == 'fetch' and result is None:
+                            raise RuntimeError('paper not found')
+                        if stage == 'index' and not index.is_indexed(arxiv_id):
+                            raise RuntimeError('could not fetch paper source')
+                    except Exception as e:
+                        for number in papers[arxiv_id]:
+                            yield {'arxiv_id': arxiv_id, 'equation': number, 'error': str(e)}
+                        continue
+
+                    if stage == 'fetch':
+                        # Source downloaded, parse it into the index
+                        job = parsers.submit(store_and_index, arxiv_id, result)
+                        pending[job] = ('index', arxiv_id, None)
+                        continue
+
+                    # Paper indexed, queue its derivations
+                    for number in papers[arxiv_id]:
+                        tex_eq = index.lookup(arxiv_id, number)
+                        if tex_eq is None:
+                            yield {'arxiv_id': arxiv_id, 'equation': number,
+                                   'error': 'equation not found'}
+                            continue
+                        latex = format_equation(tex_eq)
+                        key = index.fingerprint(arxiv_id, number) or fingerprint(latex)
+                        if key in derived:
+                            yield {'arxiv_id': arxiv_id, 'equation': number, 'latex': latex,
+                                   **derived[key]}
+                        elif key in waiting:
+                            waiting[key].append((arxiv_id, number, latex))
+                        else:
+                            waiting[key] = [(arxiv_id, number, latex)]
+                            job = llm_calls.submit(derive, latex)
+                            pending[job] = ('derive', key, None)
+    finally:
+        loop.submit(downloader.close()).result()
+        loop.close()
@@ -0,0 +1,254 @@
+import io
+import os
+import posixpath
+import re
+import signal
+import sqlite3
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from derive_eq.functions.canonical import document_macros
+from derive_eq.functions.equation_index import EquationIndex, equation_rows
+from derive_eq.functions.equation_search import EquationSearch
+from derive_eq.functions.get_tex_eq_better import ParseBudget, parse_equations
+from derive_eq.functions.source_archive import read_source_members
+from derive_eq.functions.source_cache import get_cache_dir
+from derive_eq.functions.tex_project import TexSourceView
+from derive_eq.functions.tracing import span
+
+# Papers parsed between two commits to a shard, at most this many are parsed
+# again after an interruption
+COMMIT_EVERY = 200
+
+# Dump members are named like 1901/1901.00001.gz or 9901/hep-th9901001.gz
+_MEMBER_NAME = re.compile(
+    r'^(?P<archive>[a-z-]+(?:\.[A-Z]{2})?)?(?P<number>\d{4}\.\d{4,5}|\d{7})(?P<version>v\d+)?$'
+)
+
+_DUMPS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dumps (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    papers INTEGER NOT NULL,
+    completed_at REAL NOT NULL
+);
+'''
+
+
+def dump_member_id(name):
+    '''
+    Return the arXiv ID of a member of a source dump, or None for members
+    that are not paper sources (PDF-only submissions, manifests).
+    '''
+    base = posixpath.basename(name)
+    for extension in ('.tar.gz', '.tgz', '.gz', '.tar'):
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+            break
+    else:
+        return None
+    match = _MEMBER_NAME.match(base)
+    if match is None:
+        return None
+    number = match.group('number') + (match.group('version') or '')
+    if match.group('archive'):
+        return f"{match.group('archive')}/{number}"
+    return number
+
+
+def find_dumps(paths):
+    '''Expand files and directories into the list of dump tar files to index.'''
+    dumps = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                dumps += [os.path.join(root, file) for file in sorted(files)
+                          if file.endswith('.tar')]
+        else:
+            dumps.append(path)
+    return dumps
+
+
+def iter_dump(path, skip=()):
+    '''
+    Yield (arxiv_id, archive bytes) for the papers in a dump, reading it as a
+    stream. Papers whose ID is in skip are passed over without being read.
+    '''
+    with tarfile.open(path, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            arxiv_id = dump_member_id(member.name)
+            if arxiv_id is None or arxiv_id in skip:
+                continue
+            yield arxiv_id, tar.extractfile(member).read()
+
+
+def _ignore_interrupts():
+    # Ctrl-C is handled by the parent, which saves finished work and stops
+    # the pool, rather than by every worker at once
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def index_source(arxiv_id, archive):
+    '''
+    Parse one paper's e-print into index rows. Runs in a worker process and
+    returns (arxiv_id, rows, file_hash, main file, error). rows is None if
+    the paper failed, and a paper parsed only in part within its ParseBudget
+    comes with both its rows and the reason as error.
+    '''
+    try:
+        members = read_source_members(io.BytesIO(archive))
+        view = TexSourceView.from_members(members)
+        if view is None:
+            # No TeX source, stored without equations so it is not retried
+            return arxiv_id, [], '', None, None
+        with view:
+            budget = ParseBudget()
+            rows = equation_rows(arxiv_id, parse_equations(view.source, budget), view.main,
+                                 view.locate, document_macros(view.source))
+            return arxiv_id, rows, view.digest(), view.main, budget.exceeded
+    except Exception as e:
+        return arxiv_id, None, None, None, f'{type(e).__name__}: {e}'
+
+
+def _shard_name(dump_path):
+    name = os.path.basename(dump_path)
+    for extension in ('.tar.gz', '.tgz', '.tar'):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def _connect_dumps(shard_path):
+    conn = sqlite3.connect(shard_path, timeout=30)
+    conn.executescript(_DUMPS_SCHEMA)
+    return conn
+
+
+def _dump_completed(shard_path, dump_path):
+    stat = os.stat(dump_path)
+    conn = _connect_dumps(shard_path)
+    try:
+        row = conn.execute('SELECT size, mtime, papers FROM dumps WHERE name = ?',
+                           (os.path.basename(dump_path),)).fetchone()
+    finally:
+        conn.close()
+    if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime:
+        return False
+    # Papers indexed by an older parser or canonical form count as missing
+    return row[2] == len(EquationIndex(shard_path).indexed_papers())
+
+
+def _mark_completed(shard_path, dump_path, papers):
+    stat = os.stat(dump_path)
+    conn = _connect_dumps(shard_path)
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO dumps VALUES (?, ?, ?, ?, ?)',
+                         (os.path.basename(dump_path), stat.st_size, stat.st_mtime, papers,
+                          time.time()))
+    finally:
+        conn.close()
+
+
+def index_dump(pool, dump_path, shard_path, max_in_flight):
+    '''
+    Index the papers of one dump into the SQLite shard at shard_path, using
+    the process pool. Returns a dict of counts, or None if the dump was
+    already indexed completely and was not opened.
+
+    Results are committed every COMMIT_EVERY papers. Papers already in the
+    shard are skipped, so an interrupted dump continues where it stopped.
+    A dump is only recorded as complete when none of its papers failed or
+    was parsed only in part, so those papers are tried again on the next
+    run.
+    '''
+    if os.path.exists(shard_path) and _dump_completed(shard_path, dump_path):
+        return None
+
+    counts = {'indexed': 0, 'skipped': 0, 'failed': 0, 'partial': 0}
+
+    index = EquationIndex(shard_path)
+    done = index.indexed_papers()
+    counts['skipped'] = len(done)
+    ready = []
+    pending = set()
+
+    def collect(futures):
+        for future in futures:
+            arxiv_id, rows, file_hash, main, error = future.result()
+            if rows is None:
+                print(f"Error indexing {arxiv_id}: {error}")
+                counts['failed'] += 1
+                continue
+            if error is not None:
+                print(f"Indexed part of {arxiv_id}: {error}")
+                counts['partial'] += 1
+            ready.append((arxiv_id, rows, file_hash, main, error))
+            counts['indexed'] += 1
+        if len(ready) >= COMMIT_EVERY:
+            index.store_rows(ready)
+            ready.clear()
+
+    try:
+        for arxiv_id, archive in iter_dump(dump_path, skip=done):
+            if len(pending) >= max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            pending.add(pool.submit(index_source, arxiv_id, archive))
+        collect(wait(pending)[0])
+        pending = set()
+    finally:
+        # Keep whatever finished, so a resumed run does not parse it again
+        for future in pending:
+            future.cancel()
+        if ready:
+            index.store_rows(ready)
+
+    if not counts['failed'] and not counts['partial']:
+        _mark_completed(shard_path, dump_path, counts['indexed'] + counts['skipped'])
+    return counts
+
+
+def default_shard_dir():
+    return os.path.join(get_cache_dir(), 'shards')
+
+
+def shard_paths(out_dir=None):
+    '''Paths of the shards written by index_dumps() to out_dir, sorted by name.'''
+    if out_dir is None:
+        out_dir = default_shard_dir()
+    if not os.path.isdir(out_dir):
+        return []
+    return [os.path.join(out_dir, name) for name in sorted(os.listdir(out_dir))
+            if name.endswith('.sqlite')]
+
+
+def index_dumps(paths, out_dir=None, workers=None):
+    '''
+    Index arXiv bulk source dumps, tar files of per-paper e-prints, into one
+    SQLite shard per dump below out_dir, parsing papers on a pool of worker
+    processes, and bring the search index of each shard up to date. Yields
+    (dump path, shard path, counts) as each dump finishes.
+    '''
+    if out_dir is None:
+        out_dir = default_shard_dir()
+    os.makedirs(out_dir, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(workers, initializer=_ignore_interrupts) as pool:
+        for dump_path in find_dumps(paths):
+            shard_path = os.path.join(out_dir, _shard_name(dump_path) + '.sqlite')
+            with span('index_dump', dump=os.path.basename(dump_path)) as s:
+                counts = index_dump(pool, dump_path, shard_path, max_in_flight=workers * 4)
+                s.set(**(counts or {'complete': True}))
+            if os.path.exists(shard_path):
+                # Search the shard's new papers without indexing them on the first query
+                with span('search_update', dump=os.path.basename(dump_path)) as s:
+                    s.set(papers=EquationSearch(EquationIndex(shard_path)).update())
+            yield dump_path, shard_path, counts
+
@@ -1,11 +1,529 @@
 import argparse
-from derive_eq.derive_equation import * # Import your backend function
-from rich.markdown import Markdown
-from rich.console import Console   
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from derive_eq.functions.tracing import (
+    JsonLinesSink, TimingSummary, add_sink, remove_sink, span
+)
 
-def main():
+# rich and the derivation pipeline are imported inside the commands that use
+# them, so that --help and argument errors come back without loading them
+
+# Seconds between redraws of a streamed derivation, re-parsing the markdown on
+# every chunk would make long derivations quadratic
+STREAM_REFRESH_INTERVAL = 0.1
+
+def add_tracing_arguments(parser):
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print how long each stage of the run took"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        default=os.environ.get("DERIVE_EQ_TRACE"),
+        help="Append every timed stage to FILE as a JSON line (default $DERIVE_EQ_TRACE)"
+    )
+
+def add_daemon_argument(parser):
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Run in this process even when a derive_eq serve daemon is running"
+    )
+
+def daemon_replies(args, command, **params):
+    '''
+    Hand a command to the derive_eq serve daemon, unless --local was given.
+    Returns an iterator over its replies, or None to run the command here.
+    '''
+    if args.local:
+        return None
+    from derive_eq.client import call
+    return call(command, **params)
+
+@contextmanager
+def tracing(args, command):
+    '''Record spans for the duration of a command, as asked for by --timings and --trace.'''
+    summary = TimingSummary() if args.timings else None
+    trace = JsonLinesSink(args.trace) if args.trace else None
+    sinks = [sink for sink in (summary, trace) if sink is not None]
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        with span('total', command=command):
+            yield
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+        if trace is not None:
+            trace.close()
+        if summary is not None:
+            print_timings(summary)
+
+def _format_attr(key, value):
+    if key.endswith('bytes'):
+        return f"{key}={value / 1024 ** 2:.2f} MB" if value >= 1024 ** 2 else f"{key}={value / 1024:.1f} KB"
+    if isinstance(value, float):
+        return f"{key}={value:.3f}"
+    return f"{key}={value}"
+
+def print_timings(summary):
+    '''Print a TimingSummary as a table on stderr.'''
+    from rich.console import Console
+    from rich.table import Table
+    table = Table(title="Timings")
+    table.add_column("Stage")
+    table.add_column("Calls", justify="right")
+    table.add_column("Total ms", justify="right")
+    table.add_column("Mean ms", justify="right")
+    table.add_column("Max ms", justify="right")
+    table.add_column("Details")
+    for name, count, total, mean, longest, attrs in summary.rows():
+        details = ", ".join(_format_attr(key, value) for key, value in attrs.items())
+        table.add_row(name, str(count), f"{total * 1000:.1f}", f"{mean * 1000:.1f}",
+                      f"{longest * 1000:.1f}", details)
+    Console(stderr=True).print(table)
+
+def list_equations(argv):
+    parser = argparse.ArgumentParser(
+        prog="derive_eq list",
+        description="List the equations of a paper from the local equation index"
+    )
+    parser.add_argument(
+        "arxiv_id",
+        help="arXiv ID of the paper, optionally with a version (e.g. 1907.07069v2)"
+    )
+    add_daemon_argument(parser)
+    add_tracing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from derive_eq.client import DaemonError
+    try:
+        with tracing(args, 'list'):
+            replies = daemon_replies(args, 'list', arxiv_id=args.arxiv_id)
+            if replies is not None:
+                equations = list(replies)[0]['equations']
+            else:
+                from derive_eq.derive_equation import index_paper
+                from derive_eq.functions.get_tex_eq_better import format_equation
+                equations = [[equation[0], format_equation(equation[1:])] for equation
+                             in index_paper(args.arxiv_id).equations(args.arxiv_id) or []]
+    except DaemonError as e:
+        print(f"derive_eq serve: {e}")
+        return 1
+    if not equations:
+        print(f"No equations found for {args.arxiv_id}")
+        return 1
+    for number, latex in equations:
+        number = f"({number})" if number is not None else ""
+        print(f"{number:>8} {latex}")
+    return 0
+
+def render_stream(chunks, console):
+    '''
+    Show a derivation as its chunks arrive and return the full text. The
+    markdown is redrawn in place, cut to the height of the terminal while
+    it streams, and printed once in full when it is complete, so a long
+    derivation does not leave copies of itself in the scrollback.
+    '''
+    from rich.live import Live
+    from rich.markdown import Markdown
+    text = ''
+    last_draw = 0.0
+    with Live(Markdown(''), console=console, auto_refresh=False, transient=True,
+              vertical_overflow="ellipsis") as live:
+        for chunk in chunks:
+            text += chunk
+            now = time.monotonic()
+            if now - last_draw >= STREAM_REFRESH_INTERVAL:
+                live.update(Markdown(text), refresh=True)
+                last_draw = now
+    console.print(Markdown(text))
+    return text
+
+def batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="derive_eq batch",
+        description="Derive many equations and print the results as NDJSON in "
+                    "completion order"
+    )
+    parser.add_argument(
+        "input",
+        nargs="?",
+        default="-",
+        help="File with one 'arxiv_id eq_number' pair per line, or - for stdin"
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=4,
+        help="Number of papers fetched and parsed at once"
+    )
+    parser.add_argument(
+        "--llm-workers",
+        type=int,
+        default=8,
+        help="Number of derivations requested at once"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ask for fresh derivations instead of using cached ones"
+    )
+    add_tracing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from derive_eq.batch import read_requests, run_batch
+    source = sys.stdin if args.input == "-" else open(args.input, "r")
+    failed = 0
+    with source, tracing(args, 'batch'):
+        results = run_batch(read_requests(source), args.download_workers, args.llm_workers,
+                            use_cache=not args.no_cache)
+        for result in results:
+            failed += 'error' in result
+            print(json.dumps(result), flush=True)
+    return 1 if failed else 0
+
+def index(argv):
     parser = argparse.ArgumentParser(
-        description="Derive equations based on given arguments"
+        prog="derive_eq index",
+        description="Index the equations of local arXiv bulk source dumps into SQLite "
+                    "shards, one per dump. Interrupted runs resume where they stopped"
+    )
+    parser.add_argument(
+        "dumps",
+        nargs="+",
+        help="Dump tar files, or directories holding them"
+    )
+    parser.add_argument(
+        "--out",
+        default=None,
+        help="Directory for the shards (default: shards/ in the cache directory)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of parsing processes (default: one per CPU)"
+    )
+    add_tracing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from derive_eq.bulk_index import index_dumps
+    failed = 0
+    try:
+        with tracing(args, 'index'):
+            for dump_path, shard_path, counts in index_dumps(args.dumps, args.out, args.workers):
+                if counts is None:
+                    print(f"{dump_path}: already indexed in {shard_path}")
+                    continue
+                failed += counts['failed']
+                print(f"{dump_path}: {counts['indexed']} indexed ({counts['partial']} in part), "
+                      f"{counts['skipped']} already done, {counts['failed']} failed -> "
+                      f"{shard_path}", flush=True)
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to continue")
+        return 130
+    return 1 if failed else 0
+
+def search(argv):
+    parser = argparse.ArgumentParser(
+        prog="derive_eq search",
+        description="Find equations by their content in the local equation index"
+    )
+    parser.add_argument(
+        "query",
+        help="LaTeX to look for, e.g. '\\frac{1}{2} m v^2'"
+    )
+    parser.add_argument(
+        "--paper",
+        default=None,
+        help="Only search this arXiv paper, fetching it if it is not indexed yet"
+    )
+    parser.add_argument(
+        "-k",
+        type=int,
+        default=10,
+        help="Number of results to show"
+    )
+    parser.add_argument(
+        "--shards",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="DIR",
+        help="Also search the shards written by derive_eq index (default directory "
+             "if DIR is left out)"
+    )
+    add_daemon_argument(parser)
+    add_tracing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from derive_eq.client import DaemonError
+    try:
+        with tracing(args, 'search'):
+            replies = daemon_replies(args, 'search', query=args.query, k=args.k,
+                                     paper=args.paper, shards=args.shards)
+            if replies is not None:
+                results = list(replies)[0]['results']
+            else:
+                results = search_locally(args)
+    except DaemonError as e:
+        print(f"derive_eq serve: {e}")
+        return 1
+
+    if not results:
+        print(f"No equations found for {args.query}")
+        return 1
+    for result in results:
+        number = f"({result['equation']})" if result['equation'] is not None else ""
+        print(f"{result['score']:7.2f} {result['arxiv_id']:>16} {number:>7} {result['latex']}")
+    return 0
+
+def search_locally(args):
+    from derive_eq.functions.equation_index import EquationIndex
+    from derive_eq.functions.equation_search import search_indexes
+    index = EquationIndex()
+    if args.paper is not None:
+        from derive_eq.derive_equation import index_paper
+        index_paper(args.paper, index)
+    indexes = [index]
+    if args.shards is not None:
+        from derive_eq.bulk_index import shard_paths
+        indexes += [EquationIndex(path) for path in shard_paths(args.shards or None)]
+    with span('search', query=args.query) as s:
+        results = search_indexes(indexes, args.query, args.k, args.paper)
+        s.set(results=len(results))
+    return results
+
+def prefetch(argv):
+    parser = argparse.ArgumentParser(
+        prog="derive_eq prefetch",
+        description="Derive every numbered equation of a paper in the background, so that "
+                    "asking for any of them later is answered from the cache"
+    )
+    parser.add_argument(
+        "arxiv_id",
+        help="arXiv ID of the paper, optionally with a version (e.g. 1907.07069v2)"
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Show the daemon's progress until the paper is done (without a daemon, "
+             "prefetch always runs in the foreground)"
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Show how far the daemon has got with the paper"
+    )
+    parser.add_argument(
+        "--cancel",
+        action="store_true",
+        help="Stop the daemon prefetching the paper"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of derivations run at once without a daemon (default "
+             "$DERIVE_EQ_PREFETCH_WORKERS, or 2)"
+    )
+    add_daemon_argument(parser)
+    add_tracing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from derive_eq.client import DaemonError
+    action = 'cancel' if args.cancel else 'status' if args.status else 'start'
+    progress = None
+    try:
+        with tracing(args, 'prefetch'):
+            replies = daemon_replies(args, 'prefetch', arxiv_id=args.arxiv_id, action=action,
+                                     wait=args.wait)
+            if replies is not None:
+                for reply in replies:
+                    progress = reply['progress']
+                    if progress is not None:
+                        print_progress(progress)
+            elif action != 'start':
+                print(f"No daemon running, derive_eq prefetch {args.arxiv_id} prefetches "
+                      f"in this process")
+                return 1
+            else:
+                progress = prefetch_locally(args)
+    except DaemonError as e:
+        print(f"derive_eq serve: {e}")
+        return 1
+    if progress is None:
+        print(f"{args.arxiv_id} is not being prefetched")
+        return 1
+    return 1 if progress['state'] == 'failed' else 0
+
+def prefetch_locally(args):
+    '''Prefetch a paper in this process, printing progress. Ctrl-C cancels it.'''
+    from derive_eq.prefetch import FINISHED, Prefetcher
+    prefetcher = Prefetcher(args.workers)
+    progress = prefetcher.prefetch(args.arxiv_id)
+    try:
+        print_progress(progress)
+        while progress['state'] not in FINISHED:
+            progress = prefetcher.wait(args.arxiv_id, since=progress)
+            print_progress(progress)
+    except KeyboardInterrupt:
+        prefetcher.cancel(args.arxiv_id)
+        progress = prefetcher.progress(args.arxiv_id)
+        print_progress(progress)
+    finally:
+        prefetcher.close()
+    return progress
+
+def print_progress(progress):
+    line = f"{progress['arxiv_id']}: {progress['state']}"
+    if progress['equations'] is not None:
+        line += f", {progress['done']} of {progress['equations']} equations derived"
+        if progress['failed']:
+            line += f", {progress['failed']} failed"
+        if progress['cancelled']:
+            line += f", {progress['cancelled']} cancelled"
+    if progress['error']:
+        line += f" ({progress['error']})"
+    print(line, flush=True)
+
+def diff(argv):
+    parser = argparse.ArgumentParser(
+        prog="derive_eq diff",
+        description="Compare the numbered equations of a revision of a paper with those "
+                    "of an earlier one, and reuse the derivations of the equations it kept"
+    )
+    parser.add_argument(
+        "arxiv_id",
+        help="arXiv ID of the revision, with its version (e.g. 1907.07069v2)"
+    )
+    parser.add_argument(
+        "--since",
+        default=None,
+        metavar="VERSION",
+        help="Earlier version to compare with, e.g. v1 (default: the version before)"
+    )
+    add_tracing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from derive_eq.functions.source_cache import parse_arxiv_id
+    clean_id, version = parse_arxiv_id(args.arxiv_id)
+    if version is None:
+        print(f"derive_eq diff needs a versioned arXiv ID, such as {clean_id}v2")
+        return 1
+    since = int(args.since.lstrip('v')) if args.since else int(version[1:]) - 1
+    if not 0 < since < int(version[1:]):
+        print(f"No earlier version of {args.arxiv_id} to compare with")
+        return 1
+    old_id = f"{clean_id}v{since}"
+
+    from derive_eq.derive_equation import index_paper
+    from derive_eq.functions.equation_index import EquationIndex
+    from derive_eq.functions import revisions
+    with tracing(args, 'diff'):
+        index = EquationIndex()
+        for arxiv_id in (old_id, args.arxiv_id):
+            index_paper(arxiv_id, index)
+        result = revisions.diff_revisions(index, old_id, args.arxiv_id)
+        if result is None:
+            print(f"Could not index both {old_id} and {args.arxiv_id}")
+            return 1
+        reused = revisions.carry_over(result)
+
+    for status, old_number, new_number, old_latex, new_latex in result.entries:
+        if status == revisions.UNCHANGED:
+            continue
+        old_number = f"({old_number})" if old_number is not None else ""
+        new_number = f"({new_number})" if new_number is not None else ""
+        print(f"{old_number:>8} {new_number:>8} {status:10} {new_latex or old_latex}")
+    counts = ", ".join(f"{result.count(status)} {status}" for status in (
+        revisions.UNCHANGED, revisions.RENUMBERED, revisions.CHANGED, revisions.ADDED,
+        revisions.REMOVED))
+    print(f"{old_id} -> {args.arxiv_id}: {counts}")
+    kept = result.count(revisions.UNCHANGED) + result.count(revisions.RENUMBERED)
+    if reused is None:
+        print("No derivations reused, DERIVE_EQ_BACKEND names no backend")
+        return 0
+    print(f"Derivations reused for {reused} of the {kept} equations kept, "
+          f"{len(result.to_derive())} new or changed ones to derive with derive_eq prefetch "
+          f"{args.arxiv_id}")
+    return 0
+
+def serve(argv):
+    parser = argparse.ArgumentParser(
+        prog="derive_eq serve",
+        description="Keep papers, equation indexes and the LLM backend loaded in a "
+                    "background process. derive_eq, derive_eq list, derive_eq search and "
+                    "derive_eq prefetch hand their requests to it while it runs"
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help="Unix socket to listen on (default $DERIVE_EQ_SOCKET, or derive_eq.sock "
+             "in the cache directory)"
+    )
+    parser.add_argument(
+        "--stop",
+        action="store_true",
+        help="Stop the running daemon"
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Show whether a daemon is running"
+    )
+    args = parser.parse_args(argv)
+
+    from derive_eq.client import running, socket_path
+    path = args.socket or socket_path()
+    if args.status:
+        status = running(path)
+        if status is None:
+            print(f"No daemon on {path}")
+            return 1
+        print(f"Running on {path}: pid {status['pid']}, up {status['uptime']:.0f}s, "
+              f"{status['papers']} papers in memory, {status['prefetching']} being prefetched")
+        return 0
+    from derive_eq import server
+    if args.stop:
+        if not server.stop(path):
+            print(f"No daemon on {path}")
+            return 1
+        return 0
+    return server.serve(path)
+
+# Subcommands, anything else is treated as an "arg1 arg2" derivation request
+COMMANDS = {
+    'list': list_equations,
+    'batch': batch,
+    'index': index,
+    'search': search,
+    'prefetch': prefetch,
+    'diff': diff,
+    'serve': serve,
+}
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        sys.exit(COMMANDS[argv[0]](argv[1:]))
+
+    parser = argparse.ArgumentParser(
+        description="Derive equations based on given arguments",
+        epilog="Other commands: derive_eq list ARXIV_ID lists a paper's equations, "
+               "derive_eq batch [FILE] derives many equations at once, "
+               "derive_eq index DUMP... indexes local arXiv source dumps, "
+               "derive_eq search QUERY finds equations by content, "
+               "derive_eq prefetch ARXIV_ID derives a whole paper ahead of time, "
+               "derive_eq diff ARXIV_IDvN compares a revision with the one before, "
+               "derive_eq serve keeps a daemon running to answer them faster"
     )
     parser.add_argument(
         "arg1",
@@ -15,15 +533,49 @@ def main():
         "arg2",
         help="Second argument for equation derivation"
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ask for a fresh derivation instead of using a cached one"
+    )
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="Wait for the whole derivation before showing it"
+    )
+    add_daemon_argument(parser)
+    add_tracing_arguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Call your backend function with the arguments
+    from rich.console import Console
+    from rich.markdown import Markdown
+    from derive_eq.client import DaemonError
     console = Console()
-    result = derive_equation(args.arg1, args.arg2)
-    markdown = Markdown(result)
-    console.print(markdown)
-    print(markdown)
+    try:
+        with tracing(args, 'derive'):
+            replies = daemon_replies(args, 'derive', arxiv_id=args.arg1, eq_number=args.arg2,
+                                     use_cache=not args.no_cache, stream=not args.no_stream)
+            if replies is None:
+                # No daemon, the pipeline is loaded into this process
+                from derive_eq.derive_equation import derive_equation
+            if args.no_stream:
+                if replies is not None:
+                    result = list(replies)[0]['result']
+                else:
+                    result = derive_equation(args.arg1, args.arg2, use_cache=not args.no_cache)
+                console.print(Markdown(result))
+            else:
+                if replies is not None:
+                    chunks = (reply['chunk'] for reply in replies)
+                else:
+                    chunks = derive_equation(args.arg1, args.arg2, use_cache=not args.no_cache,
+                                             stream=True)
+                render_stream(chunks, console)
+    except DaemonError as e:
+        print(f"derive_eq serve: {e}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
@@ -0,0 +1,62 @@
+import json
+import os
+import socket
+from derive_eq.functions.source_cache import get_cache_dir
+
+# Requests and replies are JSON objects, one per line. A reply stream ends
+# with {"end": true}, and {"error": message} reports a failed request.
+
+
+class DaemonError(Exception):
+    '''A request failed inside the daemon, or the daemon went away mid-reply.'''
+
+
+def socket_path():
+    '''
+    Path of the Unix socket derive_eq serve listens on, movable with the
+    DERIVE_EQ_SOCKET environment variable.
+    '''
+    return os.environ.get('DERIVE_EQ_SOCKET') or os.path.join(get_cache_dir(), 'derive_eq.sock')
+
+
+def _replies(sock):
+    with sock, sock.makefile('rb') as stream:
+        for line in stream:
+            reply = json.loads(line)
+            if 'error' in reply:
+                raise DaemonError(reply['error'])
+            if reply.get('end'):
+                return
+            yield reply
+    raise DaemonError("The daemon closed the connection before answering")
+
+
+def call(command, path=None, **params):
+    '''
+    Send a request to a running derive_eq serve daemon and return an
+    iterator over its replies, or None when no daemon is listening.
+    '''
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    if path is None:
+        path = socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({'command': command, **params}).encode('utf8') + b'\n')
+    except OSError:
+        # No socket, or one left behind by a daemon that is gone
+        sock.close()
+        return None
+    return _replies(sock)
+
+
+def running(path=None):
+    '''Return the status reply of the daemon listening at path, or None if there is none.'''
+    replies = call('ping', path)
+    if replies is None:
+        return None
+    try:
+        return list(replies)[0]
+    except (DaemonError, IndexError):
+        return None
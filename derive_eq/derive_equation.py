@@ -1,25 +1,88 @@
-from derive_eq.functions.get_tex_eq import *
-from derive_eq.functions.get_tex_file import *
-from derive_eq.functions.ask_chat import *
-
-def derive_equation(arxiv_id, eq_number):
-    eq_number = int(eq_number)
-    current_dir = os.getcwd()
-    tex_file_path = get_tex_file_path(arxiv_id, download_dir=current_dir)
-    equation = get_tex_eq(tex_file_path, eq_number)
-    derivation = bot(equation)
+from derive_eq.functions.equation_index import EquationIndex, index_tex_view
+from derive_eq.functions.equation_search import EquationSearch
+from derive_eq.functions.get_tex_eq_better import format_equation
+from derive_eq.functions.get_tex_file import load_paper_sources
+from derive_eq.functions.revisions import carry_over, diff_revisions, previous_revision
+from derive_eq.functions.source_cache import SourceCache
+from derive_eq.functions.tex_project import TexSourceView
+from derive_eq.functions.tracing import span
+
+__all__ = ['index_paper', 'get_equation', 'derive_equation']
+
+def index_paper(arxiv_id, index=None):
+    '''
+    Make sure a paper's equations are in the local equation index, downloading
+    and parsing it only if it is missing or was indexed by an older parser.
+    For an ID without a version, whose latest version may have changed, the
+    e-print is checked with the server once it is stale and the paper only
+    parsed again if its sources differ from those indexed.
+    When an earlier version of the paper is indexed, the derivations of the
+    equations this version kept are carried over, see carry_over(). The
+    paper's entry in the search index is brought up to date with it.
+    '''
+    if index is None:
+        index = EquationIndex()
+    cache = SourceCache()
+    if index.is_current(arxiv_id) and not cache.is_stale(arxiv_id):
+        return index
+
+    # The sources are read straight from the archive, nothing is extracted
+    members = load_paper_sources(arxiv_id, cache=cache)
+    with span('assemble', arxiv_id=arxiv_id) as s:
+        view = TexSourceView.from_members(members or {})
+        if view is not None:
+            s.set(files=len(view.reachable_files()), bytes=len(view.source))
+    if view is None:
+        return index
+    with view:
+        indexed = index_tex_view(index, arxiv_id, view)
+    if indexed:
+        previous = previous_revision(index, arxiv_id)
+        if previous is not None:
+            with span('carry_over', arxiv_id=arxiv_id, previous=previous) as s:
+                diff = diff_revisions(index, previous, arxiv_id)
+                s.set(reused=carry_over(diff), to_derive=len(diff.to_derive()))
+    # Keep the search index in step, so that searching never indexes
+    with span('search_update', arxiv_id=arxiv_id):
+        EquationSearch(index).update(arxiv_id)
+    return index
+
+def get_equation(arxiv_id, eq_number, index=None):
+    '''
+    Return the LaTeX of a numbered equation, read from the equation index and
+    only fetching the paper when it has not been indexed yet, or to check
+    that the latest version of an unversioned paper is the one indexed.
+    '''
+    if index is None:
+        index = EquationIndex()
+    if SourceCache().is_stale(arxiv_id):
+        # A new version of the paper may have come out since it was indexed
+        index_paper(arxiv_id, index)
+    with span('index_lookup', arxiv_id=arxiv_id) as s:
+        tex_eq = index.lookup(arxiv_id, eq_number)
+        s.set(hit=tex_eq is not None)
+    if tex_eq is None and not index.is_current(arxiv_id):
+        tex_eq = index_paper(arxiv_id, index).lookup(arxiv_id, eq_number)
+    if tex_eq is None:
+        return None
+    return format_equation(tex_eq)
+
+def derive_equation(arxiv_id, eq_number, use_cache=True, stream=False, index=None):
+    # The LLM client is only loaded once there is an equation to derive
+    from derive_eq.functions.ask_chat import bot
+
+    # Accept "3", "(3)" and subequation numbers like "3a"
+    eq_number = str(eq_number).strip('() ')
+    equation = get_equation(arxiv_id, eq_number, index)
+    if equation is None:
+        message = f"Could not find equation ({eq_number}) in arXiv:{arxiv_id}."
+        return iter([message]) if stream else message
+    # With stream=True this is an iterator over the derivation's chunks
+    derivation = bot(equation, use_cache=use_cache, stream=stream)
     # print(answer)
 
 
     # print(equation)
-    # print(tex_file_path)
-    
-    # Delete the folder and file where the tex file is located
-    if os.path.exists(tex_file_path):
-        os.remove(tex_file_path)
-        folder_path = os.path.dirname(tex_file_path)
-        if os.path.isdir(folder_path):
-            os.rmdir(folder_path)
     
     # print('it worked')
 
@@ -1,22 +1,68 @@
-from openai import OpenAI
+import time
+from derive_eq.functions.backends import DEFAULT_MODEL, SYSTEM_PROMPT, get_backend
+from derive_eq.functions.result_cache import get_result_cache, result_key
+from derive_eq.functions.tracing import span
 # import markdown2
 
-def bot(tex_eq):
-    client = OpenAI(
-        api_key=""
-)
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo-0125",
-        messages=[
-            {"role": "system", "content": "You are a mathematics expert and you are good at providing simple derivations of equations. The user will provide you with an equation in LaTeX and you need to provide the derivation"},
-            {
-                "role": "user",
-                "content": f"Provide me with the derivation of this equation {tex_eq}."
-            }
-        ]
-    )
-
-    return completion.choices[0].message.content
+__all__ = ['bot', 'MODEL', 'SYSTEM_PROMPT']
+
+MODEL = DEFAULT_MODEL
+
+def bot(tex_eq, use_cache=True, stream=False, backend=None):
+    '''
+    Ask the backend (by default the process-wide one from get_backend()) for
+    a derivation of tex_eq.
+
+    Returns the whole derivation, or with stream=True an iterator over its
+    chunks as they arrive. Rate limits, server errors and dropped connections
+    are retried with backoff, see DerivationBackend.derive_retrying(). A
+    streamed derivation is only cached once the stream has finished, and a
+    cached one is yielded as a single chunk.
+    '''
+    if backend is None:
+        backend = get_backend()
+    if stream:
+        return _stream_bot(tex_eq, use_cache, backend)
+
+    # Equations that were derived before are answered from the result cache
+    key = result_key(backend.model, SYSTEM_PROMPT, tex_eq)
+    with span('llm', model=backend.model, cache_hit=False) as s:
+        if use_cache:
+            cached = get_result_cache().get(key)
+            if cached is not None:
+                s.set(cache_hit=True, chars=len(cached))
+                return cached
+
+        derivation = backend.derive_retrying(tex_eq)
+        s.set(chars=len(derivation or ''))
+    if use_cache and derivation:
+        get_result_cache().put(key, derivation)
+    return derivation
+
+def _stream_bot(tex_eq, use_cache, backend):
+    key = result_key(backend.model, SYSTEM_PROMPT, tex_eq)
+    parts = []
+    # The span also covers the time the caller spends rendering each chunk
+    with span('llm', model=backend.model, cache_hit=False, stream=True) as s:
+        if use_cache:
+            cached = get_result_cache().get(key)
+            if cached is not None:
+                s.set(cache_hit=True, chars=len(cached))
+                yield cached
+                return
+
+        start = time.perf_counter()
+        for text in backend.stream_retrying(tex_eq):
+            if not parts:
+                s.set(first_chunk_s=time.perf_counter() - start)
+            parts.append(text)
+            yield text
+        s.set(chars=sum(map(len, parts)))
+
+    # Only a stream that ran to the end is cached, an abandoned one is not
+    derivation = ''.join(parts)
+    if use_cache and derivation:
+        get_result_cache().put(key, derivation)
 
 
 
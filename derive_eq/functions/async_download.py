@@ -0,0 +1,177 @@
+import asyncio
+import os
+import threading
+from urllib.parse import urlsplit
+from derive_eq.functions.download_manager import RETRY_STATUSES, retry_delay
+from derive_eq.functions.source_cache import DEFAULT_BASE_URL, eprint_url, parse_arxiv_id
+from derive_eq.functions.tracing import span
+
+METADATA_URL = 'http://export.arxiv.org/api/query?id_list='
+
+
+class _HostLimit:
+    '''
+    A cap on the requests to one host in flight at once and a minimum
+    interval between the start of two of them.
+    '''
+
+    def __init__(self, max_connections, min_interval):
+        self.min_interval = min_interval
+        self.slots = asyncio.Semaphore(max_connections)
+        self.rate_lock = asyncio.Lock()
+        self.next_start = 0.0
+
+    async def wait_turn(self):
+        if not self.min_interval:
+            return
+        async with self.rate_lock:
+            loop = asyncio.get_running_loop()
+            delay = self.next_start - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_start = loop.time() + self.min_interval
+
+
+class AsyncDownloader:
+    '''
+    Concurrent e-print fetcher that reuses keep-alive connections.
+
+    Requests go through one httpx.AsyncClient, created on first use, which
+    keeps up to max_connections_per_host connections alive per host and
+    follows redirects. Every host gets at most max_connections_per_host
+    requests at once and at most requests_per_second request starts. The
+    e-print response doubles as the existence check, a 404 meaning there is
+    no such paper, so the arXiv API is only queried when check_metadata is
+    set. Dropped connections, timeouts and the statuses in RETRY_STATUSES
+    are retried up to retries times, with the backoff of retry_delay().
+    '''
+
+    def __init__(self, base_url=None, max_connections_per_host=4, requests_per_second=1.0,
+                 check_metadata=False, timeout=60, retries=3, backoff=1.0, max_backoff=60.0):
+        if base_url is None:
+            base_url = os.environ.get('DERIVE_EQ_ARXIV_URL', DEFAULT_BASE_URL)
+        self.base_url = base_url.rstrip('/')
+        self.max_connections_per_host = max_connections_per_host
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.check_metadata = check_metadata
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limits = {}
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            # httpx is only loaded once there is something to download
+            import httpx
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=None,
+                                    max_keepalive_connections=self.max_connections_per_host),
+                timeout=self.timeout,
+                follow_redirects=True,
+                headers={'User-Agent': 'derive_eq/0.1'},
+            )
+        return self._client
+
+    def _limit(self, host):
+        if host not in self.limits:
+            self.limits[host] = _HostLimit(self.max_connections_per_host, self.min_interval)
+        return self.limits[host]
+
+    async def get(self, url, headers=None):
+        '''GET a URL and return its httpx.Response, following redirects.'''
+        limit = self._limit(urlsplit(url).netloc)
+        async with limit.slots:
+            await limit.wait_turn()
+            return await self._get_client().get(url, headers=headers)
+
+    async def paper_exists(self, arxiv_id):
+        '''Ask the arXiv API whether a paper, or the version of it in arxiv_id, exists.'''
+        clean_id, version = parse_arxiv_id(arxiv_id)
+        with span('arxiv_api', arxiv_id=arxiv_id) as s:
+            response = await self.get(METADATA_URL + clean_id + (version or ''))
+            found = response.status_code == 200 and b'<entry>' in response.content
+            s.set(found=found)
+        return found
+
+    async def fetch_source(self, arxiv_id):
+        '''Return the e-print archive of a paper as bytes, or None if there is none.'''
+        import httpx
+
+        if self.check_metadata and not await self.paper_exists(arxiv_id):
+            print(f"No paper found with ID {arxiv_id}")
+            return None
+
+        # The version asked for, or the latest one for an unversioned ID
+        url = eprint_url(arxiv_id, self.base_url)
+        with span('download', arxiv_id=arxiv_id) as s:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = await self.get(url)
+                except httpx.TransportError:
+                    # Connection errors, timeouts and bodies cut short
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(retry_delay(attempt, self.backoff, self.max_backoff))
+                    continue
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    break
+                await asyncio.sleep(retry_delay(attempt, self.backoff, self.max_backoff,
+                                                response.headers.get('retry-after')))
+            s.set(bytes=len(response.content), not_found=response.status_code == 404,
+                  attempts=attempt + 1)
+        if response.status_code == 404:
+            print(f"No paper found with ID {arxiv_id}")
+            return None
+        if response.status_code != 200:
+            raise OSError(f'HTTP {response.status_code} fetching the source of {arxiv_id}')
+        return response.content
+
+    async def fetch_many(self, arxiv_ids):
+        '''
+        Fetch several papers concurrently and return a dict of ID to archive
+        bytes, with None for papers that could not be fetched.
+        '''
+        async def fetch(arxiv_id):
+            try:
+                return await self.fetch_source(arxiv_id)
+            except Exception as e:
+                print(f"Error downloading {arxiv_id}: {e}")
+                return None
+
+        results = await asyncio.gather(*(fetch(arxiv_id) for arxiv_id in arxiv_ids))
+        return dict(zip(arxiv_ids, results))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self.limits = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class BackgroundLoop:
+    '''
+    Event loop running in a daemon thread, so synchronous code such as the
+    batch thread pools can share one AsyncDownloader and its connections.
+    '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        '''Schedule a coroutine and return a concurrent.futures.Future for it.'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
+from derive_eq.functions.result_cache import get_result_cache, result_key
+
+DEFAULT_MODEL = "gpt-3.5-turbo-0125"
+SYSTEM_PROMPT = (
+    "You are a mathematics expert and you are good at providing simple derivations of "
+    "equations. The user will provide you with an equation in LaTeX and you need to "
+    "provide the derivation"
+)
+
+
+def build_messages(tex_eq):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": f"Provide me with the derivation of this equation {tex_eq}."
+        }
+    ]
+
+
+# Retries of a retryable failure, each after a random wait of up to
+# backoff * 2**attempt seconds
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+
+class DerivationBackend:
+    '''
+    Something that turns an equation into a derivation.
+
+    Subclasses implement derive() and may override stream() and aderive(),
+    which by default return the whole derivation as one chunk and run
+    derive() in a worker thread. model is part of the result cache key, so
+    different backends never share cached derivations.
+    '''
+    model = None
+
+    @classmethod
+    def default_model(cls):
+        '''The model of a backend of this kind created without arguments.'''
+        return cls.model
+
+    def derive(self, tex_eq):
+        raise NotImplementedError
+
+    def stream(self, tex_eq):
+        yield self.derive(tex_eq)
+
+    async def aderive(self, tex_eq):
+        return await asyncio.to_thread(self.derive, tex_eq)
+
+    def is_retryable(self, error):
+        '''Whether a failed request is worth trying again.'''
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+    def derive_retrying(self, tex_eq, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        '''
+        derive(), with retryable failures tried again up to retries times
+        after a random wait of up to backoff * 2**attempt seconds, so that
+        clients do not retry in lockstep.
+        '''
+        for attempt in range(retries + 1):
+            try:
+                return self.derive(tex_eq)
+            except Exception as e:
+                if attempt == retries or not self.is_retryable(e):
+                    raise
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+    def stream_retrying(self, tex_eq, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        '''stream(), retried as derive_retrying() is as long as no chunk was yielded.'''
+        for attempt in range(retries + 1):
+            started = False
+            try:
+                for text in self.stream(tex_eq):
+                    started = True
+                    yield text
+                return
+            except Exception as e:
+                if started or attempt == retries or not self.is_retryable(e):
+                    raise
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+    def warm(self):
+        '''Load what the first request needs ahead of it, for long-running processes.'''
+
+    def close(self):
+        pass
+
+
+class OpenAIBackend(DerivationBackend):
+    '''
+    Derivations from the OpenAI chat completions API.
+
+    The client, and with it its pool of keep-alive connections, is created
+    on first use and reused for every later request. The API key comes
+    from OPENAI_API_KEY unless one is passed in, and the model from
+    DERIVE_EQ_MODEL.
+    '''
+
+    def __init__(self, model=None, api_key=None, base_url=None, timeout=60, max_retries=0):
+        self.model = model or self.default_model()
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        # Retries are left to derive_retrying(), stream_retrying() and
+        # derive_many(), which back off with jitter
+        self.max_retries = max_retries
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default_model(cls):
+        return os.environ.get('DERIVE_EQ_MODEL', DEFAULT_MODEL)
+
+    def _options(self):
+        return dict(api_key=self.api_key, base_url=self.base_url, timeout=self.timeout,
+                    max_retries=self.max_retries)
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from openai import OpenAI
+                self._client = OpenAI(**self._options())
+            return self._client
+
+    def _get_async_client(self):
+        # An async client's connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(**self._options())
+            self._async_loop = loop
+        return self._async_client
+
+    def derive(self, tex_eq):
+        completion = self.client.chat.completions.create(
+            model=self.model,
+            messages=build_messages(tex_eq)
+        )
+        return completion.choices[0].message.content
+
+    def stream(self, tex_eq):
+        chunks = self.client.chat.completions.create(
+            model=self.model,
+            messages=build_messages(tex_eq),
+            stream=True
+        )
+        for chunk in chunks:
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                yield text
+
+    async def aderive(self, tex_eq):
+        completion = await self._get_async_client().chat.completions.create(
+            model=self.model,
+            messages=build_messages(tex_eq)
+        )
+        return completion.choices[0].message.content
+
+    def warm(self):
+        self.client
+
+    def is_retryable(self, error):
+        import openai
+        return isinstance(error, (openai.RateLimitError, openai.APIConnectionError,
+                                  openai.APITimeoutError, openai.InternalServerError))
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        # The async client is dropped with its loop
+        self._async_client = None
+        self._async_loop = None
+
+
+class MockBackend(DerivationBackend):
+    '''
+    Offline backend that answers every equation with the same text on every
+    run, for tests and for benchmarking throughput without a network.
+
+    Each request takes latency seconds, and with fail_every set every n-th
+    request raises ConnectionError so retries can be exercised.
+    '''
+    model = 'mock'
+
+    def __init__(self, latency=0.0, chunk_size=16, fail_every=0):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.fail_every = fail_every
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _count_call(self):
+        with self._lock:
+            self.calls += 1
+            if self.fail_every and self.calls % self.fail_every == 0:
+                raise ConnectionError(f'mock failure on call {self.calls}')
+
+    def answer(self, tex_eq):
+        digest = hashlib.sha256(tex_eq.encode('utf8')).hexdigest()
+        steps = [f"{i + 1}. Step {digest[4 * i:4 * i + 4]}." for i in range(3)]
+        return f"Derivation of ${tex_eq}$\n\n" + "\n".join(steps)
+
+    def derive(self, tex_eq):
+        self._count_call()
+        if self.latency:
+            time.sleep(self.latency)
+        return self.answer(tex_eq)
+
+    def stream(self, tex_eq):
+        text = self.derive(tex_eq)
+        for i in range(0, len(text), self.chunk_size):
+            yield text[i:i + self.chunk_size]
+
+    async def aderive(self, tex_eq):
+        self._count_call()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.answer(tex_eq)
+
+
+BACKENDS = {
+    'openai': OpenAIBackend,
+    'mock': MockBackend,
+}
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def get_backend():
+    '''
+    Return the process-wide backend, creating it on first use. DERIVE_EQ_BACKEND
+    picks the kind ("openai" or "mock").
+    '''
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            name = os.environ.get('DERIVE_EQ_BACKEND', 'openai')
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown backend {name!r}, expected one of {', '.join(BACKENDS)}")
+            _default_backend = BACKENDS[name]()
+        return _default_backend
+
+
+def model_name():
+    '''
+    The model of the backend get_backend() returns, for result cache keys,
+    without creating it, or None if DERIVE_EQ_BACKEND names no backend.
+    '''
+    with _default_backend_lock:
+        if _default_backend is not None:
+            return _default_backend.model
+    backend = BACKENDS.get(os.environ.get('DERIVE_EQ_BACKEND', 'openai'))
+    return None if backend is None else backend.default_model()
+
+
+def set_backend(backend):
+    '''Use backend for every later derivation in this process.'''
+    global _default_backend
+    with _default_backend_lock:
+        _default_backend = backend
+
+
+class TokenBucket:
+    '''
+    Rate limiter allowing rate requests per second on average, with bursts of
+    up to capacity requests.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+async def derive_many(equations, backend=None, concurrency=8, requests_per_second=None,
+                      retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, use_cache=True):
+    '''
+    Derive several equations concurrently and return their derivations in
+    the order given, with None for equations that could not be derived.
+
+    At most concurrency requests are in flight at once, and with
+    requests_per_second set they are started no faster than that. Retryable
+    failures are tried again up to retries times, waiting a random time of up
+    to backoff * 2**attempt seconds first so that retries do not arrive in
+    lockstep. Cached derivations are returned without a request.
+    '''
+    if backend is None:
+        backend = get_backend()
+    cache = get_result_cache() if use_cache else None
+    slots = asyncio.Semaphore(concurrency)
+    bucket = TokenBucket(requests_per_second) if requests_per_second else None
+
+    async def derive(tex_eq):
+        key = result_key(backend.model, SYSTEM_PROMPT, tex_eq)
+        if cache is not None:
+            cached = await asyncio.to_thread(cache.get, key)
+            if cached is not None:
+                return cached
+
+        async with slots:
+            for attempt in range(retries + 1):
+                if bucket is not None:
+                    await bucket.acquire()
+                try:
+                    derivation = await backend.aderive(tex_eq)
+                    break
+                except Exception as e:
+                    if attempt == retries or not backend.is_retryable(e):
+                        print(f"Error deriving {tex_eq}: {e}")
+                        return None
+                await asyncio.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+        if cache is not None and derivation:
+            await asyncio.to_thread(cache.put, key, derivation)
+        return derivation
+
+    return await asyncio.gather(*(derive(tex_eq) for tex_eq in equations))
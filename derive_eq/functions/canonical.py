@@ -0,0 +1,335 @@
+import hashlib
+import re
+from derive_eq.functions.tex_lexer import find_definitions
+
+# Part of every fingerprint, so that fingerprints taken by an older
+# canonical_form() never match newer ones. Bump when the form changes.
+CANONICAL_VERSION = 3
+
+# Macro expansions per equation, past which the rest is left unexpanded so a
+# recursive definition cannot loop
+MAX_EXPANSIONS = 256
+
+# Tokens macro expansions may produce for an equation, per token of the
+# equation as written, so that bodies repeating their arguments cannot blow
+# it up and reading arguments again and again stays linear
+EXPANSION_FACTOR = 8
+
+_TOKEN_PATTERN = re.compile(r'\\[A-Za-z@]+|\\.|%[^\n]*|\s+|#\d|.', re.DOTALL)
+
+# Sizing, spacing and numbering commands that change how an equation is typeset
+# but not what it says. The delimiter after \left and \right is kept.
+_LAYOUT = frozenset((
+    '\\left', '\\right', '\\middle', '\\big', '\\Big', '\\bigg', '\\Bigg',
+    '\\bigl', '\\bigr', '\\Bigl', '\\Bigr', '\\biggl', '\\biggr', '\\Biggl', '\\Biggr',
+    '\\bigm', '\\Bigm', '\\biggm', '\\Biggm',
+    '\\,', '\\;', '\\:', '\\!', '\\ ', '\\quad', '\\qquad', '~',
+    '\\displaystyle', '\\textstyle', '\\scriptstyle', '\\scriptscriptstyle',
+    '\\limits', '\\nolimits', '\\nonumber', '\\notag', '&', '\\\\',
+))
+
+# Environments whose & and \\ separate the columns and rows of what they hold,
+# kept there while alignment marks and line breaks elsewhere are layout
+_STRUCTURED = frozenset((
+    'matrix', 'pmatrix', 'bmatrix', 'Bmatrix', 'vmatrix', 'Vmatrix', 'smallmatrix',
+    'matrix*', 'pmatrix*', 'bmatrix*', 'Bmatrix*', 'vmatrix*', 'Vmatrix*',
+    'cases', 'cases*', 'dcases', 'rcases', 'array', 'subarray', 'aligned', 'alignedat',
+    'gathered', 'tabular',
+))
+
+# Commands dropped together with their argument
+_LAYOUT_WITH_ARGUMENT = frozenset(('\\label', '\\tag', '\\hspace', '\\vspace', '\\phantom',
+                                   '\\hphantom', '\\vphantom'))
+
+# Spellings of the same command, and variant glyphs of the same symbol.
+# Equation search merges them too.
+_SYNONYMS = {
+    '\\le': '\\leq', '\\ge': '\\geq', '\\ne': '\\neq', '\\to': '\\rightarrow',
+    '\\gets': '\\leftarrow', '\\dfrac': '\\frac', '\\tfrac': '\\frac',
+    '\\varepsilon': '\\epsilon', '\\varphi': '\\phi', '\\vartheta': '\\theta',
+    '\\varrho': '\\rho', '\\varsigma': '\\sigma', '\\dots': '\\ldots', '\\cdots': '\\ldots',
+    '\\lbrace': '\\{', '\\rbrace': '\\}', '\\land': '\\wedge', '\\lor': '\\vee',
+    '\\lnot': '\\neg', '\\vert': '|', '\\Vert': '\\|', '\\lvert': '|', '\\rvert': '|',
+    '\\lVert': '\\|', '\\rVert': '\\|', '\\dbinom': '\\binom', '\\tbinom': '\\binom',
+}
+
+# Arguments of common commands, braced when written as a single token so
+# that \frac12 and \frac{1}{2} agree
+_ARGUMENTS = {
+    '^': 1, '_': 1, '\\frac': 2, '\\binom': 2, '\\sqrt': 1, '\\hat': 1, '\\bar': 1,
+    '\\vec': 1, '\\tilde': 1, '\\dot': 1, '\\ddot': 1, '\\check': 1, '\\breve': 1,
+    '\\widehat': 1, '\\widetilde': 1, '\\overline': 1, '\\underline': 1,
+    '\\mathbf': 1, '\\mathrm': 1, '\\mathcal': 1, '\\mathbb': 1, '\\mathit': 1,
+    '\\mathsf': 1, '\\mathfrak': 1, '\\boldsymbol': 1, '\\operatorname': 1,
+}
+
+# Punctuation that ends the sentence an equation is part of
+_TRAILING = frozenset((',', '.', ';'))
+
+
+def _tokens(tex):
+    return [token for token in _TOKEN_PATTERN.findall(tex) if token[0] != '%']
+
+
+def document_macros(source):
+    '''
+    The commands a paper defines, for canonical_form() to expand: a dict of
+    name (with its backslash) to (arguments, default tokens, body tokens).
+    source is the paper's text, as str or bytes.
+    '''
+    macros = {}
+    for name, arguments, default, body in find_definitions(source):
+        macros['\\' + name] = (arguments, None if default is None else _tokens(default),
+                               _tokens(body))
+    return macros
+
+
+def _skip_space(stack):
+    while stack and stack[-1].isspace():
+        stack.pop()
+
+
+def _argument(stack):
+    # Pop one argument off the stack of tokens, a group without its braces
+    # or a single token
+    _skip_space(stack)
+    if not stack:
+        return []
+    token = stack.pop()
+    if token != '{':
+        return [token]
+    depth = 1
+    argument = []
+    while stack:
+        token = stack.pop()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                break
+        argument.append(token)
+    return argument
+
+
+def _optional_argument(stack):
+    _skip_space(stack)
+    if not stack or stack[-1] != '[':
+        return None
+    stack.pop()
+    argument = []
+    while stack and stack[-1] != ']':
+        argument.append(stack.pop())
+    if stack:
+        stack.pop()
+    return argument
+
+
+def _parameter(item, values):
+    # The argument a body token stands for, or None
+    if item[0] == '#' and len(item) == 2 and 0 < int(item[1]) <= len(values):
+        return values[int(item[1]) - 1]
+    return None
+
+
+def _expand(tokens, macros):
+    stack = tokens[::-1]
+    expanded = []
+    expansions = 0
+    # Tokens pushed by expansions so far, and how many may be
+    pushed = 0
+    limit = EXPANSION_FACTOR * len(tokens) + 1024
+    while stack:
+        token = stack.pop()
+        macro = macros.get(token) if expansions < MAX_EXPANSIONS else None
+        if macro is None:
+            expanded.append(token)
+            continue
+        expansions += 1
+        arguments, default, body = macro
+        values = []
+        optional = None
+        if default is not None:
+            optional = _optional_argument(stack)
+            values.append(default if optional is None else optional)
+        while len(values) < arguments:
+            values.append(_argument(stack))
+        size = 0
+        for item in body:
+            value = _parameter(item, values)
+            size += 1 if value is None else len(value)
+        if pushed + size > limit:
+            # The use is left as written and nothing further is expanded
+            expanded.append(token)
+            if optional is not None:
+                expanded += ['['] + optional + [']']
+            for value in values[default is not None:]:
+                expanded += ['{'] + value + ['}']
+            expansions = MAX_EXPANSIONS
+            continue
+        pushed += size
+        replacement = []
+        for item in body:
+            value = _parameter(item, values)
+            if value is None:
+                replacement.append(item)
+            else:
+                replacement += value
+        stack += replacement[::-1]
+    return expanded
+
+
+def _matching_braces(tokens):
+    # Index of the } closing each { of tokens, for those that are closed
+    matches = {}
+    opened = []
+    for i, token in enumerate(tokens):
+        if token == '{':
+            opened.append(i)
+        elif token == '}' and opened:
+            matches[opened.pop()] = i
+    return matches
+
+
+def _environment(tokens, i):
+    # Name of the environment \begin or \end at tokens[i - 1] names, or None
+    while i < len(tokens) and tokens[i].isspace():
+        i += 1
+    if i == len(tokens) or tokens[i] != '{':
+        return None
+    name = []
+    for token in tokens[i + 1:i + 34]:
+        if token == '}':
+            return ''.join(name)
+        name.append(token)
+    return None
+
+
+def _normalize(tokens):
+    # Drop layout and merge spellings
+    kept = []
+    matches = None
+    # Whether each environment open at i is one of _STRUCTURED, and how many are
+    environments = []
+    structured = 0
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if token == '\\begin':
+            environments.append(_environment(tokens, i) in _STRUCTURED)
+            structured += environments[-1]
+        elif token == '\\end' and environments:
+            structured -= environments.pop()
+        if token.isspace() or token in _LAYOUT:
+            if token == '\\\\' and i < len(tokens) and tokens[i] in ('*', '['):
+                # \\* and \\[2pt]
+                if tokens[i] == '*':
+                    i += 1
+                if i < len(tokens) and tokens[i] == '[':
+                    while i < len(tokens) and tokens[i] != ']':
+                        i += 1
+                    i += 1
+            if structured and token in ('&', '\\\\'):
+                following = i
+                while following < len(tokens) and tokens[following].isspace():
+                    following += 1
+                # A line break that ends the last row leaves no row after it
+                if token == '&' or following == len(tokens) or tokens[following] != '\\end':
+                    kept.append(token)
+            continue
+        if token in _LAYOUT_WITH_ARGUMENT:
+            while i < len(tokens) and (tokens[i].isspace() or tokens[i] == '*'):
+                i += 1
+            if i < len(tokens) and tokens[i] == '{':
+                if matches is None:
+                    matches = _matching_braces(tokens)
+                # An unclosed group runs to the end
+                i = matches.get(i, len(tokens) - 1) + 1
+            continue
+        kept.append(_SYNONYMS.get(token, token))
+
+    return _brace_arguments(kept)
+
+
+def _brace_arguments(tokens):
+    # One pass however deeply arguments nest. An argument group ends at its
+    # }, or if left open at the token before the end of the group around it,
+    # and the command it belongs to reads its other arguments from there.
+    matches = _matching_braces(tokens)
+    # (end, arguments left to read after it) of the argument groups being read
+    groups = []
+    bound = len(tokens)
+    braced = []
+    # Arguments left to read at i
+    arguments = 0
+    i = 0
+    while i < len(tokens):
+        if i == bound:
+            braced.append('}')
+            i += 1
+            bound, arguments = groups.pop()
+            continue
+        token = tokens[i]
+        i += 1
+        if arguments and token not in ('}', ']'):
+            arguments -= 1
+            if token != '{':
+                braced += ('{', token, '}')
+                continue
+            close = matches.get(i - 1)
+            if close is None or close >= bound:
+                close = bound - 1
+            if close < i:
+                braced += ('{', '}')
+                continue
+            groups.append((bound, arguments))
+            bound = close
+            arguments = 0
+            braced.append(token)
+            continue
+        braced.append(token)
+        arguments = _ARGUMENTS.get(token, 0)
+        if token == '\\sqrt' and i < bound and tokens[i] == '[':
+            # The root's index, left as written
+            while i < bound and tokens[i] != ']':
+                braced.append(tokens[i])
+                i += 1
+            if i < bound:
+                braced.append(']')
+                i += 1
+    return braced
+
+
+def canonical_form(tex, macros=None):
+    '''
+    A normalized spelling of a LaTeX equation, the same for equations that
+    only differ in how they are typeset: whitespace, comments, \\left and
+    \\right, spacing commands, alignment marks and line breaks outside the
+    matrices, cases and arrays they give the shape of, labels and tags,
+    trailing punctuation, braces around single-token arguments and
+    alternative spellings such as \\le and \\leq. With the macros of the
+    paper from document_macros(), the commands it defines are expanded first.
+    '''
+    tokens = _tokens(tex)
+    if macros:
+        tokens = _expand(tokens, macros)
+    tokens = _normalize(tokens)
+    while tokens and tokens[-1] in _TRAILING:
+        tokens.pop()
+
+    parts = []
+    for i, token in enumerate(tokens):
+        parts.append(token)
+        # Keep the space that ends a control word before a letter
+        if (token[0] == '\\' and token[1:].isalpha() and i + 1 < len(tokens)
+                and (tokens[i + 1][0].isalpha() or tokens[i + 1][0] == '@')):
+            parts.append(' ')
+    return ''.join(parts)
+
+
+def fingerprint(tex, macros=None):
+    '''Hex digest of the canonical form of an equation, see canonical_form().'''
+    digest = hashlib.sha256(f'{CANONICAL_VERSION}\0'.encode('utf8'))
+    digest.update(canonical_form(tex, macros).encode('utf8'))
+    return digest.hexdigest()
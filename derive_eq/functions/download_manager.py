@@ -0,0 +1,229 @@
+import json
+import os
+import random
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on Windows, concurrent fetches of one file are not guarded
+    fcntl = None
+
+# Responses worth another attempt, any other error status is final
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class TruncatedDownload(OSError):
+    '''The connection ended before the whole body was received.'''
+
+
+class Download:
+    '''
+    Outcome of DownloadManager.fetch(): the file written, the HTTP status
+    (200, or 304 when the copy revalidated is still current), the validators
+    to revalidate it with later, the bytes received and the offset the
+    transfer was resumed from.
+    '''
+    __slots__ = ('path', 'status', 'validators', 'bytes', 'resumed_from')
+
+    def __init__(self, path, status, validators, bytes, resumed_from=0):
+        self.path = path
+        self.status = status
+        self.validators = validators
+        self.bytes = bytes
+        self.resumed_from = resumed_from
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+
+def response_validators(headers):
+    '''The ETag and Last-Modified of a response, the ones present.'''
+    validators = {}
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    return validators
+
+
+def retry_delay(attempt, backoff, max_backoff, retry_after=None):
+    '''
+    Seconds to wait before retry number attempt + 1: a random time of up to
+    backoff * 2**attempt, so that clients do not retry in lockstep, or what
+    the server asked for in Retry-After. Never more than max_backoff.
+    '''
+    if retry_after is not None:
+        try:
+            return min(max_backoff, max(0.0, float(retry_after)))
+        except ValueError:
+            # An HTTP date, fall back to the usual backoff
+            pass
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def _open_part(part_path):
+    # Lock the partial file, reopening it if another process finished it and
+    # moved it away while this one waited for the lock
+    while True:
+        part = open(part_path, 'ab')
+        if fcntl is not None:
+            fcntl.flock(part, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(part.fileno()), os.stat(part_path)):
+                return part
+        except FileNotFoundError:
+            pass
+        part.close()
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+class DownloadManager:
+    '''
+    Fetches URLs to files so that a failed transfer is resumed rather than
+    started again.
+
+    The body is written to a partial file, target_file + ".part" unless
+    another path is given, and only moved to target_file once complete.
+    The validators of the response are kept next to the partial file, and a
+    later attempt, in this process or another, asks for the rest of the body
+    with a Range request. If-Range makes the server send the whole body
+    instead if it changed in the meantime. A file fetched before can be
+    revalidated with If-None-Match and If-Modified-Since, which costs a 304
+    and no body when it is still current.
+
+    Connection errors, truncated bodies and the statuses in RETRY_STATUSES
+    are retried up to retries times, with the backoff of retry_delay().
+    '''
+
+    def __init__(self, retries=5, backoff=1.0, max_backoff=60.0, timeout=60,
+                 user_agent='derive_eq/0.1'):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.user_agent = user_agent
+
+    def fetch(self, url, target_file, validators=None, part_file=None):
+        '''
+        Download url to target_file and return a Download, or None if the
+        server answers 404. With the validators of an earlier Download, a
+        304 leaves target_file untouched and returns a Download with
+        not_modified set.
+        '''
+        # urllib.request pulls in http.client and email, only load it to download
+        import http.client
+        import urllib.error
+
+        if part_file is None:
+            part_file = target_file + '.part'
+        for attempt in range(self.retries + 1):
+            try:
+                return self._attempt(url, target_file, validators, part_file)
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return None
+                if attempt == self.retries or e.code not in RETRY_STATUSES:
+                    raise
+                delay = retry_delay(attempt, self.backoff, self.max_backoff,
+                                    e.headers.get('Retry-After'))
+            except (OSError, http.client.HTTPException):
+                # URLError, timeouts, resets and truncated bodies
+                if attempt == self.retries:
+                    raise
+                delay = retry_delay(attempt, self.backoff, self.max_backoff)
+            time.sleep(delay)
+
+    def _attempt(self, url, target_file, validators, part_file):
+        import urllib.error
+        import urllib.request
+
+        meta_file = part_file + '.json'
+        # The partial file is only created once the server sends a body, and
+        # locked while it is written to
+        part = _open_part(part_file) if os.path.exists(part_file) else None
+        try:
+            offset = os.fstat(part.fileno()).st_size if part is not None else 0
+            meta = _read_json(meta_file) if offset else None
+            # Only resume when the partial body can be matched to the server's
+            # current copy with If-Range, a weak ETag does not qualify
+            if_range = None
+            if meta is not None and meta.get('url') == url:
+                etag = meta.get('etag')
+                if etag and not etag.startswith('W/'):
+                    if_range = etag
+                else:
+                    if_range = meta.get('last_modified')
+            if if_range is None:
+                offset = 0
+
+            headers = {'User-Agent': self.user_agent}
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+                headers['If-Range'] = if_range
+            elif validators:
+                if validators.get('etag'):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified'):
+                    headers['If-Modified-Since'] = validators['last_modified']
+
+            try:
+                response = urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                                  timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return Download(target_file, 304, validators, 0)
+                if e.code == 416 and offset:
+                    # The partial file is no prefix of the current body
+                    part.truncate(0)
+                    raise TruncatedDownload(f'Range not satisfiable fetching {url}')
+                raise
+
+            with response:
+                if part is None:
+                    part = _open_part(part_file)
+                if response.status == 206:
+                    if not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                        part.truncate(0)
+                        raise TruncatedDownload(f'Unexpected Content-Range fetching {url}')
+                    resumed_from = offset
+                    received_validators = meta
+                else:
+                    # A full body, either first time or because the copy changed
+                    resumed_from = 0
+                    part.truncate(0)
+                    received_validators = response_validators(response.headers)
+                    with open(meta_file, 'w') as file:
+                        json.dump({'url': url, **received_validators}, file)
+
+                length = response.headers.get('Content-Length')
+                received = 0
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    part.write(chunk)
+                    received += len(chunk)
+                part.flush()
+                if length is not None and received < int(length):
+                    raise TruncatedDownload(f'Got {received} of {length} bytes fetching {url}')
+
+            os.replace(part_file, target_file)
+            received_validators = {key: value for key, value in received_validators.items()
+                                   if key != 'url'}
+            if os.path.exists(meta_file):
+                os.remove(meta_file)
+            return Download(target_file, 200, received_validators, received, resumed_from)
+        finally:
+            if part is not None:
+                part.close()
@@ -0,0 +1,354 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from derive_eq.functions.canonical import CANONICAL_VERSION, document_macros, fingerprint
+from derive_eq.functions.source_cache import get_cache_dir, parse_arxiv_id
+from derive_eq.functions.get_tex_eq_better import (
+    PARSER_VERSION, ParseBudget, format_equation, parse_equations
+)
+from derive_eq.functions.tex_project import TexSourceView
+from derive_eq.functions.tracing import span
+
+# Stored with every paper. Papers indexed by another parser version, or with
+# fingerprints taken by another canonical form, are treated as missing.
+INDEX_VERSION = PARSER_VERSION * 1000 + CANONICAL_VERSION
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS papers (
+    arxiv_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    source_file TEXT,
+    file_hash TEXT NOT NULL,
+    parser_version INTEGER NOT NULL,
+    indexed_at REAL NOT NULL,
+    partial TEXT,
+    PRIMARY KEY (arxiv_id, version)
+);
+CREATE TABLE IF NOT EXISTS equations (
+    arxiv_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    eq_number TEXT,
+    body TEXT NOT NULL,
+    source_file TEXT,
+    start_offset INTEGER,
+    end_offset INTEGER,
+    line INTEGER,
+    fingerprint TEXT,
+    PRIMARY KEY (arxiv_id, version, position)
+);
+CREATE INDEX IF NOT EXISTS equations_by_number
+    ON equations (arxiv_id, version, eq_number);
+'''
+
+
+_STORE_PAPER = ('INSERT OR REPLACE INTO papers (arxiv_id, version, source_file, file_hash, '
+                'parser_version, indexed_at, partial) VALUES (?, ?, ?, ?, ?, ?, ?)')
+
+
+def _paper_key(arxiv_id):
+    '''Index key for an arXiv ID, unversioned IDs are stored under "".'''
+    clean_id, version = parse_arxiv_id(arxiv_id)
+    return clean_id, version or ''
+
+
+def equation_rows(arxiv_id, equations, source_file=None, locate=None, macros=None):
+    '''
+    Turn the Equation records yielded by parse_equations() into rows of the
+    equations table. When the source was assembled from several files,
+    locate maps an offset to (file, offset, line) as TexSourceView.locate()
+    does. Each row carries the fingerprint of the equation, with the
+    paper's macros from document_macros() expanded.
+    '''
+    clean_id, version = _paper_key(arxiv_id)
+    rows = []
+    for position, equation in enumerate(equations):
+        start, end = equation.start, equation.end
+        if locate is not None:
+            file_name, file_start, line = locate(start)
+            end = file_start + (end - start)
+            start = file_start
+        else:
+            file_name, line = source_file, None
+        body = equation.body()
+        rows.append((clean_id, version, position, equation.number, json.dumps(body),
+                     file_name, start, end, line, fingerprint(format_equation(body), macros)))
+    return rows
+
+
+class EquationIndex:
+    '''
+    SQLite store of extracted equations, keyed by arXiv ID and version.
+
+    Each paper row records the hash of the source it was parsed from and the
+    INDEX_VERSION it was indexed with. Papers indexed by another parser or
+    canonical form are treated as missing, and re-indexing a source with an
+    unchanged hash is a no-op. A paper whose parse was cut short by its
+    ParseBudget keeps the reason in partial: its equations are served, but
+    it is not current and is parsed again when next indexed.
+    '''
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'equations.sqlite')
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            if 'partial' not in [row[1] for row in conn.execute('PRAGMA table_info(papers)')]:
+                # Indexes created before truncated parses were told apart
+                conn.execute('ALTER TABLE papers ADD COLUMN partial TEXT')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(equations)')]
+            if 'line' not in columns:
+                # Indexes created before equations were traced to their line
+                conn.execute('ALTER TABLE equations ADD COLUMN line INTEGER')
+            if 'fingerprint' not in columns:
+                # Equations indexed before have none and are never taken for duplicates
+                conn.execute('ALTER TABLE equations ADD COLUMN fingerprint TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS equations_by_fingerprint '
+                         'ON equations (fingerprint)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def paper(self, arxiv_id):
+        '''Return the stored paper row as a dict, or None if not indexed.'''
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT source_file, file_hash, parser_version, indexed_at, partial FROM papers '
+                'WHERE arxiv_id = ? AND version = ?', _paper_key(arxiv_id)
+            ).fetchone()
+        if row is None:
+            return None
+        source_file, file_hash, parser_version, indexed_at, partial = row
+        return {
+            'source_file': source_file,
+            'file_hash': file_hash,
+            'parser_version': parser_version,
+            'indexed_at': indexed_at,
+            'partial': partial,
+        }
+
+    def is_indexed(self, arxiv_id):
+        '''True if the paper is indexed with the running INDEX_VERSION, in full or in part.'''
+        paper = self.paper(arxiv_id)
+        return paper is not None and paper['parser_version'] == INDEX_VERSION
+
+    def is_current(self, arxiv_id, file_hash=None):
+        '''
+        True if the paper is indexed in full with the running INDEX_VERSION
+        and, when file_hash is given, from a source with that hash.
+        '''
+        paper = self.paper(arxiv_id)
+        if paper is None or paper['parser_version'] != INDEX_VERSION or paper['partial']:
+            return False
+        return file_hash is None or paper['file_hash'] == file_hash
+
+    def store(self, arxiv_id, equations, file_hash, source_file=None, locate=None, macros=None,
+              partial=None):
+        '''
+        Replace the equations of a paper with the Equation records yielded by
+        parse_equations(), see equation_rows() for locate and macros. partial
+        is why the parse stopped short, the exceeded of its ParseBudget.
+        '''
+        rows = equation_rows(arxiv_id, equations, source_file, locate, macros)
+        self.store_rows([(arxiv_id, rows, file_hash, source_file, partial)])
+
+    def store_rows(self, papers):
+        '''
+        Replace the equations of several papers in one transaction. papers
+        holds (arxiv_id, rows, file_hash, source_file, partial) tuples with
+        rows made by equation_rows().
+        '''
+        with self._connect() as conn:
+            for arxiv_id, rows, file_hash, source_file, partial in papers:
+                clean_id, version = _paper_key(arxiv_id)
+                conn.execute('DELETE FROM equations WHERE arxiv_id = ? AND version = ?',
+                             (clean_id, version))
+                conn.executemany(
+                    'INSERT INTO equations (arxiv_id, version, position, eq_number, body, '
+                    'source_file, start_offset, end_offset, line, fingerprint) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    rows)
+                conn.execute(_STORE_PAPER, (clean_id, version, source_file, file_hash,
+                                            INDEX_VERSION, time.time(), partial))
+
+    def adopt(self, arxiv_id, file_hash):
+        '''
+        Index a paper by copying the equations of another version of it that
+        was parsed in full by the running parser from sources with the same
+        hash, as revisions that only change the abstract or metadata have.
+        Returns False if there is no such version.
+        '''
+        clean_id, version = _paper_key(arxiv_id)
+        columns = ('position, eq_number, body, source_file, start_offset, end_offset, line, '
+                   'fingerprint')
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT version, source_file FROM papers WHERE arxiv_id = ? AND version != ? '
+                'AND file_hash = ? AND parser_version = ? AND partial IS NULL '
+                'ORDER BY indexed_at DESC LIMIT 1',
+                (clean_id, version, file_hash, INDEX_VERSION)
+            ).fetchone()
+            if row is None:
+                return False
+            conn.execute('DELETE FROM equations WHERE arxiv_id = ? AND version = ?',
+                         (clean_id, version))
+            conn.execute(
+                f'INSERT INTO equations (arxiv_id, version, {columns}) '
+                f'SELECT arxiv_id, ?, {columns} FROM equations WHERE arxiv_id = ? AND version = ?',
+                (version, clean_id, row[0]))
+            conn.execute(_STORE_PAPER, (clean_id, version, row[1], file_hash, INDEX_VERSION,
+                                        time.time(), None))
+        return True
+
+    def revisions(self, arxiv_id):
+        '''
+        Versions of a paper indexed by the running parser, as full arXiv IDs
+        oldest first, leaving out the unversioned copy.
+        '''
+        clean_id, version = _paper_key(arxiv_id)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT version FROM papers WHERE arxiv_id = ? AND version != '' "
+                'AND parser_version = ?', (clean_id, INDEX_VERSION)
+            ).fetchall()
+        return [clean_id + version for version in sorted((row[0] for row in rows),
+                                                          key=lambda v: int(v[1:]))]
+
+    def indexed_papers(self):
+        '''
+        Set of the arXiv IDs, with their version if any, indexed in full by
+        the running parser.
+        '''
+        with self._connect() as conn:
+            rows = conn.execute('SELECT arxiv_id, version FROM papers WHERE parser_version = ? '
+                                'AND partial IS NULL', (INDEX_VERSION,)).fetchall()
+        return {arxiv_id + version for arxiv_id, version in rows}
+
+    def lookup(self, arxiv_id, equation_number):
+        '''
+        Return the equation body for a number, in the same form as
+        get_tex_eq(), or None if the paper is not indexed or has no such
+        equation.
+        '''
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT e.body FROM equations e JOIN papers p USING (arxiv_id, version) '
+                'WHERE e.arxiv_id = ? AND e.version = ? AND e.eq_number = ? '
+                'AND p.parser_version = ? ORDER BY e.position LIMIT 1',
+                _paper_key(arxiv_id) + (str(equation_number), INDEX_VERSION)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def fingerprint(self, arxiv_id, equation_number):
+        '''
+        Return the fingerprint of a numbered equation, equal for equations that
+        only differ in how they are typeset, or None if it is not indexed.
+        '''
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT e.fingerprint FROM equations e JOIN papers p USING (arxiv_id, version) '
+                'WHERE e.arxiv_id = ? AND e.version = ? AND e.eq_number = ? '
+                'AND p.parser_version = ? ORDER BY e.position LIMIT 1',
+                _paper_key(arxiv_id) + (str(equation_number), INDEX_VERSION)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def fingerprints(self, arxiv_id):
+        '''
+        Return {eq_number: fingerprint} for the numbered equations of a paper,
+        with None for equations indexed before fingerprints were stored, or
+        None if the paper is not indexed.
+        '''
+        if not self.is_indexed(arxiv_id):
+            return None
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT eq_number, fingerprint FROM equations WHERE arxiv_id = ? AND version = ? '
+                'AND eq_number IS NOT NULL ORDER BY position', _paper_key(arxiv_id)
+            ).fetchall()
+        # A number used twice refers to its first equation, as in lookup()
+        fingerprints = {}
+        for eq_number, fingerprint in rows:
+            fingerprints.setdefault(eq_number, fingerprint)
+        return fingerprints
+
+    def duplicates(self, fingerprint):
+        '''(arxiv_id, eq_number) of every indexed equation with this fingerprint.'''
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT e.arxiv_id || e.version, e.eq_number FROM equations e '
+                'JOIN papers p USING (arxiv_id, version) '
+                'WHERE e.fingerprint = ? AND p.parser_version = ? ORDER BY 1, e.position',
+                (fingerprint, INDEX_VERSION)
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def equations(self, arxiv_id):
+        '''
+        Return every entry of a paper in document order as [eq_num, ...] lists,
+        or None if the paper is not indexed.
+        '''
+        if not self.is_indexed(arxiv_id):
+            return None
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT eq_number, body FROM equations WHERE arxiv_id = ? AND version = ? '
+                'ORDER BY position', _paper_key(arxiv_id)
+            ).fetchall()
+        return [[eq_number] + json.loads(body) for eq_number, body in rows]
+
+    def invalidate(self, arxiv_id):
+        '''Drop a paper from the index.'''
+        clean_id, version = _paper_key(arxiv_id)
+        with self._connect() as conn:
+            conn.execute('DELETE FROM equations WHERE arxiv_id = ? AND version = ?',
+                         (clean_id, version))
+            conn.execute('DELETE FROM papers WHERE arxiv_id = ? AND version = ?',
+                         (clean_id, version))
+
+
+def index_tex_view(index, arxiv_id, view):
+    '''
+    Parse a paper assembled by a TexSourceView into the index, unless it is
+    already indexed from the same sources by the same parser version, or
+    another version of it is and its equations are copied. A paper past the
+    limits of a ParseBudget is indexed with the equations found within them
+    and marked partial, so it is parsed again the next time.
+    '''
+    file_hash = view.digest()
+    if index.is_current(arxiv_id, file_hash):
+        return False
+    if index.adopt(arxiv_id, file_hash):
+        return True
+
+    budget = ParseBudget()
+    with span('parse', arxiv_id=arxiv_id, bytes=len(view.source)) as s:
+        equations = list(parse_equations(view.source, budget))
+        s.set(equations=len(equations), partial=budget.exceeded is not None)
+    if budget.exceeded is not None:
+        print(f"Indexed part of {arxiv_id}: {budget.exceeded}")
+    with span('index_store', arxiv_id=arxiv_id, equations=len(equations)):
+        index.store(arxiv_id, equations, file_hash, source_file=view.main, locate=view.locate,
+                    macros=document_macros(view.source), partial=budget.exceeded)
+    return True
+
+
+def index_tex_file(index, arxiv_id, tex_file_path):
+    '''
+    Parse a paper's main tex file, and the files it inputs, into the index.
+    '''
+    with TexSourceView.from_file(tex_file_path) as view:
+        return index_tex_view(index, arxiv_id, view)
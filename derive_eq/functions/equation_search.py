@@ -0,0 +1,368 @@
+import heapq
+import json
+import math
+import re
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+from derive_eq.functions.canonical import _LAYOUT, _LAYOUT_WITH_ARGUMENT, _SYNONYMS
+from derive_eq.functions.equation_index import _paper_key
+from derive_eq.functions.get_tex_eq_better import format_equation
+
+# Longest token n-gram indexed, unigrams to trigrams
+MAX_NGRAM = 3
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Stored with the search index, which is rebuilt when it changes. Bump when
+# the terms latex_terms() makes for an equation change.
+SEARCH_VERSION = 1
+
+# Query terms in more than this share of all equations (single letters, =)
+# are left out when the query has rarer terms, they barely change the
+# ranking but have the longest posting lists
+COMMON_TERM_SHARE = 0.3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS search_papers (
+    arxiv_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    indexed_at REAL NOT NULL,
+    first_doc INTEGER NOT NULL,
+    last_doc INTEGER NOT NULL,
+    PRIMARY KEY (arxiv_id, version)
+);
+CREATE TABLE IF NOT EXISTS search_docs (
+    doc INTEGER PRIMARY KEY,
+    arxiv_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS search_terms (
+    term_id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE,
+    df INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS search_postings (
+    term_id INTEGER NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term_id, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS search_postings_by_doc ON search_postings (doc);
+CREATE TABLE IF NOT EXISTS search_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    docs INTEGER NOT NULL,
+    total_length INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO search_stats (id, docs, total_length) VALUES (0, 0, 0);
+'''
+
+# Weights of the query terms, a temporary table of the connection so that
+# the number of terms is not limited by SQLite's host parameters
+_WEIGHTS_SCHEMA = '''
+CREATE TEMP TABLE IF NOT EXISTS search_weights (
+    term_id INTEGER PRIMARY KEY,
+    weight REAL NOT NULL
+);
+DELETE FROM search_weights;
+'''
+
+# Host parameters per IN (...) query, below SQLite's limit
+_CHUNK = 500
+
+_TOKEN_PATTERN = re.compile(r'\\[A-Za-z]+|\\.|[A-Za-z]|\d+(?:\.\d+)?|[^\s{}&$~]')
+
+# Commands whose token is dropped: those canonical_form() drops as layout,
+# and font and text commands, so that \mathbf{x} is also found by x
+_IGNORED = _LAYOUT | _LAYOUT_WITH_ARGUMENT | frozenset((
+    '\\mathrm', '\\mathbf', '\\mathit', '\\mathsf', '\\mathtt', '\\boldsymbol', '\\bm',
+    '\\text', '\\textrm', '\\textbf', '\\textit', '\\operatorname',
+))
+
+
+def _select_in(conn, query, values):
+    '''Rows of a query with one "IN (%s)", run over values _CHUNK at a time.'''
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), _CHUNK):
+        chunk = values[i:i + _CHUNK]
+        rows += conn.execute(query % ', '.join('?' * len(chunk)), chunk).fetchall()
+    return rows
+
+
+def normalize_latex(tex):
+    '''
+    Split LaTeX into normalized tokens: control words, single letters,
+    numbers and symbols. Braces, alignment marks, spacing and font commands
+    are dropped, and alternative spellings such as \\le and \\leq are merged
+    as canonical_form() merges them.
+    '''
+    tokens = []
+    for token in _TOKEN_PATTERN.findall(tex):
+        if token in _IGNORED:
+            continue
+        tokens.append(_SYNONYMS.get(token, token))
+    return tokens
+
+
+def latex_terms(tex):
+    '''Counter of the token n-grams of tex, from single tokens up to MAX_NGRAM.'''
+    tokens = normalize_latex(tex)
+    terms = Counter(tokens)
+    for n in range(2, MAX_NGRAM + 1):
+        terms.update(map(' '.join, zip(*(tokens[i:] for i in range(n)))))
+    return terms
+
+
+class EquationSearch:
+    '''
+    Inverted index over the equations of an EquationIndex, kept in the same
+    SQLite file.
+
+    Every equation is indexed under its normalized token n-grams and queries
+    are ranked with BM25, looking up only the posting lists of the query's
+    terms. Papers added to, re-parsed into or dropped from the equation
+    index are picked up by update(), which is run as papers are indexed,
+    so that a search never has to index anything. A search index built
+    with another SEARCH_VERSION is built again when it is opened.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.path = index.path
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(search_stats)')]
+            if 'version' not in columns:
+                # Search indexes created before their terms were versioned
+                conn.execute('ALTER TABLE search_stats ADD COLUMN version INTEGER NOT NULL '
+                             'DEFAULT 0')
+            # A row of a paper whose terms are to be made again, if any
+            rebuild = None
+            if conn.execute('SELECT version FROM search_stats').fetchone()[0] != SEARCH_VERSION:
+                # Terms made by another version may not match those of queries
+                rebuild = conn.execute('SELECT 1 FROM search_papers LIMIT 1').fetchone()
+                for table in ('search_papers', 'search_docs', 'search_terms', 'search_postings'):
+                    conn.execute(f'DELETE FROM {table}')
+                conn.execute('UPDATE search_stats SET docs = 0, total_length = 0, version = ?',
+                             (SEARCH_VERSION,))
+        if rebuild is not None:
+            # The papers it held are indexed again with the terms of this version
+            self.update()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _term_ids(self, conn, terms):
+        '''Return {term: term_id} for terms, adding the ones not seen before.'''
+        terms = list(terms)
+        conn.executemany('INSERT OR IGNORE INTO search_terms (term, df) VALUES (?, 0)',
+                         [(term,) for term in terms])
+        return dict(_select_in(
+            conn, 'SELECT term, term_id FROM search_terms WHERE term IN (%s)', terms))
+
+    def _remove_docs(self, conn, first_doc, last_doc):
+        conn.executemany('UPDATE search_terms SET df = df - ? WHERE term_id = ?', [
+            (count, term_id) for term_id, count in conn.execute(
+                'SELECT term_id, COUNT(*) FROM search_postings WHERE doc BETWEEN ? AND ? '
+                'GROUP BY term_id', (first_doc, last_doc))
+        ])
+        conn.execute('DELETE FROM search_postings WHERE doc BETWEEN ? AND ?',
+                     (first_doc, last_doc))
+        docs, length = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(length), 0) FROM search_docs WHERE doc BETWEEN ? AND ?',
+            (first_doc, last_doc)).fetchone()
+        conn.execute('UPDATE search_stats SET docs = docs - ?, total_length = total_length - ?',
+                     (docs, length))
+        conn.execute('DELETE FROM search_docs WHERE doc BETWEEN ? AND ?', (first_doc, last_doc))
+
+    def update(self, arxiv_id=None):
+        '''
+        Index the equations of papers that are new or changed since the last
+        update, and drop those of papers no longer in the equation index.
+        With arxiv_id, only that paper is looked at. Returns the number of
+        papers indexed or dropped.
+        '''
+        removed_filter = stale_filter = ''
+        parameters = ()
+        if arxiv_id is not None:
+            removed_filter = 'AND s.arxiv_id = ? AND s.version = ?'
+            stale_filter = 'AND p.arxiv_id = ? AND p.version = ?'
+            parameters = _paper_key(arxiv_id)
+        with self._connect() as conn:
+            removed = conn.execute(
+                'SELECT s.arxiv_id, s.version, s.first_doc, s.last_doc FROM search_papers s '
+                'LEFT JOIN papers p USING (arxiv_id, version) '
+                'WHERE p.arxiv_id IS NULL ' + removed_filter, parameters
+            ).fetchall()
+            for removed_id, version, first_doc, last_doc in removed:
+                self._remove_docs(conn, first_doc, last_doc)
+                conn.execute('DELETE FROM search_papers WHERE arxiv_id = ? AND version = ?',
+                             (removed_id, version))
+            stale = conn.execute(
+                'SELECT p.arxiv_id, p.version, p.indexed_at, s.first_doc, s.last_doc '
+                'FROM papers p LEFT JOIN search_papers s USING (arxiv_id, version) '
+                'WHERE (s.indexed_at IS NULL OR s.indexed_at < p.indexed_at) ' + stale_filter,
+                parameters
+            ).fetchall()
+            if not stale:
+                return len(removed)
+            next_doc = conn.execute('SELECT COALESCE(MAX(doc), 0) + 1 FROM search_docs').fetchone()[0]
+            for arxiv_id, version, indexed_at, first_doc, last_doc in stale:
+                if first_doc is not None:
+                    self._remove_docs(conn, first_doc, last_doc)
+                rows = conn.execute(
+                    'SELECT position, body FROM equations WHERE arxiv_id = ? AND version = ? '
+                    'ORDER BY position', (arxiv_id, version)
+                ).fetchall()
+                first = next_doc
+                docs = []
+                doc_terms = []
+                for position, body in rows:
+                    terms = latex_terms(format_equation(json.loads(body)))
+                    if not terms:
+                        continue
+                    docs.append((next_doc, arxiv_id, version, position, sum(terms.values())))
+                    doc_terms.append((next_doc, terms))
+                    next_doc += 1
+
+                # Every term of a paper is looked up or added once
+                df = Counter(term for doc, terms in doc_terms for term in terms)
+                ids = self._term_ids(conn, df)
+                conn.executemany('INSERT INTO search_docs VALUES (?, ?, ?, ?, ?)', docs)
+                conn.executemany('INSERT INTO search_postings VALUES (?, ?, ?)', [
+                    (ids[term], doc, tf) for doc, terms in doc_terms for term, tf in terms.items()
+                ])
+                conn.executemany('UPDATE search_terms SET df = df + ? WHERE term_id = ?',
+                                 [(count, ids[term]) for term, count in df.items()])
+                conn.execute('UPDATE search_stats SET docs = docs + ?, total_length = total_length + ?',
+                             (len(docs), sum(doc[4] for doc in docs)))
+                conn.execute('INSERT OR REPLACE INTO search_papers VALUES (?, ?, ?, ?, ?)',
+                             (arxiv_id, version, indexed_at, first, next_doc - 1))
+        return len(removed) + len(stale)
+
+    def stats(self, query_terms):
+        '''
+        The BM25 statistics of the search index for the terms of a query:
+        (equations, their total length in terms, {term: equations with it}).
+        '''
+        with self._connect() as conn:
+            total, total_length = conn.execute(
+                'SELECT docs, total_length FROM search_stats').fetchone()
+            df = dict(_select_in(
+                conn, 'SELECT term, df FROM search_terms WHERE df > 0 AND term IN (%s)',
+                query_terms))
+        return total, total_length, df
+
+    def search(self, query, k=10, arxiv_id=None, stats=None):
+        '''
+        Return the k equations that best match a LaTeX query, best first, as
+        dicts with arxiv_id, equation number, latex and score. arxiv_id
+        limits the search to one paper. stats, as returned by stats(), is
+        what the equations are scored against, by default this index's own;
+        indexes searched together are given their combined stats so their
+        scores can be compared.
+        '''
+        query_terms = latex_terms(query)
+        if not query_terms:
+            return []
+        if stats is None:
+            stats = self.stats(query_terms)
+        total, total_length, df = stats
+        if not total or not df:
+            return []
+        average_length = total_length / total
+
+        with self._connect() as conn:
+            known = [(term, term_id, df[term]) for term, term_id in _select_in(
+                conn, 'SELECT term, term_id FROM search_terms WHERE df > 0 AND term IN (%s)',
+                query_terms) if term in df]
+            if not known:
+                return []
+            # Very common terms are left out when rarer ones can carry the
+            # ranking, except within one paper where posting lists are short
+            if arxiv_id is None and min(df.values()) <= total * COMMON_TERM_SHARE:
+                known = [row for row in known if row[2] <= total * COMMON_TERM_SHARE]
+                if not known:
+                    # The rarer terms are only in other indexes
+                    return []
+
+            # Each term's weight is its idf times how often the query has it,
+            # the BM25 sum over the posting lists is left to SQLite. CROSS
+            # JOIN keeps it starting from the weights, the planner has no
+            # statistics on a temporary table and would scan every posting.
+            conn.executescript(_WEIGHTS_SCHEMA)
+            conn.executemany('INSERT INTO search_weights VALUES (?, ?)', [
+                (term_id, math.log(1 + (total - term_df + 0.5) / (term_df + 0.5)) * query_terms[term])
+                for term, term_id, term_df in known
+            ])
+            paper_filter = ''
+            parameters = [K1 + 1, K1, 1 - B, B / average_length]
+            if arxiv_id is not None:
+                # A paper's equations have consecutive doc numbers, so only
+                # that stretch of each posting list is read
+                doc_range = conn.execute(
+                    'SELECT first_doc, last_doc FROM search_papers '
+                    'WHERE arxiv_id = ? AND version = ?', _paper_key(arxiv_id)).fetchone()
+                if doc_range is None:
+                    return []
+                paper_filter = 'WHERE p.doc BETWEEN ? AND ? '
+                parameters += doc_range
+            ranked = conn.execute(
+                'SELECT p.doc, SUM(w.weight * p.tf * ? / (p.tf + ? * (? + ? * d.length))) AS score '
+                'FROM search_weights w CROSS JOIN search_postings p ON p.term_id = w.term_id '
+                'CROSS JOIN search_docs d ON d.doc = p.doc ' + paper_filter +
+                'GROUP BY p.doc ORDER BY score DESC LIMIT ?',
+                parameters + [k]
+            ).fetchall()
+
+            # An equation re-parsed away since the last update() is skipped
+            found = {doc: row for doc, *row in _select_in(
+                conn, 'SELECT d.doc, d.arxiv_id, d.version, e.eq_number, e.body '
+                'FROM search_docs d JOIN equations e USING (arxiv_id, version, position) '
+                'WHERE d.doc IN (%s)', [doc for doc, score in ranked])}
+            results = []
+            for doc, score in ranked:
+                if doc not in found:
+                    continue
+                found_id, version, number, body = found[doc]
+                results.append({
+                    'arxiv_id': found_id + version,
+                    'equation': number,
+                    'latex': format_equation(json.loads(body)),
+                    'score': round(score, 4),
+                })
+        return results
+
+
+def search_indexes(indexes, query, k=10, arxiv_id=None):
+    '''
+    Search several equation indexes, such as the local index and the shards
+    of a bulk index, and merge their top k results. Equations are scored
+    against the BM25 statistics of all the indexes together, as if they
+    were one.
+    '''
+    searches = [EquationSearch(index) for index in indexes]
+    query_terms = latex_terms(query)
+    total = total_length = 0
+    df = Counter()
+    for search in searches:
+        index_total, index_length, index_df = search.stats(query_terms)
+        total += index_total
+        total_length += index_length
+        df.update(index_df)
+    results = []
+    for search in searches:
+        results += search.search(query, k, arxiv_id, stats=(total, total_length, df))
+    return heapq.nlargest(k, results, key=lambda result: result['score'])
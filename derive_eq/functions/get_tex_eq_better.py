@@ -1,365 +1,524 @@
-import re
-import numpy as np
-
-def extract_equations_from_tex(file_path):
-    """
-    Extract mathematical expressions from a LaTeX file, handling custom environment definitions
-    and various math environments.
-    """
-    equations = []
-    equation_counter = 1
-    in_subequations = False
-    current_subeq_num = None
-    subeq_letter = 'a'
-    
-    def parse_custom_environments(content):
-        """Parse custom environment definitions including \def, \newcommand, and \renewcommand."""
-        custom_commands = {}
-        
-        # Pattern for \def\cmd{\begin{env}} or \def\cmd{\end{env}}
-        def_pattern = r'\\def\\(\w+)\{\\(begin|end)\{([^}]+)\}\}'
-        
-        # Pattern for \newcommand{\cmd}{\begin{env}} or \newcommand{\cmd}{\end{env}}
-        newcommand_pattern = r'\\(?:newcommand|renewcommand)\{\\(\w+)\}(?:\[\d\])?\{\\(begin|end)\{([^}]+)\}\}'
-        
-        # Pattern for simple \def shortcuts like \def\beq{\begin{equation}}
-        simple_def_pattern = r'\\def\\(\w+)\{\\(begin|end)\{([^}]+)\}\}'
-        
-        # Collect all patterns to search
-        patterns = [
-            (def_pattern, 'def'),
-            (newcommand_pattern, 'newcommand'),
-            (simple_def_pattern, 'simple_def')
-        ]
-        
-        # Process each pattern type
-        for pattern, cmd_type in patterns:
-            for match in re.finditer(pattern, content):
-                command, begin_end, env = match.groups()
-                if command not in custom_commands:
-                    custom_commands[command] = {
-                        'type': cmd_type,
-                        'begin_end': begin_end,
-                        'environment': env
-                    }
-        
-        return custom_commands
-
-    def preprocess_content_with_custom_environments(content, custom_commands):
-        """Replace custom environment commands with their standard equivalents."""
-        # Sort commands by length (longest first) to handle nested definitions
-        sorted_commands = sorted(custom_commands.keys(), key=len, reverse=True)
-        
-        for cmd in sorted_commands:
-            cmd_info = custom_commands[cmd]
-            begin_end = cmd_info['begin_end']
-            env = cmd_info['environment']
-            
-            # Create the pattern to match the custom command
-            pattern = rf'\\{cmd}'
-            replacement = rf'\\{begin_end}{{{env}}}'
-            
-            # Replace all occurrences
-            content = re.sub(pattern, replacement, content)
-        
-        return content
-
-    def create_combined_pattern(custom_envs):
-        """Create regex pattern including both standard and custom environments."""
-        numbered_envs = (
-            r'equation|align|multline|gather|alignat|flalign|empheq|eqnarray'
-            r'|subequations|xalignat|xxalignat|multiline'
-        )
-        starred_envs = (
-            r'equation\*|align\*|multline\*|gather\*|alignat\*|flalign\*|empheq\*|eqnarray\*'
-            r'|xalignat\*|xxalignat\*|multiline\*'
-        )
-        sub_envs = (
-            r'aligned|gathered|split|alignedat|matrix|pmatrix|bmatrix|Bmatrix|vmatrix|Vmatrix'
-            r'|smallmatrix|cases|rcases|dcases|drcases'
-        )
-        
-        # Add custom environments
-        custom_numbered_envs = [
-            env['environment'] 
-            for env in custom_envs.values() 
-            if env['begin_end'] == 'begin' and not env['environment'].endswith('*')
-        ]
-        if custom_numbered_envs:
-            numbered_envs = f"{numbered_envs}|{'|'.join(custom_numbered_envs)}"
-        
-        patterns = [
-            f'\\\\begin{{({numbered_envs})}}\s*(.*?)\s*\\\\end{{\\1}}',
-            f'\\\\begin{{({starred_envs})}}\s*(.*?)\s*\\\\end{{\\1}}',
-            f'\\\\begin{{({sub_envs})}}\s*(.*?)\s*\\\\end{{\\1}}',
-            r'\\\((.*?)\\\)',
-            r'\$([^$]*?)\$',
-            r'\\\[(.*?)\\\]',
-            r'\$\$(.*?)\$\$'
-        ]
-        
-        return '|'.join(patterns)
-    
-    def process_multiline_equation(equation_text, env_type, is_numbered, nested=False):
-        """Process equations with multiple lines and alignment markers."""
-        nonlocal equation_counter, in_subequations, current_subeq_num, subeq_letter
-        
-        # Handle subequations environment
-        if env_type == 'subequations' and not nested:
-            in_subequations = True
-            current_subeq_num = str(equation_counter)
-            equation_counter += 1
-            subeq_letter = 'a'
-            
-            # Process the content inside subequations
-            sub_env_pattern = (
-                r'\\begin{(equation|align|gather|multline|alignat|flalign|empheq|eqnarray)(\*)?}'
-                r'(.*?)'
-                r'\\end{\1(?:\2)?}'
-            )
-            sub_matches = re.finditer(sub_env_pattern, equation_text, re.DOTALL)
-            
-            results = []
-            for sub_match in sub_matches:
-                sub_env, starred, sub_content = sub_match.groups()
-                if not starred:
-                    lines = [line.strip() for line in sub_content.split('\\\\') if line.strip()]
-                    processed_lines = []
-                    
-                    for line in lines:
-                        # Check for \notag or \nonumber
-                        has_notag = any(tag in line for tag in ['\\notag', '\\nonumber'])
-                        clean_line = re.sub(r'\\(?:notag|nonumber)', '', line).strip()
-                        
-                        if not has_notag:
-                            eq_num = f"{current_subeq_num}{subeq_letter}"
-                            subeq_letter = chr(ord(subeq_letter) + 1)
-                            processed_lines.append([eq_num, clean_line])
-                        else:
-                            processed_lines.append([None, clean_line])
-                    
-                    results.extend(processed_lines)
-            
-            in_subequations = False
-            return results
-        
-        # Handle nested environments
-        nested_env_pattern = r'\\begin{(aligned|gathered|split|alignedat|matrix|pmatrix|bmatrix|Bmatrix|vmatrix|Vmatrix|smallmatrix|cases|rcases|dcases|drcases)}\s*(.*?)\s*\\end{\1}'
-        
-        if not nested:
-            matches = list(re.finditer(nested_env_pattern, equation_text, re.DOTALL))
-            if matches:
-                for match in matches:
-                    nested_env = match.group(1)
-                    nested_content = match.group(2)
-                    processed_nested = process_multiline_equation(nested_content, nested_env, False, nested=True)
-                    
-                    if is_numbered:
-                        if in_subequations:
-                            eq_num = f"{current_subeq_num}{subeq_letter}"
-                            subeq_letter = chr(ord(subeq_letter) + 1)
-                        else:
-                            eq_num = str(equation_counter)
-                            equation_counter += 1
-                        return [[eq_num, processed_nested] if isinstance(processed_nested, str) 
-                               else [eq_num] + processed_nested]
-                    else:
-                        return processed_nested
-        
-        # Handle alignment environments
-        lines = [line.strip() for line in equation_text.split('\\\\') if line.strip()]
-        processed_lines = []
-        
-        if env_type in ['align', 'align*', 'alignat', 'alignat*', 'flalign', 'flalign*', 
-                       'aligned', 'gather', 'gather*', 'gathered', 'split', 'eqnarray', 'eqnarray*']:
-            for line in lines:
-                has_notag = any(tag in line for tag in ['\\notag', '\\nonumber'])
-                clean_line = re.sub(r'\\(?:notag|nonumber)', '', line).strip()
-                
-                parts = clean_line.split('&')
-                processed_line = ' & '.join(part.strip() for part in parts)
-                
-                if is_numbered and not nested and not has_notag:
-                    if in_subequations:
-                        eq_num = f"{current_subeq_num}{subeq_letter}"
-                        subeq_letter = chr(ord(subeq_letter) + 1)
-                    else:
-                        eq_num = str(equation_counter)
-                        equation_counter += 1
-                    processed_lines.append([eq_num, processed_line])
-                else:
-                    processed_lines.append([None, processed_line])
-            
-            return processed_lines
-        
-        # Handle other environments
-        else:
-            if len(lines) > 1:
-                processed_lines = [[None, line] for line in lines]
-            else:
-                processed_lines = [[None, ' '.join(lines)]]
-            
-            if is_numbered and not nested:
-                if in_subequations:
-                    eq_num = f"{current_subeq_num}{subeq_letter}"
-                    subeq_letter = chr(ord(subeq_letter) + 1)
-                else:
-                    eq_num = str(equation_counter)
-                    equation_counter += 1
-                processed_lines[0][0] = eq_num
-            
-            return processed_lines
-
-    try:
-        with open(file_path, 'r', encoding='utf8', errors='ignore') as file:
-            content = file.read()
-            
-            # Parse custom environment definitions
-            custom_commands = parse_custom_environments(content)
-            
-            # Preprocess content to replace custom environments
-            content = preprocess_content_with_custom_environments(content, custom_commands)
-            
-            # Extract document body if present
-            document_start = re.search(r'\\begin{document}', content)
-            if document_start:
-                content = content[document_start.end():]
-            
-            # Remove comments and labels
-            content = re.sub(r'(?<!\\)%.*$', '', content, flags=re.MULTILINE)
-            content = re.sub(r'\\label{.*?}', '', content)
-            
-            # Create pattern for environments
-            pattern = (
-                r'\\begin{(subequations)}(.*?)\\end{subequations}|'  # Subequations case
-                r'\\begin{(equation|align|gather|multline|alignat|flalign|empheq|eqnarray)(\*)?}'
-                r'(.*?)'
-                r'\\end{\3(?:\4)?}'
-            )
-            
-            # Find all equations
-            matches = re.finditer(pattern, content, re.DOTALL)
-            
-            for match in matches:
-                groups = match.groups()
-                try:
-                    # Check if this is a subequations environment
-                    if groups[0] == 'subequations':
-                        subeq_content = groups[1]
-                        subeq_results = process_multiline_equation(subeq_content, 'subequations', True)
-                        if subeq_results:
-                            equations.extend(subeq_results)
-                    # Regular equation environment
-                    elif groups[2]:
-                        env_type = groups[2]
-                        is_starred = bool(groups[3])
-                        math_content = groups[4]
-                        if not is_starred:
-                            processed_content = process_multiline_equation(
-                                math_content, env_type, True, nested=False
-                            )
-                            if processed_content:
-                                equations.extend(processed_content)
-                
-                except Exception as e:
-                    print(f"Error processing equation: {e}")
-                    continue
-
-    except Exception as e:
-        print(f"Error reading or processing file: {e}")
-        return []
-
-    return equations
-
-# Test code
-test_content = r"""
-\documentclass{article}
-\def\beq{\begin{equation}}
-\def\eeq{\end{equation}}
-\def\ba{\begin{align}}
-\def\ea{\end{align}}
-
-\begin{document}
-First equation using custom environment:
-\beq
-E = mc^2
-\eeq
-
-Custom align environment with nested matrix and \notag:
-\ba
-x &= \begin{pmatrix} 1 & 2 \\ 3 & 4 \end{pmatrix} \notag \\
-z &= w \\
-\begin{cases}
-a &= b \nonumber \\
-c &= d
-\end{cases}
-\ea
-
-Regular equation with nested aligned:
-\begin{equation}
-\begin{aligned}
-F &= ma \\
-E &= mc^2
-\end{aligned}
-\end{equation}
-
-\begin{subequations}
-\begin{align}
-A &= B \\
-C &= D \notag \\
-E &= F
-\end{align}
-\end{equation}
-\end{subequations}
-
-\end{document}
-"""
-def testcode():
-    import tempfile
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.tex', delete=False) as f:
-        f.write(test_content)
-        test_file = f.name
-    
-    print("\nExtracting equations...")
-    path = "/mnt/c/Users/alexa/Desktop/Mathhack/misc stuff/"
-    equations = extract_equations_from_tex(path+"cuts.tex")
-    # equations = extract_equations_from_tex(test_file)
-    
-    print("\nExtracted equations:")
-    for eq in equations:
-        if isinstance(eq, list):
-            if eq[0] is not None:
-                print(f"\nEquation ({eq[0]}):")
-                print(f"  {eq[1]}")
-            else:
-                print(f"\nUnnumbered line:")
-                print(f"  {eq[1]}")
-                
-def get_tex_eq(file_path, equation_number, sure=True):
-    # Extract equations from the specified LaTeX file
-    equations = extract_equations_from_tex(file_path)
-    
-    for i in range(len(equations)):
-        
-        if equations[i][0] == str(equation_number):
-            tex_eq = equations[i][1:]
-            
-            if sure: print('\n', tex_eq, '\n')
-            if sure == False:
-                if i > 3: 
-                    a = -3
-                else:
-                    a = 1-i
-                while a<4 and i+a < len(equations):
-                    print(equations[i+a])
-                    a+=1
-                
-                equation_confirm = input("Confirm (y) or enter new number: ")
-                
-                if equation_confirm == 'y': 
-                    print('\n', tex_eq, '\n')
-                else:
-                    for j in range(len(equations)):
-                        if equations[j][0] == str(equation_confirm):
-                            tex_eq = equations[j][1:]
-                            print('\n', tex_eq, '\n')
\ No newline at end of file
+import os
+import re
+import time
+from collections import deque
+from itertools import islice
+from derive_eq.functions.tex_project import TexSourceView
+from derive_eq.functions.tex_lexer import (
+    tokenize_tex, MacroTable, ScanTimeout, BEGIN, END, NEWLINE, AMP, NOTAG, TEXT
+)
+
+# Bumped whenever the extracted equations change, so stored indexes built by
+# an older parser are rebuilt
+PARSER_VERSION = 5
+
+# Top level environments that receive equation numbers
+NUMBERED_ENVS = {
+    'equation', 'align', 'gather', 'multline', 'alignat', 'flalign', 'empheq', 'eqnarray'
+}
+
+# Environments nested inside a numbered one that carry the actual lines
+SUB_ENVS = {
+    'aligned', 'gathered', 'split', 'alignedat', 'matrix', 'pmatrix', 'bmatrix', 'Bmatrix',
+    'vmatrix', 'Vmatrix', 'smallmatrix', 'cases', 'rcases', 'dcases', 'drcases'
+}
+
+# Environments where every line is numbered and & marks alignment columns
+ALIGN_ENVS = {
+    'align', 'align*', 'alignat', 'alignat*', 'flalign', 'flalign*', 'aligned', 'gather',
+    'gather*', 'gathered', 'split', 'eqnarray', 'eqnarray*'
+}
+
+# Environments whose commands \let may alias, as in \let\be\equation
+LET_ENVS = NUMBERED_ENVS | SUB_ENVS | {'subequations'}
+
+# Default limits of a ParseBudget, overridden by DERIVE_EQ_PARSE_MAX_MB and
+# DERIVE_EQ_PARSE_TIMEOUT
+MAX_PARSE_MB = 128
+MAX_PARSE_SECONDS = 60.0
+
+# How the text of a line is rebuilt from the source, see _line_text()
+RAW = 'raw'            # As written, \notag included
+CLEAN = 'clean'        # \notag and \nonumber removed
+ALIGNED = 'aligned'    # \notag removed and the & columns normalised
+
+_NONBLANK = re.compile(r'\S')
+_NONBLANK_BYTES = re.compile(rb'\S')
+
+
+def _text(source, start, end):
+    text = source[start:end]
+    return text if isinstance(text, str) else text.decode('utf8', errors='ignore')
+
+
+def _line_text(source, start, end, style, macros):
+    """Text of the line source[start:end], tokenized again and formatted per style."""
+    pieces = []
+    # Indexes into pieces of the alignment columns
+    columns = []
+    for kind, value, token_start, token_end in tokenize_tex(source, macros, start, end, LET_ENVS):
+        if kind == TEXT:
+            pieces.append(_text(source, token_start, token_end))
+        elif kind == AMP:
+            columns.append(len(pieces))
+            pieces.append('&')
+        elif kind == NOTAG:
+            pieces.append('' if style != RAW else _text(source, token_start, token_end))
+        elif kind == NEWLINE:
+            # Rows are split at line breaks, so this is one the parse did not split at
+            pieces.append('\\\\')
+        else:
+            # BEGIN or END, spelt out as they may come from a macro too
+            pieces.append(f'\\{kind}{{{value}}}')
+
+    if style != ALIGNED:
+        return ''.join(pieces).strip()
+    cells = []
+    last = 0
+    for index in columns:
+        cells.append(''.join(pieces[last:index]).strip())
+        last = index + 1
+    cells.append(''.join(pieces[last:]).strip())
+    return ' & '.join(cells)
+
+
+class Equation:
+    """
+    One equation entry found by parse_equations().
+
+    Only offsets into the source are kept: start and end delimit the
+    environment the entry comes from, and lines holds the (start, end) offsets
+    of its lines one after the other. The LaTeX of the lines is rebuilt from
+    the source when it is asked for, with text, lines() or body().
+
+    nested is True for environments wrapping an aligned/cases/matrix block,
+    whose lines are kept apart. macros is the MacroTable of the parse and
+    version the number of its changes made before the first line, so the
+    lines are rebuilt with the macros defined at that point of the source
+    and not those defined further on. Indexing works on the list form used before
+    these records, [eq_num, line] or [eq_num, [None, line], ...], so
+    equation[0] is the number and equation[1:] the body.
+    """
+    __slots__ = ('number', 'env', 'start', 'end', 'lines', 'nested', 'style', 'source', 'macros',
+                 'version')
+
+    def __init__(self, number, env, start, end, lines, nested, style, source, macros, version):
+        self.number = number
+        self.env = env
+        self.start = start
+        self.end = end
+        self.lines = lines
+        self.nested = nested
+        self.style = style
+        self.source = source
+        self.macros = macros
+        self.version = version
+
+    def line_texts(self):
+        """The LaTeX of each line."""
+        lines = self.lines
+        # Definitions within the lines apply to the lines after, as in the parse
+        macros = self.macros.at(self.version)
+        return [_line_text(self.source, lines[i], lines[i + 1], self.style, macros)
+                for i in range(0, len(lines), 2)]
+
+    def body(self):
+        """The entry without its number, as returned by get_tex_eq()."""
+        if self.nested:
+            return [[None, line] for line in self.line_texts()]
+        return self.line_texts()
+
+    @property
+    def text(self):
+        """The whole equation as a single LaTeX string."""
+        return format_equation(self.body())
+
+    def to_list(self):
+        return [self.number] + self.body()
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.number
+        return self.to_list()[index]
+
+    def __len__(self):
+        return 1 + len(self.lines) // 2
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __repr__(self):
+        return f"Equation({self.number!r}, {self.env!r}, {self.start}, {self.end})"
+
+
+class _Row:
+    """
+    Offsets of one \\\\-separated line of an environment, and the version of
+    the MacroTable where it starts.
+    """
+    __slots__ = ('start', 'end', 'notag', 'blank', 'version')
+
+    def __init__(self, start, version):
+        self.start = start
+        self.version = version
+        self.end = start
+        self.notag = False
+        # Whether the line has nothing but whitespace so far
+        self.blank = True
+
+    def add(self, kind, nonblank, content, start, end):
+        if kind == TEXT:
+            if self.blank and nonblank(content, start, end) is not None:
+                self.blank = False
+        else:
+            self.blank = False
+            if kind == NOTAG:
+                self.notag = True
+
+
+class _Capture:
+    """Rows collected between a \\begin{env} and its matching \\end{env}."""
+    __slots__ = ('env', 'starred', 'end_names', 'start', 'rows')
+
+    def __init__(self, env, start, end, version):
+        base = env[:-1] if env.endswith('*') else env
+        self.env = base
+        self.starred = base != env
+        # A starred environment may be closed with or without the star
+        self.end_names = {base, env}
+        self.start = start
+        self.rows = [_Row(end, version)]
+
+    def new_row(self, start, end, version):
+        self.rows[-1].end = start
+        self.rows.append(_Row(end, version))
+
+    def close(self, start):
+        self.rows[-1].end = start
+
+    def lines(self):
+        return [row for row in self.rows if not row.blank]
+
+
+def _offsets(rows):
+    offsets = []
+    for row in rows:
+        offsets += (row.start, row.end)
+    return tuple(offsets)
+
+
+def _is_numbered(env):
+    return env == 'subequations' or env.rstrip('*') in NUMBERED_ENVS
+
+
+class ParseBudget:
+    """
+    Limits on the work parse_equations() spends on one file: the bytes of
+    source it reads (characters for a str) and the seconds it runs for,
+    counted from its start and including the time its caller takes between
+    equations. The clock is looked at every few tokens, and every few
+    braces when scanning a macro body or argument, so the time limit is
+    overrun by milliseconds at most. Past either limit the rest of
+    the file is skipped, the equations found so far are still yielded and
+    exceeded tells which limit was hit. It stays None for a file parsed in
+    full.
+    """
+    __slots__ = ('max_bytes', 'max_seconds', 'exceeded')
+
+    def __init__(self, max_bytes=None, max_seconds=None):
+        if max_bytes is None:
+            max_mb = float(os.environ.get('DERIVE_EQ_PARSE_MAX_MB', MAX_PARSE_MB))
+            max_bytes = int(max_mb * 1024 * 1024)
+        if max_seconds is None:
+            max_seconds = float(os.environ.get('DERIVE_EQ_PARSE_TIMEOUT', MAX_PARSE_SECONDS))
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.exceeded = None
+
+
+def parse_equations(content, budget=None):
+    """
+    Turn LaTeX source into numbered equation entries.
+
+    Yields an Equation for every entry, holding offsets into content rather
+    than copies of its text. The source is tokenized once by tokenize_tex()
+    and every environment is closed by the first matching \\end. Both take
+    time linear in the size of the document whatever it holds, also for
+    truncated or malformed sources, see tokenize_tex() for the bound on
+    macros. Rebuilding the text of every line tokenizes each line once more.
+
+    budget is a ParseBudget, by default one with the default limits, so a
+    file too large or too slow to parse gives the equations found up to
+    that point rather than holding up the caller.
+
+    content may be a str or a bytes-like buffer such as an mmap, which is
+    scanned in place with byte offsets and only decoded line by line when
+    an equation's text is asked for.
+    """
+    if budget is None:
+        budget = ParseBudget()
+    limit = min(len(content), budget.max_bytes)
+    if limit < len(content):
+        budget.exceeded = f"only the first {limit} of {len(content)} bytes parsed"
+    deadline = time.perf_counter() + budget.max_seconds
+    if isinstance(content, str):
+        nonblank = _NONBLANK.search
+        has_document = content.find('\\begin{document}', 0, limit) != -1
+    else:
+        nonblank = _NONBLANK_BYTES.search
+        has_document = content.find(b'\\begin{document}', 0, limit) != -1
+    macros = MacroTable()
+    counter = 1
+    top = None            # Numbered environment or subequations being read
+    nested = None         # First aligned/cases/... block inside top
+    nested_done = False
+    inner = None          # Environment inside a subequations block
+    subeq_num = None
+    subeq_letter = 'a'
+    # Equations found before \\begin{document}, kept until it is clear that
+    # there is a document body. Files without one are all body.
+    pending = [] if has_document else None
+    found = []
+
+    tokens = tokenize_tex(content, macros, 0, limit, LET_ENVS, deadline)
+    try:
+        for kind, value, start, end in tokens:
+            if kind == BEGIN:
+                if value == 'document' and pending is not None:
+                    # Only the document body is searched, anything before is discarded
+                    pending = None
+                    counter = 1
+                    top = nested = inner = None
+                    continue
+                if _is_numbered(value) and (top is None or top.env != 'subequations'
+                                            or value == 'subequations'):
+                    # Numbered environments do not nest, so one that is still open
+                    # was never closed. Drop it and start again from here.
+                    top = _Capture(value, start, end, macros.version)
+                    nested = inner = None
+                    nested_done = False
+                    if value == 'subequations':
+                        subeq_num = str(counter)
+                        counter += 1
+                        subeq_letter = 'a'
+                    continue
+
+            if top is None or top.starred:
+                if top is not None and kind == END and value in top.end_names:
+                    top = None
+                continue
+
+            if top.env == 'subequations':
+                if kind == END and value == 'subequations':
+                    top = inner = None
+                elif kind == BEGIN and _is_numbered(value):
+                    inner = _Capture(value, start, end, macros.version)
+                elif inner is None or inner.starred:
+                    if inner is not None and kind == END and value in inner.end_names:
+                        inner = None
+                elif kind == END and value in inner.end_names:
+                    inner.close(start)
+                    for row in inner.lines():
+                        if row.notag:
+                            number = None
+                        else:
+                            number = f"{subeq_num}{subeq_letter}"
+                            subeq_letter = chr(ord(subeq_letter) + 1)
+                        found.append(Equation(number, inner.env, inner.start, end,
+                                              (row.start, row.end), False, CLEAN, content, macros,
+                                              row.version))
+                    inner = None
+                elif kind == NEWLINE:
+                    inner.new_row(start, end, macros.version)
+                else:
+                    inner.rows[-1].add(kind, nonblank, content, start, end)
+
+            elif kind == END and value in top.end_names:
+                top.close(start)
+                try:
+                    entries = _number_capture(top, nested if nested_done else None, counter,
+                                              end, content, macros)
+                except Exception as e:
+                    print(f"Error processing equation: {e}")
+                    entries = []
+                for entry in entries:
+                    if entry.number is not None:
+                        counter += 1
+                    found.append(entry)
+                top = nested = None
+
+            else:
+                if kind == NEWLINE:
+                    top.new_row(start, end, macros.version)
+                else:
+                    top.rows[-1].add(kind, nonblank, content, start, end)
+
+                if nested_done:
+                    pass
+                elif nested is None:
+                    if kind == BEGIN and value in SUB_ENVS:
+                        nested = _Capture(value, start, end, macros.version)
+                elif kind == END and value in nested.end_names:
+                    nested.close(start)
+                    nested_done = True
+                elif kind == NEWLINE:
+                    nested.new_row(start, end, macros.version)
+                else:
+                    nested.rows[-1].add(kind, nonblank, content, start, end)
+
+            if found:
+                if pending is not None:
+                    pending.extend(found)
+                else:
+                    yield from found
+                found = []
+    except ScanTimeout as e:
+        budget.exceeded = f"stopped after {budget.max_seconds:g} s at offset {e.offset}"
+
+    # Without a \\begin{document} the whole file is the body
+    if pending:
+        yield from pending
+
+
+def _number_capture(top, nested, counter, end, content, macros):
+    """Apply the numbering rules to a closed numbered environment."""
+    def equation(number, lines, is_nested, style, version):
+        return Equation(number, top.env, top.start, end, lines, is_nested, style, content,
+                        macros, version)
+
+    if nested is not None:
+        # The nested block replaces the environment and takes a single number
+        rows = nested.lines()
+        version = (rows or nested.rows)[0].version
+        if nested.env in ALIGN_ENVS:
+            return [equation(str(counter), _offsets(rows), True, ALIGNED, version)]
+        # An empty block still gives one empty line
+        lines = _offsets(rows) or (nested.start, nested.start)
+        return [equation(str(counter), lines, True, RAW, version)]
+
+    if top.env in ALIGN_ENVS:
+        entries = []
+        for row in top.lines():
+            if row.notag:
+                entries.append(equation(None, (row.start, row.end), False, ALIGNED, row.version))
+            else:
+                entries.append(equation(str(counter), (row.start, row.end), False, ALIGNED,
+                                        row.version))
+                counter += 1
+        return entries
+
+    rows = top.lines()
+    if not rows:
+        return [equation(str(counter), (top.start, top.start), False, RAW, top.rows[0].version)]
+    entries = [equation(None, (row.start, row.end), False, RAW, row.version) for row in rows]
+    entries[0].number = str(counter)
+    return entries
+
+
+def _open_tex_file(file_path):
+    """TexSourceView of a LaTeX file, or None with the error printed if it cannot be read."""
+    try:
+        return TexSourceView.from_file(file_path)
+    except Exception as e:
+        print(f"Error reading or processing file: {e}")
+        return None
+
+
+def iter_equations_from_tex(file_path):
+    """
+    Yield the Equation records of a LaTeX file one at a time as they are
+    found. Files it pulls in with \\input, \\include or \\subfile are read
+    in place, and stopping early skips parsing the rest of the document.
+    The files are closed once the iterator is exhausted or closed, after
+    which the records can no longer rebuild their lines.
+    """
+    view = _open_tex_file(file_path)
+    if view is None:
+        return
+    with view:
+        yield from parse_equations(view.source)
+
+
+def extract_equations_from_tex(file_path):
+    """
+    Extract mathematical expressions from a LaTeX file, handling custom environment definitions
+    and various math environments. The file is scanned once, see parse_equations().
+    Returns a list of Equation records.
+    """
+    view = _open_tex_file(file_path)
+    if view is None:
+        return []
+    # The records rebuild their lines from the source, which stays mapped
+    # for as long as they are kept rather than being copied
+    return list(parse_equations(view.source))
+
+
+def format_equation(tex_eq):
+    """Join the parts of an equation entry back into a single LaTeX string."""
+    lines = [part if isinstance(part, str) else part[1] for part in tex_eq]
+    return ' \\\\ '.join(line for line in lines if line)
+
+
+def find_equation(equations, equation_number, window=0):
+    """
+    Consume an equation iterator up to the given equation number.
+    
+    Returns (before, entry, after), where before and after hold up to window
+    neighbouring equations, or None if the number is not found. The iterator
+    is not read past the last equation needed. A list is searched from its
+    start on every call.
+    """
+    # The equations after the entry are taken from where the loop stopped
+    equations = iter(equations)
+    before = deque(maxlen=window)
+    for entry in equations:
+        if entry.number == str(equation_number):
+            return list(before), entry, list(islice(equations, window))
+        if window:
+            before.append(entry)
+    return None
+
+
+def get_tex_eq(file_path, equation_number, sure=True):
+    view = _open_tex_file(file_path)
+    if view is None:
+        return None
+    # The records read their lines from the files until the end
+    with view:
+        return _get_tex_eq(view, equation_number, sure)
+
+
+def _get_tex_eq(view, equation_number, sure):
+    # Only parse the paper up to the requested equation, plus the few after it
+    # that are shown when asking for confirmation
+    equations = parse_equations(view.source)
+    found = find_equation(equations, equation_number, window=0 if sure else 3)
+    if found is None:
+        return None
+    before, entry, after = found
+    tex_eq = entry.body()
+    
+    if sure: print('\n', tex_eq, '\n')
+    if sure == False:
+        for neighbour in before + [entry] + after:
+            print(neighbour.to_list())
+        
+        equation_confirm = input("Confirm (y) or enter new number: ")
+        
+        if equation_confirm == 'y': 
+            print('\n', tex_eq, '\n')
+        else:
+            # Look in what was already read, then further on in the paper,
+            # and only start over if the equation came before the window
+            entry = next((e for e in before + after if e.number == str(equation_confirm)), None)
+            if entry is None:
+                found = find_equation(equations, equation_confirm)
+                if found is None:
+                    found = find_equation(parse_equations(view.source), equation_confirm)
+                if found is None:
+                    return None
+                entry = found[1]
+            tex_eq = entry.body()
+            print('\n', tex_eq, '\n')
+    
+    return tex_eq
@@ -1,38 +1,87 @@
-import urllib.request
-import feedparser
-import tarfile
 import os
-from urllib.parse import urlencode
+import tempfile
+from derive_eq.functions.download_manager import DownloadManager
+from derive_eq.functions.source_cache import SourceCache, eprint_url, get_cache_dir
+from derive_eq.functions.source_cache import parse_arxiv_id
+from derive_eq.functions.tracing import span
 
-def download_paper_by_id(arxiv_id, download_dir="downloads"):
+__all__ = [
+    'fetch_source_archive', 'download_source', 'load_paper_sources', 'download_paper_by_id',
+    'get_tex_file', 'get_tex_file_path',
+]
+
+def default_download_dir():
+    '''Where partial downloads are kept until they complete.'''
+    return os.path.join(get_cache_dir(), 'downloads')
+
+def download_source(arxiv_id, target_file, validators=None, part_file=None, manager=None):
     """
-    Download source files for a paper using its arXiv ID.
+    Download the e-print archive of a paper to target_file with a
+    DownloadManager, resuming from part_file if an earlier attempt left one.
     
     Parameters:
-    arxiv_id (str): arXiv ID (e.g., "2311.17667" or "1706.03762")
-    download_dir (str): Directory to save downloaded files
+    arxiv_id (str): arXiv ID (e.g., "2311.17667" or "1706.03762v2"), the
+        latest version is fetched if it has none
+    target_file (str): Path to write the archive to
+    validators (dict): Validators of a copy fetched before, to only download
+        the archive if it changed
+    part_file (str): Path of the partial download, target_file + ".part" by default
+    manager (DownloadManager): Manager to download with, a default one if None
     
     Returns:
-    str: Path to downloaded files or None if download fails
+    Download: What was fetched, with not_modified set if the copy is still
+    current, or None if the paper could not be found
     """
-    # Create download directory if it doesn't exist
-    os.makedirs(download_dir, exist_ok=True)
+    if manager is None:
+        manager = DownloadManager()
     
-    # Clean the arXiv ID (remove version if present)
-    clean_id = arxiv_id.split('v')[0]
+    # Construct the URL for the source files, of the version asked for
+    source_url = eprint_url(arxiv_id)
     
-    # Fetch the paper metadata first to verify it exists
-    base_url = 'http://export.arxiv.org/api/query?'
-    search_query = urlencode({
-        'id_list': clean_id,
-    })
+    # Download the source files (usually comes as a tar.gz)
+    with span('download', arxiv_id=arxiv_id) as s:
+        download = manager.fetch(source_url, target_file, validators, part_file)
+        if download is None:
+            s.set(not_found=True)
+            print(f"No paper found with ID {arxiv_id}")
+            return None
+        s.set(bytes=download.bytes, status=download.status, resumed_from=download.resumed_from)
+    return download
+
+def fetch_source_archive(arxiv_id, target_file, check_metadata=False):
+    """
+    Download the e-print archive of a paper to target_file.
     
-    response = urllib.request.urlopen(base_url + search_query)
-    feed = feedparser.parse(response.read())
+    Parameters:
+    arxiv_id (str): arXiv ID (e.g., "2311.17667" or "1706.03762")
+    target_file (str): Path to write the archive to
+    check_metadata (bool): Query the arXiv API for the paper first. By default
+        a 404 from the e-print URL is taken to mean the paper does not exist.
     
-    if len(feed.entries) == 0:
-        print(f"No paper found with ID {arxiv_id}")
-        return None
+    Returns:
+    str: target_file or None if the paper could not be found
+    """
+    if check_metadata:
+        # urllib.request pulls in http.client and email, only load it to download
+        import urllib.request
+        from urllib.parse import urlencode
+        import feedparser
+        
+        # Fetch the paper metadata first to verify it exists
+        base_url = 'http://export.arxiv.org/api/query?'
+        clean_id, version = parse_arxiv_id(arxiv_id)
+        search_query = urlencode({
+            'id_list': clean_id + (version or ''),
+        })
+        
+        with span('arxiv_api', arxiv_id=arxiv_id) as s:
+            response = urllib.request.urlopen(base_url + search_query)
+            feed = feedparser.parse(response.read())
+            s.set(found=len(feed.entries) > 0)
+        
+        if len(feed.entries) == 0:
+            print(f"No paper found with ID {arxiv_id}")
+            return None
     
     # Get the paper's details
     # paper = feed.entries[0]
@@ -41,55 +90,165 @@ def download_paper_by_id(arxiv_id, download_dir="downloads"):
     # print(f"Found paper: {title}")
     # print(f"arXiv ID: {clean_id}")
     
-    # Construct the URL for the source files
-    source_url = f'https://arxiv.org/e-print/{clean_id}'
+    if download_source(arxiv_id, target_file) is None:
+        return None
+    return target_file
+
+
+def load_paper_sources(arxiv_id, cache=None, download_dir=None, revalidate=None):
+    """
+    Fetch a paper's e-print and return its text members, read straight out
+    of the archive without extracting anything to disk.
     
-    # Download the source files (usually comes as a tar.gz)
-    target_file = os.path.join(download_dir, f'{clean_id}.tar.gz')
-    # print(f"Downloading source files to {target_file}...")
+    Parameters:
+    arxiv_id (str): arXiv ID (e.g., "2311.17667" or "1706.03762")
+    cache (SourceCache): Optional e-print cache consulted before the network
+    download_dir (str): Directory for the download, if not cached. An
+        interrupted download is resumed from there on the next call.
+    revalidate (bool): Check with the server that a cached e-print is still
+        current, downloading it again only if it changed. By default only
+        an e-print the cache finds stale is checked, see
+        SourceCache.is_stale(). A versioned e-print never changes and is
+        not revalidated.
     
+    Returns:
+    dict: {name: bytes} of the .tex and other text files, or None if the
+    download fails
+    """
+    # tarfile and gzip are only loaded once there is an archive to read
+    from derive_eq.functions.source_archive import read_source_members
+
+    def read_members(path):
+        with span('extract', arxiv_id=arxiv_id, bytes=os.path.getsize(path)) as s:
+            with open(path, 'rb') as file:
+                members = read_source_members(file)
+            s.set(files=len(members), text_bytes=sum(map(len, members.values())))
+        return members
+
+    clean_id, version = parse_arxiv_id(arxiv_id)
+    if version is not None:
+        # arXiv never replaces a version once it is announced
+        revalidate = False
+    elif revalidate is None:
+        # The latest version of the paper may have changed since
+        revalidate = cache is not None and cache.is_stale(arxiv_id)
+
     try:
-        urllib.request.urlretrieve(source_url, target_file)
+        archive = None
+        if cache is not None:
+            with span('source_cache', arxiv_id=arxiv_id) as s:
+                archive = cache.get(arxiv_id)
+                s.set(hit=archive is not None)
         
-        # Extract the tar.gz file
-        extract_dir = os.path.join(download_dir, clean_id)
-        os.makedirs(extract_dir, exist_ok=True)
+        if archive is None or revalidate:
+            if download_dir is None:
+                download_dir = default_download_dir()
+            os.makedirs(download_dir, exist_ok=True)
+            # The partial download has a fixed name so a later call resumes it
+            part_file = os.path.join(download_dir,
+                                     clean_id.replace('/', '_') + (version or '') + '.part')
+            validators = cache.validators(arxiv_id) if archive is not None else None
+            # With a copy to fall back on, a server that cannot be reached
+            # is not waited for
+            manager = DownloadManager(retries=0) if archive is not None else None
+            fd, target_file = tempfile.mkstemp(suffix='.tar.gz', dir=download_dir)
+            os.close(fd)
+            try:
+                download = download_source(arxiv_id, target_file, validators, part_file,
+                                           manager)
+                if download is None:
+                    if archive is None:
+                        return None
+                    print(f"Could not revalidate {arxiv_id}, using the cached copy")
+                elif cache is None:
+                    return read_members(target_file)
+                elif download.not_modified:
+                    cache.mark_checked(arxiv_id)
+                else:
+                    # Keep the archive for later calls, with what revalidates it
+                    archive = cache.put(arxiv_id, target_file, download.validators)
+            except Exception as e:
+                if archive is None:
+                    raise
+                print(f"Could not revalidate {arxiv_id}, using the cached copy: {str(e)}")
+            finally:
+                os.remove(target_file)
         
-        with tarfile.open(target_file, 'r:gz') as tar:
-            tar.extractall(path=extract_dir)
-        
-        # Clean up the tar.gz file
-        os.remove(target_file)
-        
-        # print(f"Successfully downloaded and extracted files to {extract_dir}")
-        return extract_dir
+        return read_members(archive)
         
     except Exception as e:
         print(f"Error downloading or extracting files: {str(e)}")
         return None
 
 
+def download_paper_by_id(arxiv_id, download_dir="downloads", cache=None, revalidate=None):
+    """
+    Download source files for a paper using its arXiv ID.
+    
+    Parameters:
+    arxiv_id (str): arXiv ID (e.g., "2311.17667" or "1706.03762")
+    download_dir (str): Directory to save downloaded files
+    cache (SourceCache): Optional e-print cache consulted before the network
+    revalidate (bool): Check with the server that a cached e-print is still current,
+        by default only once it is stale, see load_paper_sources()
+    
+    Returns:
+    str: Path to downloaded files or None if download fails
+    """
+    # Create download directory if it doesn't exist
+    os.makedirs(download_dir, exist_ok=True)
+    
+    members = load_paper_sources(arxiv_id, cache=cache, download_dir=download_dir,
+                                 revalidate=revalidate)
+    if members is None:
+        return None
+    
+    # Only the text sources are written out, figures are never extracted
+    from derive_eq.functions.source_archive import write_source_members
+    # Each version gets its own directory
+    clean_id, version = parse_arxiv_id(arxiv_id)
+    extract_dir = os.path.join(download_dir, clean_id + (version or ''))
+    os.makedirs(extract_dir, exist_ok=True)
+    write_source_members(members, extract_dir)
+    
+    # print(f"Successfully downloaded and extracted files to {extract_dir}")
+    return extract_dir
+
+
 def get_tex_file(folder_dir):
     '''
-    Function that finds a tex file in a given directory and deletes all 
-    other non-tex files.
+    Function that finds the main tex file in a given directory, the root
+    document picked by find_main_file() among all the .tex files below it.
+    Nothing in the directory is changed.
     '''
-    tex_files = []
-    for root, dirs, files in os.walk(folder_dir):
-        for file in files:
-            if file.endswith('.tex'):
-                tex_files.append(os.path.join(root, file))
-            else:
-                os.remove(os.path.join(root, file))
-    if len(tex_files) > 0:
-        return tex_files[0]
-    
-def get_tex_file_path(arxiv_id, download_dir="downloads"):
+    # Only needed once a directory is searched
+    from derive_eq.functions.tex_project import find_main_file
+
+    members = {}
+    with span('get_tex_file') as s:
+        for root, dirs, files in os.walk(folder_dir):
+            for file in files:
+                if file.lower().endswith('.tex'):
+                    path = os.path.join(root, file)
+                    name = os.path.relpath(path, folder_dir).replace(os.sep, '/')
+                    with open(path, 'rb') as tex_file:
+                        members[name] = tex_file.read()
+        s.set(files=len(members))
+    main = find_main_file(members)
+    if main is not None:
+        return os.path.join(folder_dir, *main.split('/'))
+
+def get_tex_file_path(arxiv_id, download_dir="downloads", use_cache=True, revalidate=None):
     '''
     Function that downloads a paper by its arXiv ID and returns the path to the
-    main tex file.
+    main tex file. The e-print is taken from the local source cache when it has
+    been fetched before, and checked to still be current as load_paper_sources()
+    does.
     '''
-    tex_folder = download_paper_by_id(arxiv_id, download_dir)
+    cache = SourceCache() if use_cache else None
+    tex_folder = download_paper_by_id(arxiv_id, download_dir, cache=cache, revalidate=revalidate)
+    if tex_folder is None:
+        return None
     tex_file_path = get_tex_file(tex_folder)
     return tex_file_path
 
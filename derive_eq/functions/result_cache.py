@@ -0,0 +1,172 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from derive_eq.functions.canonical import canonical_form
+from derive_eq.functions.source_cache import get_cache_dir
+
+# Defaults, overridable with DERIVE_EQ_RESULT_TTL (seconds) and
+# DERIVE_EQ_RESULT_CACHE_MAX_MB
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 ** 2
+DEFAULT_MAX_MEMORY_ITEMS = 256
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_access ON results (accessed);
+'''
+
+
+def result_key(model, system_prompt, tex_eq):
+    '''
+    Cache key for a derivation: a hash of the model, system prompt and the
+    canonical form of the equation, so equations that are only typeset
+    differently share one derivation.
+    '''
+    digest = hashlib.sha256()
+    for part in (model, system_prompt, canonical_form(tex_eq)):
+        digest.update(part.encode('utf8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResultCache:
+    '''
+    Two-tier store for finished derivations.
+
+    Lookups go to an in-process LRU of max_memory_items entries first and to
+    a SQLite file second, promoting disk hits into memory. Entries older than
+    ttl seconds count as misses, and the disk tier drops its least recently
+    used entries once it holds more than max_disk_bytes. hits and misses
+    count lookups since the cache was created.
+    '''
+
+    def __init__(self, path=None, max_memory_items=DEFAULT_MAX_MEMORY_ITEMS,
+                 max_disk_bytes=None, ttl=None):
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'results.sqlite')
+        if max_disk_bytes is None:
+            max_mb = os.environ.get('DERIVE_EQ_RESULT_CACHE_MAX_MB')
+            max_disk_bytes = int(max_mb) * 1024 ** 2 if max_mb else DEFAULT_MAX_DISK_BYTES
+        if ttl is None:
+            ttl = float(os.environ.get('DERIVE_EQ_RESULT_TTL', DEFAULT_TTL))
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _expired(self, created):
+        return self.ttl and time.time() - created > self.ttl
+
+    def get(self, key):
+        '''Return the cached derivation for key, or None.'''
+        with self.lock:
+            if key in self.memory:
+                value, created = self.memory[key]
+                if not self._expired(created):
+                    self.memory.move_to_end(key)
+                    self.hits['memory'] += 1
+                    return value
+                del self.memory[key]
+
+        with self._connect() as conn:
+            row = conn.execute('SELECT value, created FROM results WHERE key = ?',
+                               (key,)).fetchone()
+            if row is not None and self._expired(row[1]):
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                row = None
+            if row is not None:
+                conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits['disk'] += 1
+            self._remember(key, row[0], row[1])
+        return row[0]
+
+    def put(self, key, value):
+        '''Store a derivation in both tiers.'''
+        now = time.time()
+        with self.lock:
+            self._remember(key, value, now)
+        size = len(value.encode('utf8'))
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                         (key, value, size, now, now))
+            self._evict(conn)
+
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict(self, conn):
+        if self.ttl:
+            conn.execute('DELETE FROM results WHERE created < ?', (time.time() - self.ttl,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        for key, size in conn.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+            if total <= self.max_disk_bytes:
+                break
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+
+    def stats(self):
+        '''Hit and miss counters as a dict.'''
+        with self.lock:
+            return {
+                'memory_hits': self.hits['memory'],
+                'disk_hits': self.hits['disk'],
+                'misses': self.misses,
+                'memory_items': len(self.memory),
+            }
+
+    def clear(self):
+        '''Drop every cached derivation.'''
+        with self.lock:
+            self.memory.clear()
+        with self._connect() as conn:
+            conn.execute('DELETE FROM results')
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    '''Return the process-wide ResultCache, creating it on first use.'''
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+        return _default_cache
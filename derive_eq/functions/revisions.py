@@ -0,0 +1,148 @@
+from derive_eq.functions.canonical import fingerprint
+from derive_eq.functions.get_tex_eq_better import format_equation
+from derive_eq.functions.source_cache import parse_arxiv_id
+
+# What became of each numbered equation from one revision to the next
+UNCHANGED = 'unchanged'
+RENUMBERED = 'renumbered'
+CHANGED = 'changed'
+ADDED = 'added'
+REMOVED = 'removed'
+
+
+class RevisionDiff:
+    '''
+    How the numbered equations of one indexed revision of a paper map onto
+    those of another. entries holds (status, old_number, new_number,
+    old_latex, new_latex) tuples in the order of the new revision, followed
+    by the equations it removed, with None for the side an equation is
+    missing from.
+    '''
+    __slots__ = ('old_id', 'new_id', 'entries')
+
+    def __init__(self, old_id, new_id, entries):
+        self.old_id = old_id
+        self.new_id = new_id
+        self.entries = entries
+
+    def count(self, status):
+        return sum(entry[0] == status for entry in self.entries)
+
+    def to_derive(self):
+        '''Numbers of the new revision's equations whose derivations cannot be reused.'''
+        return [entry[2] for entry in self.entries if entry[0] in (CHANGED, ADDED)]
+
+
+def numbered_equations(index, arxiv_id):
+    '''[(number, latex, fingerprint)] of a paper's numbered equations, or None if not indexed.'''
+    equations = index.equations(arxiv_id)
+    if equations is None:
+        return None
+    fingerprints = index.fingerprints(arxiv_id)
+    numbered = []
+    seen = set()
+    for equation in equations:
+        number = equation[0]
+        if number is None or number in seen:
+            continue
+        seen.add(number)
+        latex = format_equation(equation[1:])
+        numbered.append((number, latex, fingerprints.get(number) or fingerprint(latex)))
+    return numbered
+
+
+def previous_revision(index, arxiv_id):
+    '''The latest version of a paper indexed before the version in arxiv_id, or None.'''
+    clean_id, version = parse_arxiv_id(arxiv_id)
+    if version is None:
+        return None
+    earlier = [revision for revision in index.revisions(arxiv_id)
+               if int(parse_arxiv_id(revision)[1][1:]) < int(version[1:])]
+    return earlier[-1] if earlier else None
+
+
+def diff_revisions(index, old_id, new_id):
+    '''
+    Match the numbered equations of two indexed revisions by fingerprint,
+    so an equation that was kept is found however it was renumbered or
+    retypeset. The other new equations are paired in order with the old
+    ones left between the same kept equations, as changed versions of
+    them, and the rest are added. Returns a RevisionDiff, or None if
+    either revision is not indexed.
+    '''
+    old = numbered_equations(index, old_id)
+    new = numbered_equations(index, new_id)
+    if old is None or new is None:
+        return None
+
+    # Positions of the old equations by fingerprint, in document order
+    by_fingerprint = {}
+    for position, equation in enumerate(old):
+        by_fingerprint.setdefault(equation[2], []).append(position)
+    # The old position each new equation was matched with, or None
+    matches = []
+    matched = set()
+    for number, latex, key in new:
+        candidates = [position for position in by_fingerprint.get(key, ())
+                      if position not in matched]
+        # A repeated equation is matched with the copy under the same number if any
+        position = next((position for position in candidates if old[position][0] == number),
+                        candidates[0] if candidates else None)
+        if position is not None:
+            matched.add(position)
+        matches.append(position)
+
+    entries = []
+    for i, (number, latex, key) in enumerate(new):
+        position = matches[i]
+        if position is not None:
+            status = UNCHANGED if old[position][0] == number else RENUMBERED
+            entries.append((status, old[position][0], number, old[position][1], latex))
+            continue
+        if i == 0 or matches[i - 1] is not None:
+            # A run of unmatched equations starts, find the old ones in the same gap
+            after = next((matches[j] for j in range(i - 1, -1, -1) if matches[j] is not None),
+                         -1)
+            before = next((matches[j] for j in range(i + 1, len(new)) if matches[j] is not None),
+                          len(old))
+            gap = [position for position in range(after + 1, before) if position not in matched]
+        if gap:
+            position = gap.pop(0)
+            matched.add(position)
+            entries.append((CHANGED, old[position][0], number, old[position][1], latex))
+        else:
+            entries.append((ADDED, None, number, None, latex))
+    entries += [(REMOVED, equation[0], None, equation[1], None)
+                for position, equation in enumerate(old) if position not in matched]
+    return RevisionDiff(old_id, new_id, entries)
+
+
+def carry_over(diff):
+    '''
+    Store the derivation of every equation diff found kept, from the result
+    cache, under the new revision's text of it as well, which is only needed
+    when that text differs. Returns how many kept equations have a
+    derivation in the cache, or None if no backend is configured to key
+    them by.
+    '''
+    # The result cache is only loaded once there is a diff. The backend is
+    # not created, indexing does not depend on being able to derive.
+    from derive_eq.functions.backends import SYSTEM_PROMPT, model_name
+    from derive_eq.functions.result_cache import get_result_cache, result_key
+    model = model_name()
+    if model is None:
+        return None
+    cache = get_result_cache()
+    reused = 0
+    for status, old_number, new_number, old_latex, new_latex in diff.entries:
+        if status not in (UNCHANGED, RENUMBERED):
+            continue
+        new_key = result_key(model, SYSTEM_PROMPT, new_latex)
+        if cache.get(new_key) is not None:
+            reused += 1
+            continue
+        derivation = cache.get(result_key(model, SYSTEM_PROMPT, old_latex))
+        if derivation is not None:
+            cache.put(new_key, derivation)
+            reused += 1
+    return reused
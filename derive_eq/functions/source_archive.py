@@ -0,0 +1,108 @@
+import gzip
+import os
+import posixpath
+import tarfile
+
+# Members worth keeping from an e-print, everything else (figures, PDFs, data)
+# is skipped without being written anywhere
+TEXT_EXTENSIONS = (
+    '.tex', '.ltx', '.sty', '.cls', '.bbl', '.bib', '.bst', '.def', '.cfg', '.clo', '.txt'
+)
+
+# Upper bound on the text kept from one e-print (64 MB)
+DEFAULT_MAX_BYTES = 64 * 1024 ** 2
+
+# Name given to the source of single-file submissions, which are not tars
+SINGLE_FILE_NAME = 'main.tex'
+
+
+class _PrefixedReader:
+    '''File-like object that returns some already read bytes before the rest of a stream.'''
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+def _is_tar_header(block):
+    if len(block) < tarfile.BLOCKSIZE:
+        return False
+    try:
+        tarfile.TarInfo.frombuf(block[:tarfile.BLOCKSIZE], 'utf-8', 'surrogateescape')
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
+def _safe_name(name):
+    name = posixpath.normpath(name.replace('\\', '/'))
+    if name.startswith('/') or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+
+def read_source_members(fileobj, max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    Read an arXiv e-print in a single pass and return {name: bytes} for its
+    text members.
+
+    Handles gzipped or plain tar archives and gzipped single-file sources.
+    Tar members are read as a stream, so images and other binary members are
+    skipped without being written to disk or held in memory. At most max_bytes
+    of text are kept, larger members are left out.
+    '''
+    stream = fileobj
+    head = stream.read(2)
+    if head == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=_PrefixedReader(head, fileobj))
+        head = b''
+    head += stream.read(tarfile.BLOCKSIZE - len(head))
+
+    if not _is_tar_header(head):
+        # A single file, either a bare tex source or a PDF-only submission
+        if head.startswith(b'%PDF'):
+            return {}
+        data = head + stream.read(max_bytes + 1 - len(head))
+        if len(data) > max_bytes:
+            print(f"Skipping source larger than {max_bytes} bytes")
+            return {}
+        return {SINGLE_FILE_NAME: data}
+
+    members = {}
+    kept = 0
+    with tarfile.open(fileobj=_PrefixedReader(head, stream), mode='r|') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.lower().endswith(TEXT_EXTENSIONS):
+                continue
+            name = _safe_name(member.name)
+            if name is None:
+                continue
+            if kept + member.size > max_bytes:
+                print(f"Skipping {member.name}: source size limit reached")
+                continue
+            members[name] = tar.extractfile(member).read()
+            kept += member.size
+    return members
+
+
+def write_source_members(members, extract_dir):
+    '''Write the members returned by read_source_members() below extract_dir.'''
+    paths = []
+    for name, data in members.items():
+        path = os.path.join(extract_dir, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(data)
+        paths.append(path)
+    return paths
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+# Where e-prints are fetched from, overridable with DERIVE_EQ_ARXIV_URL so a
+# local server can stand in
+DEFAULT_BASE_URL = 'https://arxiv.org'
+
+# Default upper bound on the total size of cached e-prints (2 GB)
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+
+# Seconds after which the cached e-print of an unversioned ID is checked with
+# the server again, overridable with DERIVE_EQ_REVALIDATE_AFTER
+DEFAULT_REVALIDATE_AFTER = 24 * 3600
+
+
+def get_cache_dir():
+    '''
+    Return the root directory for derive_eq's on-disk caches. Can be moved
+    with the DERIVE_EQ_CACHE_DIR environment variable.
+    '''
+    default_dir = os.path.join(os.path.expanduser('~'), '.cache', 'derive_eq')
+    return os.environ.get('DERIVE_EQ_CACHE_DIR', default_dir)
+
+
+def parse_arxiv_id(arxiv_id):
+    '''
+    Split an arXiv ID into its base ID and version, e.g. "2311.17667v2" gives
+    ("2311.17667", "v2"). The version is None when the ID is unversioned.
+    '''
+    match = re.match(r'^(.+?)(v\d+)?$', arxiv_id.strip())
+    return match.group(1), match.group(2)
+
+
+def eprint_url(arxiv_id, base_url=None):
+    '''
+    URL of a paper's e-print, pinned to the version in arxiv_id if it has
+    one and the latest version otherwise. base_url defaults to
+    DERIVE_EQ_ARXIV_URL, or arXiv itself.
+    '''
+    if base_url is None:
+        base_url = os.environ.get('DERIVE_EQ_ARXIV_URL', DEFAULT_BASE_URL)
+    clean_id, version = parse_arxiv_id(arxiv_id)
+    return f"{base_url.rstrip('/')}/e-print/{clean_id}{version or ''}"
+
+
+class SourceCache:
+    '''
+    Content-addressed store for downloaded arXiv e-prints.
+
+    Archives are stored once under blobs/ by their sha256, and keys/ maps an
+    arXiv ID and version onto a blob. Every write goes through a temporary
+    file and os.replace, so readers never see a half-written archive. Blob
+    mtimes record the last access and the least recently used blobs are
+    evicted once the cache grows past max_bytes.
+    '''
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(get_cache_dir(), 'sources')
+        if max_bytes is None:
+            max_mb = os.environ.get('DERIVE_EQ_CACHE_MAX_MB')
+            max_bytes = int(max_mb) * 1024 ** 2 if max_mb else DEFAULT_CACHE_SIZE
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        self.key_dir = os.path.join(cache_dir, 'keys')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.key_dir, exist_ok=True)
+
+    def _key_path(self, arxiv_id):
+        clean_id, version = parse_arxiv_id(arxiv_id)
+        # Old-style IDs such as hep-th/9901001 contain a slash
+        key = clean_id.replace('/', '_') + (version or '')
+        return os.path.join(self.key_dir, key)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def get(self, arxiv_id):
+        '''
+        Return the path of the cached archive for arxiv_id, or None on a miss.
+        '''
+        try:
+            with open(self._key_path(arxiv_id), 'r') as key_file:
+                digest = key_file.read().strip()
+        except OSError:
+            return None
+
+        blob_path = self._blob_path(digest)
+        try:
+            # Touch the blob so eviction sees it as recently used
+            os.utime(blob_path)
+        except OSError:
+            return None
+        return blob_path
+
+    def validators(self, arxiv_id):
+        '''
+        Return the ETag and Last-Modified the cached archive of arxiv_id was
+        served with, to revalidate it with, or None if they were not kept.
+        '''
+        try:
+            with open(self._key_path(arxiv_id) + '.validators', 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _checked_path(self, arxiv_id):
+        # The validators are rewritten or touched whenever the copy is found
+        # current, and the key whenever a new copy is stored
+        validators_path = self._key_path(arxiv_id) + '.validators'
+        return validators_path if os.path.exists(validators_path) else self._key_path(arxiv_id)
+
+    def is_stale(self, arxiv_id, max_age=None):
+        '''
+        True if arxiv_id has no version and its e-print was stored or last
+        found current more than max_age seconds ago, by default
+        DERIVE_EQ_REVALIDATE_AFTER, or never. A given version of a paper
+        never changes, so its e-print never goes stale.
+        '''
+        if parse_arxiv_id(arxiv_id)[1] is not None:
+            return False
+        if max_age is None:
+            max_age = float(os.environ.get('DERIVE_EQ_REVALIDATE_AFTER',
+                                           DEFAULT_REVALIDATE_AFTER))
+        try:
+            checked_at = os.stat(self._checked_path(arxiv_id)).st_mtime
+        except OSError:
+            return True
+        return time.time() - checked_at > max_age
+
+    def mark_checked(self, arxiv_id):
+        '''Record that the server found the cached e-print of arxiv_id still current.'''
+        try:
+            os.utime(self._checked_path(arxiv_id))
+        except OSError:
+            pass
+
+    def put(self, arxiv_id, source_path, validators=None):
+        '''
+        Copy the archive at source_path into the cache under arxiv_id and
+        return the path of the cached copy. validators, as returned by
+        DownloadManager.fetch(), are kept for revalidating it.
+        '''
+        with open(source_path, 'rb') as source:
+            blob_path = self._store(arxiv_id, source)
+        validators_path = self._key_path(arxiv_id) + '.validators'
+        if validators:
+            self._atomic_write(validators_path, json.dumps(validators))
+        elif os.path.exists(validators_path):
+            os.remove(validators_path)
+        return blob_path
+
+    def put_bytes(self, arxiv_id, data):
+        '''Store an in-memory archive under arxiv_id.'''
+        with tempfile.SpooledTemporaryFile() as source:
+            source.write(data)
+            source.seek(0)
+            return self._store(arxiv_id, source)
+
+    def _store(self, arxiv_id, source):
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+            blob_path = self._blob_path(digest.hexdigest())
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._atomic_write(self._key_path(arxiv_id), digest.hexdigest())
+        self.evict()
+        return blob_path
+
+    def _atomic_write(self, path, text):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(text)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        '''Remove least recently used blobs until the cache fits in max_bytes.'''
+        blobs = []
+        total = 0
+        for root, dirs, files in os.walk(self.blob_dir):
+            for file in files:
+                if file.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        # Keys pointing at evicted blobs are treated as misses by get()
+        for mtime, size, path in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        '''Delete every cached archive.'''
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.key_dir, exist_ok=True)
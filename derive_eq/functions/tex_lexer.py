@@ -0,0 +1,649 @@
+import re
+import time
+from bisect import bisect_right
+
+# Token kinds emitted by tokenize_tex()
+BEGIN = 'begin'      # \begin{env}, value is the environment name
+END = 'end'          # \end{env}, value is the environment name
+NEWLINE = 'newline'  # \\ line break
+AMP = 'amp'          # & alignment column
+NOTAG = 'notag'      # \notag or \nonumber
+TEXT = 'text'        # Any other source text, value is None
+
+# One alternation that finds everything the lexer cares about. Comments and
+# labels are matched so they can be dropped, \& and \% so they are not taken
+# for alignment markers or comments, and every other control word is looked
+# up in the macro table.
+_TOKEN_PATTERN = (
+    r'%[^\n]*'
+    r'|\\(?:'
+    r'(begin|end)[ \t]*\{([^{}]*)\}'
+    r'|label\{[^}\n]{0,256}\}'
+    r'|([A-Za-z@]+)'
+    r'|([\\&%])'
+    r')'
+    r'|&'
+)
+
+# What follows the name of each defining command, up to the body
+_DEF_HEAD = r'\s*\\([A-Za-z@]+)([^{]{0,20})'
+_NEWCOMMAND_HEAD = (
+    r'\*?\s*(?:\{\s*\\([A-Za-z@]+)\s*\}|\\([A-Za-z@]+))\s*(?:\[\s*(\d)\s*\])?'
+)
+_NEWENVIRONMENT_HEAD = r'\*?\s*\{([^{}\\]{1,256})\}\s*(?:\[\s*(\d)\s*\])?'
+_LET_HEAD = r'\s*\\([A-Za-z@]+)\s*=?\s*\\([A-Za-z@]+)'
+
+# Bound on the length of a macro body or argument, so that an unbalanced
+# brace costs a limited scan rather than one to the end of the document
+MAX_GROUP_LENGTH = 64 * 1024
+
+# Source searched for macro bodies and arguments, per character scanned by
+# tokenize_tex(). Many unbalanced braces each cost a scan of up to
+# MAX_GROUP_LENGTH, and this bounds their sum.
+GROUP_SCAN_FACTOR = 4
+
+# Levels of macro bodies and arguments tokenized within one another, past
+# which definitions and macros with arguments are left as text
+MAX_EXPANSION_DEPTH = 32
+
+# Structural tokens a macro may expand to, past which its definition is left
+# as text, so that one use costs a bounded time
+MAX_MACRO_TOKENS = 1024
+
+# Matches between two looks at the clock when scanning to a deadline
+_CLOCK_EVERY = 16
+
+
+class ScanTimeout(TimeoutError):
+    '''tokenize_tex() ran past its deadline, offset is where it stopped.'''
+
+    def __init__(self, offset):
+        super().__init__(f'Scanning stopped at offset {offset}')
+        self.offset = offset
+
+
+class _Syntax:
+    '''The lexer's patterns and literals, compiled for str or for bytes sources.'''
+
+    def __init__(self, literal):
+        self.token = re.compile(literal(_TOKEN_PATTERN))
+        self.heads = {
+            'def': re.compile(literal(_DEF_HEAD)),
+            'newcommand': re.compile(literal(_NEWCOMMAND_HEAD)),
+            'newenvironment': re.compile(literal(_NEWENVIRONMENT_HEAD)),
+            'let': re.compile(literal(_LET_HEAD)),
+        }
+        # Defining commands, by the kind of definition they make
+        self.definitions = {
+            literal('def'): 'def',
+            literal('gdef'): 'def',
+            literal('edef'): 'def',
+            literal('xdef'): 'def',
+            literal('newcommand'): 'newcommand',
+            literal('renewcommand'): 'newcommand',
+            literal('providecommand'): 'providecommand',
+            literal('DeclareRobustCommand'): 'newcommand',
+            literal('newenvironment'): 'newenvironment',
+            literal('renewenvironment'): 'newenvironment',
+            literal('let'): 'let',
+        }
+        self.notag = {literal('notag'), literal('nonumber')}
+        self.begin = literal('begin')
+        self.backslash = literal('\\')
+        self.amp = literal('&')
+        self.open_brace = literal('{')
+        self.close_brace = literal('}')
+        self.space = re.compile(literal(r'\s*'))
+        self.nonblank = re.compile(literal(r'\S'))
+        self.brace = re.compile(literal(r'\\.|[{}]'))
+        self.optional = re.compile(literal(r'\s*\[([^\]]{0,1024})\]'))
+        self.single = re.compile(literal(r'\s*(\\[A-Za-z@]+|\\.|[^\s{}])'))
+        self.parameter = re.compile(literal(r'#(\d)'))
+        self.end_prefix = literal('end')
+        self.defining = re.compile(literal(
+            r'%[^\n]*|\\(def|gdef|edef|xdef|newcommand|renewcommand|providecommand'
+            r'|DeclareRobustCommand|let)(?![A-Za-z@])'
+        ))
+
+
+_STR_SYNTAX = _Syntax(str)
+_BYTES_SYNTAX = _Syntax(lambda text: text.encode('ascii'))
+
+
+def _name(value):
+    # Environment names are reported as str whatever the source type
+    return value if isinstance(value, str) else value.decode('utf8', errors='ignore')
+
+
+class MacroTable(dict):
+    '''
+    The macros recorded by tokenize_tex(), by control word, and the commands
+    of redefined environments under (BEGIN, name) and (END, name) keys.
+    redefines_environments is set once such a key is, so that environments
+    are only looked up here when one may have been redefined.
+
+    Every change is numbered, version being the number of the last one, and
+    kept, so that at() gives the macros as they were at an earlier point of
+    the scan without copying them.
+    '''
+    __slots__ = ('redefines_environments', 'version', 'changes', 'environments_version')
+
+    def __init__(self):
+        super().__init__()
+        self.redefines_environments = False
+        self.version = 0
+        # ([versions], [macros, None once forgotten]) by key
+        self.changes = {}
+        # Version at which an environment was first redefined
+        self.environments_version = None
+
+    def __setitem__(self, key, value):
+        self._change(key, value)
+        super().__setitem__(key, value)
+
+    def pop(self, key, default=None):
+        if key not in self:
+            return default
+        self._change(key, None)
+        return super().pop(key)
+
+    def _change(self, key, value):
+        self.version += 1
+        if type(key) is tuple and not self.redefines_environments:
+            self.redefines_environments = True
+            self.environments_version = self.version
+        changes = self.changes.get(key)
+        if changes is None:
+            changes = self.changes[key] = ([], [])
+        changes[0].append(self.version)
+        changes[1].append(value)
+
+    def macro_at(self, key, version):
+        '''The macro key stood for once version changes were made, or None.'''
+        changes = self.changes.get(key)
+        if changes is None:
+            return None
+        versions, values = changes
+        if versions[-1] <= version:
+            return values[-1]
+        i = bisect_right(versions, version)
+        return values[i - 1] if i else None
+
+    def at(self, version):
+        '''
+        The macros as they were once version changes were made, to tokenize
+        again part of the source scanned then. Definitions met doing so are
+        kept in the snapshot and leave this table as it is.
+        '''
+        return _MacroSnapshot(self, version)
+
+
+class _MacroSnapshot:
+    '''A MacroTable as it was at one version, see MacroTable.at().'''
+    __slots__ = ('table', 'version', 'redefines_environments', 'overlay')
+
+    def __init__(self, table, version):
+        self.table = table
+        self.version = version
+        self.redefines_environments = (table.environments_version is not None
+                                       and table.environments_version <= version)
+        # Definitions made since, None for a macro forgotten
+        self.overlay = {}
+
+    def get(self, key, default=None):
+        if self.overlay and key in self.overlay:
+            macro = self.overlay[key]
+        elif key in self.table.changes:
+            macro = self.table.macro_at(key, self.version)
+        else:
+            # Most control words were never defined
+            return default
+        return default if macro is None else macro
+
+    def __contains__(self, key):
+        if key not in self.table.changes and not self.overlay:
+            return False
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        macro = self.get(key)
+        if macro is None:
+            raise KeyError(key)
+        return macro
+
+    def __setitem__(self, key, value):
+        if type(key) is tuple:
+            self.redefines_environments = True
+        self.overlay[key] = value
+
+    def pop(self, key, default=None):
+        macro = self.get(key)
+        self.overlay[key] = None
+        return default if macro is None else macro
+
+
+class _Scan:
+    '''
+    State shared by one call of tokenize_tex() or find_definitions() and the
+    scans it makes of macro bodies and arguments: the source left to scan
+    for {...} groups, the tokens left to produce by expanding macros, how
+    deeply bodies and arguments are being tokenized within one another and
+    the deadline to stop at, if any. The budgets grow with the length of
+    the source, which keeps the whole call linear in it whatever the input.
+    '''
+    __slots__ = ('syntax', 'macros', 'environments', 'groups', 'expansions', 'depth',
+                 'deadline')
+
+    def __init__(self, syntax, macros, environments, length, deadline=None):
+        self.syntax = syntax
+        self.macros = macros
+        self.environments = environments
+        self.groups = GROUP_SCAN_FACTOR * length
+        self.expansions = length
+        self.depth = 0
+        self.deadline = deadline
+
+    def expands(self, macro):
+        '''Whether a use of macro can still be expanded, taking its tokens if so.'''
+        items, arguments, optional = macro
+        if (arguments or optional) and self.depth >= MAX_EXPANSION_DEPTH:
+            return False
+        if len(items) > self.expansions:
+            return False
+        self.expansions -= len(items)
+        return True
+
+
+def _group(content, pos, end, scan):
+    '''
+    Return (inner start, inner end, end) of the {...} group at pos, after any
+    whitespace, or None if there is no complete group there or the scan has
+    run out of source to search for one.
+    '''
+    syntax = scan.syntax
+    pos = syntax.space.match(content, pos, end).end()
+    if content[pos:pos + 1] != syntax.open_brace:
+        return None
+    limit = min(end, pos + MAX_GROUP_LENGTH, pos + scan.groups)
+    deadline = scan.deadline
+    countdown = _CLOCK_EVERY
+    depth = 0
+    for match in syntax.brace.finditer(content, pos, limit):
+        if deadline is not None:
+            # One group may hold tens of thousands of braces
+            countdown -= 1
+            if not countdown:
+                countdown = _CLOCK_EVERY
+                if time.perf_counter() > deadline:
+                    raise ScanTimeout(pos)
+        brace = match.group()
+        if brace == syntax.open_brace:
+            depth += 1
+        elif brace == syntax.close_brace:
+            depth -= 1
+            if depth == 0:
+                scan.groups -= match.end() - pos
+                return pos + 1, match.start(), match.end()
+    scan.groups -= limit - pos
+    return None
+
+
+def _read_arguments(content, pos, end, arguments, optional, scan):
+    '''
+    Read the arguments of a macro use starting at pos. Returns the list of
+    their (start, end) spans, None for an optional argument left out, and
+    the offset after the last one.
+    '''
+    syntax = scan.syntax
+    spans = []
+    if optional:
+        match = syntax.optional.match(content, pos, end)
+        if match is None:
+            spans.append(None)
+        else:
+            spans.append(match.span(1))
+            pos = match.end()
+        arguments -= 1
+    for _ in range(arguments):
+        group = _group(content, pos, end, scan)
+        if group is not None:
+            spans.append(group[:2])
+            pos = group[2]
+            continue
+        # An undelimited argument is a single token
+        match = syntax.single.match(content, pos, end)
+        if match is None:
+            spans.append(None)
+            continue
+        spans.append(match.span(1))
+        pos = match.end()
+    return spans, pos
+
+
+def _expansion(content, start, end, scan):
+    '''
+    Turn a macro body into what a use of the macro expands to: a tuple of
+    structural (kind, value) tokens and argument numbers. Bodies with any
+    other text cannot be expanded from offsets into the source and give None,
+    as do bodies nested more than MAX_EXPANSION_DEPTH deep and bodies that
+    expand to more than MAX_MACRO_TOKENS tokens.
+    '''
+    if scan.depth >= MAX_EXPANSION_DEPTH:
+        return None
+    syntax = scan.syntax
+    items = []
+    depth = scan.depth
+    scan.depth += 1
+    for kind, value, token_start, token_end in _tokenize(content, start, end, scan):
+        if kind != TEXT:
+            if (value is not None and '#' in value) or len(items) == MAX_MACRO_TOKENS:
+                items = None
+                break
+            items.append((kind, value))
+            continue
+        # Between the parameters #1, #2... only whitespace is allowed
+        last = token_start
+        for match in syntax.parameter.finditer(content, token_start, token_end):
+            if syntax.nonblank.search(content, last, match.start()) is not None:
+                items = None
+                break
+            items.append(int(match.group(1)))
+            last = match.end()
+        if items is None or syntax.nonblank.search(content, last, token_end) is not None:
+            items = None
+            break
+    # Stopping early leaves the uses being expanded in the body unfinished
+    scan.depth = depth
+    if items is None:
+        return None
+    numbers = [item for item in items if isinstance(item, int)]
+    # Arguments are read from the source in order, so each is used once and in order
+    if numbers != sorted(set(numbers)):
+        return None
+    return tuple(items)
+
+
+def _define(kind, content, pos, end, scan):
+    '''
+    Record the definition made by a defining command ending at pos. Returns
+    the offset after the definition if it was recorded, or None if it is
+    left in the text as it is, either because it is malformed or because its
+    body is not made of structure alone (any earlier macro of that name is
+    then forgotten).
+    '''
+    syntax = scan.syntax
+    macros = scan.macros
+    head = syntax.heads['newcommand' if kind == 'providecommand' else kind].match(content, pos, end)
+    if head is None:
+        return None
+
+    if kind == 'let':
+        name, target = head.groups()
+        if target in macros:
+            macros[name] = macros[target]
+            return head.end()
+        # \let\be\equation and \let\ee\endequation alias an environment
+        target_name = _name(target)
+        if target_name in scan.environments:
+            macros[name] = (((BEGIN, target_name),), 0, False)
+            return head.end()
+        if target.startswith(syntax.end_prefix) and _name(target[3:]) in scan.environments:
+            macros[name] = (((END, _name(target[3:])),), 0, False)
+            return head.end()
+        macros.pop(name, None)
+        return None
+
+    if kind == 'newenvironment':
+        env = _name(head.group(1).strip())
+        arguments = int(head.group(2) or 0)
+        pos = head.end()
+        optional = arguments > 0 and syntax.optional.match(content, pos, end)
+        if optional:
+            pos = optional.end()
+        begin_code = _group(content, pos, end, scan)
+        end_code = begin_code and _group(content, begin_code[2], end, scan)
+        if not end_code:
+            return None
+        begin_items = _expansion(content, begin_code[0], begin_code[1], scan)
+        end_items = _expansion(content, end_code[0], end_code[1], scan)
+        if begin_items is None or end_items is None or any(
+                isinstance(item, int) for item in end_items):
+            macros.pop((BEGIN, env), None)
+            macros.pop((END, env), None)
+            return None
+        macros[(BEGIN, env)] = (begin_items, arguments, bool(optional))
+        macros[(END, env)] = (end_items, 0, False)
+        return end_code[2]
+
+    if kind == 'def':
+        name, parameters = head.groups()
+        arguments = parameters.count(b'#' if isinstance(parameters, bytes) else '#')
+        optional = False
+    else:
+        name = head.group(1) or head.group(2)
+        arguments = int(head.group(3) or 0)
+        optional = False
+    pos = head.end()
+    if kind != 'def' and arguments:
+        default = syntax.optional.match(content, pos, end)
+        if default is not None:
+            optional = True
+            pos = default.end()
+    body = _group(content, pos, end, scan)
+    if body is None:
+        return None
+    if kind == 'providecommand' and name in macros:
+        return body[2]
+    items = _expansion(content, body[0], body[1], scan)
+    if items is None:
+        macros.pop(name, None)
+        return None
+    macros[name] = (items, arguments, optional)
+    return body[2]
+
+
+def _expand(content, macro, start, pos, end, scan):
+    '''
+    Yield the tokens of a use of macro at start, whose name ends at pos.
+    Structural tokens cover the source between the arguments, and arguments
+    are tokenized in place. Returns the offset after the use.
+    '''
+    if scan.deadline is not None and time.perf_counter() > scan.deadline:
+        # Uses nested in arguments are expanded before the scan moves on
+        raise ScanTimeout(start)
+    items, arguments, optional = macro
+    spans, after = _read_arguments(content, pos, end, arguments, optional, scan)
+    # Where the source between two arguments ends
+    boundaries = []
+    boundary = after
+    for item in reversed(items):
+        if isinstance(item, int):
+            span = spans[item - 1] if item <= len(spans) else None
+            if span is not None:
+                boundary = span[0]
+        boundaries.append(boundary)
+    boundaries.reverse()
+
+    cursor = start
+    for item, boundary in zip(items, boundaries):
+        if isinstance(item, int):
+            span = spans[item - 1] if item <= len(spans) else None
+            if span is not None:
+                scan.depth += 1
+                yield from _tokenize(content, span[0], span[1], scan)
+                scan.depth -= 1
+                cursor = span[1]
+        else:
+            yield item[0], item[1], cursor, boundary
+    return after
+
+
+def find_definitions(content):
+    '''
+    Yield (name, arguments, default, body) for every command defined in
+    content with \\def, \\newcommand and their variants, whatever its body:
+    the name without its backslash, the number of arguments, the default of
+    an optional first argument or None, and the body as written. A \\let
+    gives the command it copies as its body. Names, defaults and bodies are
+    str, also for bytes-like content. Bodies are looked for within the same
+    budget as in tokenize_tex(), so the bodies yielded add up to at most
+    GROUP_SCAN_FACTOR times the length of content.
+    '''
+    syntax = _STR_SYNTAX if isinstance(content, str) else _BYTES_SYNTAX
+    end = len(content)
+    scan = _Scan(syntax, None, (), end)
+    for match in syntax.defining.finditer(content):
+        if match.group(1) is None:
+            # A comment
+            continue
+        kind = syntax.definitions[match.group(1)]
+        head = syntax.heads['newcommand' if kind == 'providecommand' else kind].match(
+            content, match.end(), end)
+        if head is None:
+            continue
+        if kind == 'let':
+            name, target = head.groups()
+            yield _name(name), 0, None, '\\' + _name(target)
+            continue
+        default = None
+        if kind == 'def':
+            name, parameters = head.groups()
+            arguments = parameters.count(b'#' if isinstance(parameters, bytes) else '#')
+        else:
+            name = head.group(1) or head.group(2)
+            arguments = int(head.group(3) or 0)
+        pos = head.end()
+        if kind != 'def' and arguments:
+            optional = syntax.optional.match(content, pos, end)
+            if optional is not None:
+                default = _name(optional.group(1))
+                pos = optional.end()
+        body = _group(content, pos, end, scan)
+        if body is not None:
+            yield _name(name), arguments, default, _name(content[body[0]:body[1]])
+
+
+def tokenize_tex(content, macros=None, start=0, end=None, environments=(), deadline=None):
+    """
+    Scan LaTeX source once and yield (kind, value, start, end) tokens.
+    Only content[start:end] is scanned, offsets stay relative to content.
+
+    content is a str or any bytes-like buffer the re module can search, such
+    as bytes or an mmap, in which case offsets are byte offsets and nothing
+    is decoded but environment names.
+
+    Only the structure needed for equation extraction is reported: environment
+    boundaries, line breaks, alignment columns and \\notag markers. Everything
+    in between is yielded as TEXT spans into content, with comments and
+    \\label{...} commands left out.
+
+    Macros are expanded as they are met. \\def, \\newcommand and their
+    variants, \\newenvironment and \\let record in macros, a MacroTable or a
+    snapshot of one from its at(), made anew if None is given, what their
+    uses expand to, with or without arguments, as long as the body is made
+    of structure only: environments, line breaks, columns, \\notag, labels
+    and the macro's own parameters. The arguments of a use are tokenized
+    where they are in the source. \\let may alias the commands of the
+    environments named in environments, as in \\let\\be\\equation. Every
+    control word is looked up in the macro table as a whole, so the cost
+    does not depend on the number of macros and \\beq never matches a macro
+    \\be.
+
+    The time taken is linear in end - start, for malformed sources too, and
+    does not grow with the number of macros defined, before the call or
+    during it: each definition and each use costs one lookup in the table.
+    Every pattern matches a bounded stretch or one no later match covers
+    again, and what may be scanned more than once is budgeted: the search
+    for {...} groups, such as the body of a \\def left unclosed, to
+    GROUP_SCAN_FACTOR times the length of the source, the tokens yielded by
+    expanding macros to one per character of source and MAX_MACRO_TOKENS
+    per macro, and bodies and arguments nested in one another to
+    MAX_EXPANSION_DEPTH levels. Past these budgets definitions and macro
+    uses are left in the text as they are, which no ordinary document comes
+    near. benchmarks/bench_fuzz.py checks this on inputs built against each
+    of these bounds.
+
+    With a deadline, a time.perf_counter() value, ScanTimeout is raised
+    once the clock passes it.
+    """
+    syntax = _STR_SYNTAX if isinstance(content, str) else _BYTES_SYNTAX
+    if macros is None:
+        macros = MacroTable()
+    if end is None:
+        end = len(content)
+    return _tokenize(content, start, end,
+                     _Scan(syntax, macros, environments, end - start, deadline))
+
+
+def _tokenize(content, start, end, scan):
+    syntax = scan.syntax
+    macros = scan.macros
+    search = syntax.token.search
+    deadline = scan.deadline
+    countdown = _CLOCK_EVERY
+    text_start = start
+    pos = start
+
+    while True:
+        match = search(content, pos, end)
+        if match is None:
+            break
+        if deadline is not None:
+            countdown -= 1
+            if not countdown:
+                countdown = _CLOCK_EVERY
+                if time.perf_counter() > deadline:
+                    raise ScanTimeout(pos)
+        start, pos = match.span()
+        group = match.lastindex
+        macro = None
+
+        if group == 3:
+            word = match.group(3)
+            if word in macros:
+                macro = macros[word]
+                items = macro[0]
+                if len(items) == 1 and not macro[1] and not macro[2]:
+                    # A shortcut for a single token, such as \beq, needs no expansion
+                    kind, value = items[0]
+                    macro = None
+                elif not scan.expands(macro):
+                    continue
+            elif word in syntax.notag:
+                kind, value = NOTAG, None
+            elif word in syntax.definitions:
+                definition_end = _define(syntax.definitions[word], content, pos, end, scan)
+                if definition_end is None:
+                    continue
+                kind, value = None, None
+                pos = definition_end
+            else:
+                continue
+        elif group == 2:
+            kind = BEGIN if match.group(1) == syntax.begin else END
+            value = _name(match.group(2).strip())
+            # Environments are only looked up in macros once one has been redefined
+            if macros.redefines_environments:
+                macro = macros.get((kind, value))
+                if macro is not None and not scan.expands(macro):
+                    macro = None
+        elif group == 4:
+            if match.group(4) != syntax.backslash:
+                continue
+            kind, value = NEWLINE, None
+        elif match.group(0) == syntax.amp:
+            kind, value = AMP, None
+        else:
+            # Comment or label, dropped from the text
+            kind, value = None, None
+
+        if text_start < start:
+            yield TEXT, None, text_start, start
+        if macro is not None:
+            pos = yield from _expand(content, macro, start, pos, end, scan)
+        elif kind is not None:
+            yield kind, value, start, pos
+        text_start = pos
+
+    if text_start < end:
+        yield TEXT, None, text_start, end
@@ -0,0 +1,246 @@
+import hashlib
+import mmap
+import os
+import posixpath
+import re
+from bisect import bisect_right
+
+# \input{file}, \include{file}, \subfile{file} and the brace-less \input file
+_INPUT_PATTERN = re.compile(
+    rb'\\(?:input|include|subfile)[ \t]*\{([^}]+)\}|\\input[ \t]+([^\s{}\\%]+)'
+)
+_COMMENT_PATTERN = re.compile(rb'(?<!\\)%')
+_DOCUMENTCLASS_PATTERN = re.compile(rb'^[ \t]*\\documentclass', re.MULTILINE)
+_NEWLINE_PATTERN = re.compile(rb'\n')
+
+# Limit on \input nesting, which also stops include cycles
+MAX_INPUT_DEPTH = 20
+
+
+def _is_commented(data, pos):
+    line_start = data.rfind(b'\n', 0, pos) + 1
+    return _COMMENT_PATTERN.search(data, line_start, pos) is not None
+
+
+def _input_name(match):
+    return (match.group(1) or match.group(2)).strip().decode('utf8', errors='ignore')
+
+
+def _count_lines(data, start, end):
+    # mmap has no count()
+    if isinstance(data, bytes):
+        return data.count(b'\n', start, end)
+    return len(_NEWLINE_PATTERN.findall(data, start, end))
+
+
+def map_file(path):
+    '''
+    Map a file into memory read-only. Pages are read by the OS as they are
+    touched, so the file is never copied into the process as a whole.
+    Empty files, which cannot be mapped, come back as b''.
+    '''
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def find_input_names(data):
+    '''Return the file names of the uncommented \\input/\\include/\\subfile commands in data.'''
+    names = []
+    for match in _INPUT_PATTERN.finditer(data):
+        if not _is_commented(data, match.start()):
+            names.append(_input_name(match))
+    return names
+
+
+def find_main_file(members):
+    '''
+    Pick the root document among the .tex members of a source tree.
+
+    Files are scored on having an uncommented \\documentclass and a
+    \\begin{document}, and files pulled in by another file's \\input are
+    ruled out. Ties go to top-level files with common main-file names.
+    '''
+    tex_names = [name for name in members if name.lower().endswith('.tex')]
+    if not tex_names:
+        return None
+
+    included = set()
+    for name in tex_names:
+        for child in find_input_names(members[name]):
+            resolved = resolve_input(child, name, members)
+            if resolved is not None and resolved != name:
+                included.add(resolved)
+
+    def score(name):
+        data = members[name]
+        points = 0
+        if _DOCUMENTCLASS_PATTERN.search(data):
+            points += 10
+        if b'\\begin{document}' in data:
+            points += 5
+        if name in included:
+            points -= 20
+        if '/' not in name:
+            points += 1
+        if posixpath.splitext(posixpath.basename(name))[0].lower() in ('main', 'ms', 'paper'):
+            points += 1
+        return points, len(data)
+
+    return max(tex_names, key=score)
+
+
+def resolve_input(name, parent, members):
+    '''
+    Find the member an \\input refers to. Names are tried relative to the root
+    of the source tree and to the including file, with and without .tex.
+    '''
+    candidates = []
+    for base in ('', posixpath.dirname(parent)):
+        path = posixpath.normpath(posixpath.join(base, name))
+        candidates += [path, path + '.tex']
+    for candidate in candidates:
+        if candidate in members:
+            return candidate
+    return None
+
+
+class TexSourceView:
+    '''
+    A document assembled from its main file with every reachable \\input,
+    \\include and \\subfile spliced in place.
+
+    Files are loaded through loader(name), which returns bytes (or an mmap)
+    or None, and only when they are reached, so files the document never
+    includes are never read. source holds the assembled document as bytes,
+    and locate() maps a byte offset in it back to the file, offset and line
+    it came from. A document that is a single file without inputs is not
+    copied at all: source is that file's buffer.
+
+    close(), or leaving a with block, unmaps the files the view mapped.
+    Equation records parsed from source rebuild their lines from it, so
+    they are to be used before then.
+    '''
+
+    def __init__(self, loader, main, names=None):
+        self.loader = loader
+        self.main = main
+        # Known file names, for resolving \input{name} without the extension
+        self.names = names
+        self.files = {}
+        # (start in text, file name, offset in that file), sorted by start
+        self.segments = []
+        parts = []
+        self._length = 0
+        self._append_file(main, parts, depth=0, stack=(main,))
+        data = self.files.get(main)
+        if self.segments == [(0, main, 0)] and self._length == len(data):
+            self.source = data
+        else:
+            self.source = b''.join(parts)
+        self._starts = [segment[0] for segment in self.segments]
+        # Last (offset, line) found by locate() in each file, which is asked
+        # for offsets in increasing order
+        self._lines = {}
+
+    @classmethod
+    def from_members(cls, members, main=None):
+        '''View over the {name: bytes} members of an e-print.'''
+        if main is None:
+            main = find_main_file(members)
+        if main is None:
+            return None
+        return cls(members.get, main, names=members)
+
+    @classmethod
+    def from_file(cls, file_path):
+        '''View rooted at a tex file on disk, with inputs resolved next to it.'''
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"No such file: '{file_path}'")
+        root = os.path.dirname(os.path.abspath(file_path))
+
+        def loader(name):
+            path = os.path.join(root, *name.split('/'))
+            if not os.path.isfile(path):
+                return None
+            return map_file(path)
+
+        return cls(loader, os.path.basename(file_path))
+
+    def close(self):
+        '''Unmap the files mapped by the loader, see map_file().'''
+        for data in self.files.values():
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def text(self):
+        '''The assembled document decoded to str, a full copy of source.'''
+        return bytes(self.source).decode('utf8', errors='ignore')
+
+    def _load(self, name):
+        if name not in self.files:
+            self.files[name] = self.loader(name)
+        return self.files[name]
+
+    def _resolve(self, name, parent):
+        if self.names is not None:
+            return resolve_input(name, parent, self.names)
+        for base in ('', posixpath.dirname(parent)):
+            path = posixpath.normpath(posixpath.join(base, name))
+            for candidate in (path, path + '.tex'):
+                if self._load(candidate) is not None:
+                    return candidate
+        return None
+
+    def _append(self, parts, name, data, start, end):
+        if start < end:
+            self.segments.append((self._length, name, start))
+            parts.append(memoryview(data)[start:end])
+            self._length += end - start
+
+    def _append_file(self, name, parts, depth, stack):
+        data = self._load(name)
+        if data is None:
+            return
+        pos = 0
+        for match in _INPUT_PATTERN.finditer(data):
+            if _is_commented(data, match.start()):
+                continue
+            child = self._resolve(_input_name(match), name)
+            if child is None or child in stack or depth >= MAX_INPUT_DEPTH:
+                continue
+            self._append(parts, name, data, pos, match.start())
+            self._append_file(child, parts, depth + 1, stack + (child,))
+            pos = match.end()
+        self._append(parts, name, data, pos, len(data))
+
+    def reachable_files(self):
+        '''Names of the files that make up the document, in order of first use.'''
+        return list(dict.fromkeys(name for start, name, offset in self.segments))
+
+    def digest(self):
+        '''sha256 of the assembled document, for detecting source changes.'''
+        return hashlib.sha256(self.source).hexdigest()
+
+    def locate(self, offset):
+        '''Return (file name, offset in file, line number) for a byte offset into source.'''
+        index = bisect_right(self._starts, offset) - 1
+        if index < 0:
+            return self.main, offset, 1
+        start, name, file_offset = self.segments[index]
+        file_offset += offset - start
+        # Count on from the last offset looked up in this file when possible
+        last_offset, line = self._lines.get(name, (0, 1))
+        if file_offset < last_offset:
+            last_offset, line = 0, 1
+        line += _count_lines(self.files[name], last_offset, file_offset)
+        self._lines[name] = (file_offset, line)
+        return name, file_offset, line
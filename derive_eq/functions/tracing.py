@@ -0,0 +1,168 @@
+import contextvars
+import itertools
+import json
+import threading
+import time
+
+# Id of the innermost open span. Tasks started by asyncio copy it, so spans
+# opened by concurrent downloads nest under the span that started them
+_current_span = contextvars.ContextVar('derive_eq_current_span', default=None)
+_span_ids = itertools.count(1)
+
+# Receivers of finished spans, tracing is off while this is empty
+_sinks = []
+_sinks_lock = threading.Lock()
+
+
+class Span:
+    '''
+    One timed stage of a run. Attributes such as byte and equation counts
+    or cache hits are set with set() and add() while the span is open, and
+    the span is handed to every sink when it closes.
+    '''
+    __slots__ = ('name', 'attrs', 'id', 'parent', 'start', 'duration', '_clock', '_token')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.id = next(_span_ids)
+        self.parent = None
+        self.start = None
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, key, amount=1):
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self.id)
+        self.start = time.time()
+        self._clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self._clock
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Closed in another context than it was opened in, e.g. a generator
+            # resumed from a different task
+            _current_span.set(self.parent)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        for sink in list(_sinks):
+            sink.record(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'span': self.name,
+            'id': self.id,
+            'parent': self.parent,
+            'start': self.start,
+            'duration': self.duration,
+            **self.attrs,
+        }
+
+
+class _NoopSpan:
+    '''Stand-in returned by span() while tracing is off.'''
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attrs):
+    '''
+    Time a stage of a run:
+
+        with span('download', arxiv_id=arxiv_id) as s:
+            ...
+            s.set(bytes=size)
+
+    While no sink is registered this returns a shared object whose methods
+    do nothing, so instrumented code pays for one function call.
+    '''
+    if not _sinks:
+        return _NOOP_SPAN
+    return Span(name, attrs)
+
+
+def enabled():
+    return bool(_sinks)
+
+
+def add_sink(sink):
+    '''Start passing finished spans to sink.record(span).'''
+    with _sinks_lock:
+        _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+class TimingSummary:
+    '''
+    Sink that totals spans by name: how often each stage ran, the time it
+    took and the sum of its numeric attributes (booleans count as 0 or 1).
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        with self.lock:
+            stage = self.stages.setdefault(span.name, {
+                'count': 0, 'total': 0.0, 'max': 0.0, 'attrs': {}
+            })
+            stage['count'] += 1
+            stage['total'] += span.duration
+            stage['max'] = max(stage['max'], span.duration)
+            for key, value in span.attrs.items():
+                if isinstance(value, (int, float)):
+                    stage['attrs'][key] = stage['attrs'].get(key, 0) + value
+
+    def rows(self):
+        '''(name, count, total seconds, mean seconds, max seconds, attrs) per stage, in first-seen order.'''
+        with self.lock:
+            return [(name, stage['count'], stage['total'], stage['total'] / stage['count'],
+                     stage['max'], dict(stage['attrs']))
+                    for name, stage in self.stages.items()]
+
+
+class JsonLinesSink:
+    '''Sink that writes every finished span as one JSON object per line.'''
+
+    def __init__(self, path):
+        self.file = open(path, 'a', buffering=1)
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
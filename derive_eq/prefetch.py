@@ -0,0 +1,312 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from derive_eq.derive_equation import index_paper
+from derive_eq.functions.ask_chat import bot
+from derive_eq.functions.backends import SYSTEM_PROMPT, get_backend
+from derive_eq.functions.canonical import fingerprint
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.functions.get_tex_eq_better import format_equation
+from derive_eq.functions.result_cache import get_result_cache, result_key
+from derive_eq.functions.tracing import span
+
+# Priorities of queued work, lower runs first. Papers are indexed and derived
+# ahead of time at PREFETCH, and an equation someone asks for moves up to URGENT.
+URGENT = 0
+PREFETCH = 10
+
+# States of a paper whose prefetch is over
+FINISHED = ('finished', 'cancelled', 'failed')
+
+# Fields of a progress dict that change as a prefetch goes on
+_PROGRESS = ('state', 'equations', 'done', 'failed', 'cancelled')
+
+# Default size of the worker pool, overridable with DERIVE_EQ_PREFETCH_WORKERS
+DEFAULT_WORKERS = 2
+
+
+class _Job:
+    '''One queued derivation, shared by every equation with the same fingerprint.'''
+    __slots__ = ('key', 'latex', 'variants', 'priority', 'future', 'equations')
+
+    def __init__(self, key, latex, priority):
+        self.key = key
+        self.latex = latex
+        # Other ways the equations waiting on it are written
+        self.variants = set()
+        self.priority = priority
+        self.future = Future()
+        # (arxiv_id, eq_number) of the equations waiting on it
+        self.equations = []
+
+
+class _Paper:
+    '''Progress of the prefetch of one paper, see Prefetcher.progress().'''
+    __slots__ = ('arxiv_id', 'state', 'equations', 'done', 'failed', 'cancelled', 'error',
+                 'started')
+
+    def __init__(self, arxiv_id):
+        self.arxiv_id = arxiv_id
+        self.state = 'indexing'
+        self.equations = None
+        self.done = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.error = None
+        self.started = time.time()
+
+    @property
+    def finished(self):
+        return self.state in FINISHED
+
+    def count(self, failed):
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+        if self.state == 'deriving' and self.done + self.failed >= self.equations:
+            self.state = 'finished'
+
+    def snapshot(self):
+        return {
+            'arxiv_id': self.arxiv_id,
+            'state': self.state,
+            'equations': self.equations,
+            'done': self.done,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'error': self.error,
+            'elapsed': time.time() - self.started,
+        }
+
+
+class Prefetcher:
+    '''
+    Derives every numbered equation of a paper in the background, so that
+    asking for one of them later is answered from the result cache.
+
+    Work is done by a pool of worker threads, started on first use, and taken
+    from one queue by priority. Papers are fetched, indexed and derived at
+    PREFETCH priority, equation after equation in document order and paper
+    after paper, and bump() moves an equation someone is waiting for to the
+    front. Equations with the same fingerprint, in one paper or in several,
+    are derived once. Derivations go through bot(), which stores them in the
+    result cache, so those already there cost nothing.
+    '''
+
+    def __init__(self, workers=None, index=None, use_cache=True):
+        if workers is None:
+            workers = int(os.environ.get('DERIVE_EQ_PREFETCH_WORKERS', DEFAULT_WORKERS))
+        self.workers = workers
+        self.index = index or EquationIndex()
+        self.use_cache = use_cache
+        # Guards everything below, and is notified whenever progress is made
+        self.lock = threading.Condition()
+        # Heap of (priority, sequence, job or arXiv ID of a paper to index)
+        self.queue = []
+        self.sequence = itertools.count()
+        # Jobs queued or running by fingerprint, and by the equations waiting on them
+        self.jobs = {}
+        self.equations = {}
+        self.papers = {}
+        self.threads = []
+        self.closed = False
+
+    def prefetch(self, arxiv_id):
+        '''
+        Queue every numbered equation of a paper for derivation and return
+        its progress. A paper already being prefetched is left as it is.
+        '''
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Prefetcher is closed')
+            paper = self.papers.get(arxiv_id)
+            if paper is None or paper.finished:
+                paper = self.papers[arxiv_id] = _Paper(arxiv_id)
+                self._push(arxiv_id, PREFETCH)
+                self._start_workers()
+            return paper.snapshot()
+
+    def bump(self, arxiv_id, eq_number):
+        '''
+        Move the derivation of an equation being prefetched to the front of
+        the queue. Returns a Future for the derivation, or None if the
+        equation is not waiting to be derived.
+        '''
+        with self.lock:
+            job = self.equations.get((arxiv_id, str(eq_number).strip('() ')))
+            if job is None:
+                return None
+            if job.priority > URGENT and not job.future.running():
+                job.priority = URGENT
+                self._push(job, URGENT)
+            return job.future
+
+    def cancel(self, arxiv_id):
+        '''
+        Stop prefetching a paper: its derivations still queued are dropped,
+        except those another paper's equations wait on too, and the ones
+        running finish into the result cache. Returns False if the paper
+        was not being prefetched.
+        '''
+        with self.lock:
+            paper = self.papers.get(arxiv_id)
+            if paper is None or paper.finished:
+                return False
+            for equation, job in list(self.equations.items()):
+                if equation[0] != arxiv_id:
+                    continue
+                del self.equations[equation]
+                job.equations.remove(equation)
+                if not job.equations and job.future.cancel():
+                    del self.jobs[job.key]
+                paper.cancelled += 1
+            paper.state = 'cancelled'
+            self.lock.notify_all()
+            return True
+
+    def progress(self, arxiv_id=None):
+        '''
+        Progress of a paper as a dict, or None if it was never prefetched:
+        its state ('indexing', 'deriving', 'finished', 'cancelled', or
+        'failed' with the reason in error), the numbered equations found,
+        and how many were derived, failed or were cancelled. Without an
+        arxiv_id, a list of the progress of every paper.
+        '''
+        with self.lock:
+            if arxiv_id is None:
+                return [paper.snapshot() for paper in self.papers.values()]
+            paper = self.papers.get(arxiv_id)
+            return None if paper is None else paper.snapshot()
+
+    def wait(self, arxiv_id, timeout=None, since=None):
+        '''
+        Wait up to timeout seconds for a paper to finish, or with since, a
+        progress dict, for its progress to move on from that one. Returns the
+        progress, or None if the paper was never prefetched.
+        '''
+        def moved():
+            if paper.finished or since is None:
+                return paper.finished
+            return any(getattr(paper, key) != since[key] for key in _PROGRESS)
+
+        with self.lock:
+            paper = self.papers.get(arxiv_id)
+            if paper is None:
+                return None
+            self.lock.wait_for(moved, timeout)
+            return paper.snapshot()
+
+    def close(self):
+        '''Drop all queued work and let the workers stop once their current job is done.'''
+        with self.lock:
+            self.closed = True
+            for job in self.jobs.values():
+                job.future.cancel()
+            for paper in self.papers.values():
+                if not paper.finished:
+                    paper.state = 'cancelled'
+            self.queue.clear()
+            self.lock.notify_all()
+
+    def _push(self, task, priority):
+        heapq.heappush(self.queue, (priority, next(self.sequence), task))
+        self.lock.notify()
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='derive_eq-prefetch', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+                priority, _, task = heapq.heappop(self.queue)
+                if isinstance(task, _Job):
+                    # A bumped job leaves its first entry behind, and a
+                    # cancelled one all of them
+                    if task.future.done() or task.future.running():
+                        continue
+                    task.future.set_running_or_notify_cancel()
+            if isinstance(task, _Job):
+                self._derive(task)
+            else:
+                self._index(task)
+
+    def _index(self, arxiv_id):
+        with self.lock:
+            paper = self.papers[arxiv_id]
+            if paper.state != 'indexing':
+                return
+        try:
+            with span('prefetch_index', arxiv_id=arxiv_id) as s:
+                index = index_paper(arxiv_id, self.index)
+                equations = index.equations(arxiv_id)
+                if equations is None:
+                    raise RuntimeError('could not fetch paper source')
+                fingerprints = index.fingerprints(arxiv_id) or {}
+                s.set(equations=len(equations))
+        except Exception as e:
+            with self.lock:
+                paper.state = 'failed'
+                paper.error = str(e)
+                self.lock.notify_all()
+            return
+
+        with self.lock:
+            if paper.state != 'indexing':
+                return
+            paper.state = 'deriving'
+            paper.equations = 0
+            for equation in equations:
+                number = equation[0]
+                if number is None or (arxiv_id, number) in self.equations:
+                    continue
+                latex = format_equation(equation[1:])
+                key = fingerprints.get(number) or fingerprint(latex)
+                job = self.jobs.get(key)
+                if job is None:
+                    job = self.jobs[key] = _Job(key, latex, PREFETCH)
+                    self._push(job, PREFETCH)
+                elif latex != job.latex:
+                    job.variants.add(latex)
+                job.equations.append((arxiv_id, number))
+                self.equations[(arxiv_id, number)] = job
+                paper.equations += 1
+            if not paper.equations:
+                paper.state = 'finished'
+            self.lock.notify_all()
+
+    def _derive(self, job):
+        derivation = error = None
+        try:
+            with span('prefetch_derive', priority=job.priority):
+                derivation = bot(job.latex, use_cache=self.use_cache)
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.jobs.pop(job.key, None)
+            variants = list(job.variants)
+            for equation in job.equations:
+                self.equations.pop(equation, None)
+                self.papers[equation[0]].count(error is not None)
+            self.lock.notify_all()
+        if error is not None:
+            job.future.set_exception(error)
+            return
+        if self.use_cache and derivation and variants:
+            # The result cache is keyed by the text of an equation, so the
+            # duplicates written differently are stored under theirs too
+            cache = get_result_cache()
+            model = get_backend().model
+            for latex in variants:
+                cache.put(result_key(model, SYSTEM_PROMPT, latex), derivation)
+        job.future.set_result(derivation)
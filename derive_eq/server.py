@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from derive_eq.bulk_index import shard_paths
+from derive_eq.client import call, running, socket_path
+from derive_eq.derive_equation import derive_equation, index_paper
+from derive_eq.functions.backends import get_backend
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.functions.equation_search import search_indexes
+from derive_eq.functions.get_tex_eq_better import format_equation
+from derive_eq.prefetch import FINISHED, Prefetcher
+
+# Papers whose equation lists are kept in memory
+MAX_PAPERS = 256
+
+
+class DeriveServer:
+    '''
+    Long-running process that answers derive_eq requests on a Unix socket.
+
+    The equation index and bulk-index shards, the backend with its pool of
+    connections and the in-memory tier of the result cache stay loaded
+    between requests, and the equation lists of the last MAX_PAPERS papers
+    listed are kept in memory. Each request runs on a worker thread, so a
+    slow download or derivation does not hold up the others. Papers asked
+    for with the prefetch command are derived in the background by a
+    Prefetcher.
+    '''
+    # Requests a client may send, each answered by the method of that name
+    COMMANDS = ('ping', 'derive', 'list', 'search', 'prefetch')
+
+    def __init__(self, path=None, index=None):
+        self.path = path or socket_path()
+        self.index = index or EquationIndex()
+        self.shards = {}
+        self.papers = OrderedDict()
+        self.lock = threading.Lock()
+        self.prefetcher = Prefetcher(index=self.index)
+        self.started = time.time()
+        self.stopped = None
+
+    def warm(self):
+        '''Open the backend before the first request rather than during it.'''
+        get_backend().warm()
+
+    def ping(self):
+        prefetching = sum(progress['state'] not in FINISHED
+                          for progress in self.prefetcher.progress())
+        yield {'pid': os.getpid(), 'uptime': time.time() - self.started, 'papers': len(self.papers),
+               'prefetching': prefetching}
+
+    def derive(self, arxiv_id, eq_number, use_cache=True, stream=True):
+        if use_cache:
+            # An equation waiting to be prefetched is derived next, after which
+            # the answer comes from the result cache
+            derivation = self.prefetcher.bump(arxiv_id, eq_number)
+            if derivation is not None:
+                try:
+                    derivation.result()
+                except Exception:
+                    # Cancelled or failed, it is derived here instead
+                    pass
+        result = derive_equation(arxiv_id, eq_number, use_cache=use_cache, stream=stream,
+                                 index=self.index)
+        if not stream:
+            yield {'result': result}
+            return
+        for chunk in result:
+            yield {'chunk': chunk}
+
+    def prefetch(self, arxiv_id, action='start', wait=False):
+        '''
+        Start, cancel or report on the prefetch of a paper, as action says.
+        With wait, progress is sent every time it changes until the paper is
+        done. The prefetch goes on if the client goes away.
+        '''
+        if action == 'start':
+            self.prefetcher.prefetch(arxiv_id)
+        elif action == 'cancel':
+            self.prefetcher.cancel(arxiv_id)
+        elif action != 'status':
+            raise ValueError(f"Unknown prefetch action {action!r}")
+        progress = self.prefetcher.progress(arxiv_id)
+        yield {'progress': progress}
+        while wait and progress is not None and progress['state'] not in FINISHED:
+            progress = self.prefetcher.wait(arxiv_id, since=progress)
+            yield {'progress': progress}
+
+    def list(self, arxiv_id):
+        yield {'equations': self.paper_equations(arxiv_id)}
+
+    def search(self, query, k=10, paper=None, shards=None):
+        if paper is not None:
+            index_paper(paper, self.index)
+        indexes = [self.index]
+        if shards is not None:
+            indexes += [self.shard(path) for path in shard_paths(shards or None)]
+        yield {'results': search_indexes(indexes, query, k, paper)}
+
+    def paper_equations(self, arxiv_id):
+        '''[number, latex] for every equation of a paper, fetched and parsed on first use.'''
+        with self.lock:
+            if arxiv_id in self.papers:
+                self.papers.move_to_end(arxiv_id)
+                return self.papers[arxiv_id]
+        equations = index_paper(arxiv_id, self.index).equations(arxiv_id)
+        if not equations:
+            return []
+        rows = [[equation[0], format_equation(equation[1:])] for equation in equations]
+        with self.lock:
+            self.papers[arxiv_id] = rows
+            while len(self.papers) > MAX_PAPERS:
+                self.papers.popitem(last=False)
+        return rows
+
+    def shard(self, path):
+        with self.lock:
+            if path not in self.shards:
+                self.shards[path] = EquationIndex(path)
+            return self.shards[path]
+
+    async def handle(self, reader, writer):
+        start = time.perf_counter()
+        command = None
+        replies = None
+        try:
+            request = json.loads(await reader.readline())
+            command = request.pop('command', None)
+            if command == 'shutdown':
+                self.stopped.set()
+            elif command in self.COMMANDS:
+                replies = getattr(self, command)(**request)
+            else:
+                raise ValueError(f"Unknown command {command!r}")
+            # The handlers block on SQLite, downloads and the backend, so every
+            # reply is produced on a worker thread
+            while replies is not None:
+                reply = await asyncio.to_thread(next, replies, None)
+                if reply is None:
+                    break
+                writer.write(json.dumps(reply).encode('utf8') + b'\n')
+                await writer.drain()
+            writer.write(b'{"end": true}\n')
+            await writer.drain()
+        except ConnectionError:
+            # The client went away, a streamed derivation is abandoned
+            pass
+        except Exception as e:
+            try:
+                writer.write(json.dumps({'error': f"{type(e).__name__}: {e}"}).encode('utf8') + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                pass
+        finally:
+            if replies is not None:
+                await asyncio.to_thread(replies.close)
+            writer.close()
+            print(f"{command} {(time.perf_counter() - start) * 1000:.1f} ms", flush=True)
+
+    async def run(self):
+        self.stopped = asyncio.Event()
+        # Only the user may connect. The socket is created with those
+        # permissions by bind(), a chmod() afterwards would leave a moment
+        # in which anyone could connect.
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, self.path)
+        finally:
+            os.umask(umask)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopped.set)
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            self.prefetcher.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def serve(path=None):
+    '''
+    Run a DeriveServer on the Unix socket at path until it is stopped.
+    Returns 1 without starting if another daemon already answers there.
+    '''
+    if path is None:
+        path = socket_path()
+    if running(path) is not None:
+        print(f"derive_eq serve is already running on {path}")
+        return 1
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    server = DeriveServer(path)
+    server.warm()
+    print(f"Listening on {path}", flush=True)
+    asyncio.run(server.run())
+    return 0
+
+
+def stop(path=None):
+    '''Ask the daemon at path to shut down. Returns False if none is running.'''
+    replies = call('shutdown', path)
+    if replies is None:
+        return False
+    for reply in replies:
+        pass
+    return True
@@ -9,7 +9,7 @@ setup(
             'derive_eq=derive_eq.cli:main',
         ],
     },
-    install_requires=['feedparser'],
+    install_requires=['feedparser', 'httpx'],
     python_requires='>=3.11',
     author='Joe Bacchus, Alex, Piotr Toka',
     author_email='',
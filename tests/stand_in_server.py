@@ -0,0 +1,118 @@
+'''
+A local HTTP server standing in for arXiv's e-print endpoint in tests.
+
+It serves the archives in papers, by the ID in /e-print/<id>, with an ETag
+and Last-Modified. It answers If-None-Match with a 304 and honours Range
+with If-Range. It can also cut its next bodies short or answer 503, and it
+logs the status of every request.
+'''
+import hashlib
+import http.server
+import io
+import tarfile
+import threading
+
+LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+def paper_archive(files):
+    '''A gzipped tar of {name: str or bytes}, as arXiv serves e-prints.'''
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, data in files.items():
+            data = data.encode() if isinstance(data, str) else data
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class StandInServer:
+    '''
+    The server, started on a free port of 127.0.0.1 by start(). Set
+    truncate or unavailable to the number of coming requests to cut short
+    or answer 503, and last_modified to what the next responses carry.
+    '''
+
+    def __init__(self, papers=None):
+        self.papers = dict(papers or {})
+        self.truncate = 0
+        self.unavailable = 0
+        self.last_modified = LAST_MODIFIED
+        # (path, request headers, status) of every request
+        self.log = []
+        self.httpd = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def statuses(self):
+        return [status for path, headers, status in self.log]
+
+    def start(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.respond(self)
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def respond(self, handler):
+        headers = dict(handler.headers.items())
+        data = self.papers.get(handler.path.rsplit('/', 1)[-1])
+
+        def reply(status, body=b'', extra=()):
+            self.log.append((handler.path, headers, status))
+            handler.send_response(status)
+            for name, value in extra:
+                handler.send_header(name, value)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            return body
+
+        if self.unavailable:
+            self.unavailable -= 1
+            reply(503, extra=[('Retry-After', '0')])
+            return
+        if data is None:
+            reply(404)
+            return
+        etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        validators = [('ETag', etag), ('Last-Modified', self.last_modified)]
+        if handler.headers.get('If-None-Match') == etag:
+            self.log.append((handler.path, headers, 304))
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+
+        start = 0
+        if handler.headers.get('If-Range') in (etag, self.last_modified):
+            start = int(handler.headers.get('Range', 'bytes=0-')[6:].rstrip('-'))
+        if start:
+            body = reply(206, data[start:], validators + [
+                ('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')])
+        else:
+            body = reply(200, data, validators)
+        if self.truncate:
+            # Send a third of the body and drop the connection
+            self.truncate -= 1
+            handler.wfile.write(body[:len(body) // 3])
+            handler.wfile.flush()
+            handler.close_connection = True
+            handler.connection.shutdown(2)
+            return
+        handler.wfile.write(body)
@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+
+from derive_eq.functions.async_download import AsyncDownloader
+from stand_in_server import StandInServer, paper_archive
+
+PAPER = paper_archive({'main.tex': '\\begin{equation} a = b \\end{equation}\n%' + 'x' * 200000})
+
+
+class AsyncDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'2301.00001': PAPER, '2301.00002v1': b'other'}).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def fetch(self, *arxiv_ids, **options):
+        async def fetch():
+            async with AsyncDownloader(self.server.url, requests_per_second=0, backoff=0.01,
+                                       **options) as downloader:
+                return await downloader.fetch_many(arxiv_ids)
+
+        return asyncio.run(fetch())
+
+    def test_papers_are_fetched(self):
+        archives = self.fetch('2301.00001', '2301.00002v1', '2301.99999')
+        self.assertEqual(archives, {'2301.00001': PAPER, '2301.00002v1': b'other',
+                                    '2301.99999': None})
+        self.assertEqual(sorted(self.server.statuses()), [200, 200, 404])
+
+    def test_unavailable_server_is_retried(self):
+        self.server.unavailable = 2
+        self.assertEqual(self.fetch('2301.00001'), {'2301.00001': PAPER})
+        self.assertEqual(self.server.statuses(), [503, 503, 200])
+
+    def test_truncated_body_is_fetched_again(self):
+        self.server.truncate = 1
+        self.assertEqual(self.fetch('2301.00001'), {'2301.00001': PAPER})
+        self.assertEqual(self.server.statuses(), [200, 200])
+
+    def test_retries_run_out(self):
+        self.server.unavailable = 3
+        self.assertEqual(self.fetch('2301.00001', retries=1), {'2301.00001': None})
+        self.assertEqual(self.server.statuses(), [503, 503])
+
+
+if __name__ == '__main__':
+    unittest.main()
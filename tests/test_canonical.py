@@ -0,0 +1,61 @@
+import unittest
+
+from derive_eq.functions.canonical import canonical_form, document_macros, fingerprint
+
+# Spellings of one equation, which must share a canonical form
+SAME = (
+    ('E = m c^2', 'E=mc^{2}', 'E = m c^2.', 'E &= m c^2 \\label{energy}'),
+    ('\\frac12 x', '\\frac{1}{2} x', '\\dfrac{1}{2}\\, x', '\\tfrac 1 2 x % half'),
+    ('\\left( x + y \\right)', '(x+y)', '\\bigl( x + y \\bigr)'),
+    ('a \\le b', 'a \\leq b', 'a\\leq b,'),
+    ('a = b \\\\ c = d', 'a &= b \\nonumber \\\\ c &= d'),
+    ('\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}',
+     '\\begin{pmatrix} a&b\\\\c&d \\\\ \\end{pmatrix}'),
+)
+
+# Equations that differ only in their row and column separators
+DISTINCT = (
+    ('\\begin{pmatrix} a \\\\ b \\end{pmatrix}', '\\begin{pmatrix} a & b \\end{pmatrix}'),
+    ('\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}',
+     '\\begin{pmatrix} a & b & c & d \\end{pmatrix}'),
+    ('f(x) = \\begin{cases} 1 & x > 0 \\\\ 0 \\end{cases}',
+     'f(x) = \\begin{cases} 1 & x > 0 & 0 \\end{cases}'),
+    ('\\begin{array}{cc} a & b \\\\ c & d \\end{array}',
+     '\\begin{array}{cc} a & b & c \\\\ d \\end{array}'),
+    ('\\begin{aligned} x &= 1 \\\\ y &= 2 \\end{aligned}',
+     '\\begin{aligned} x &= 1 y &= 2 \\end{aligned}'),
+)
+
+
+class CanonicalFormTest(unittest.TestCase):
+
+    def test_typeset_variants_collide(self):
+        for variants in SAME:
+            self.assertEqual({canonical_form(variant) for variant in variants},
+                             {canonical_form(variants[0])}, variants)
+            self.assertEqual(len({fingerprint(variant) for variant in variants}), 1)
+
+    def test_separators_of_structured_environments_are_kept(self):
+        for first, second in DISTINCT:
+            self.assertNotEqual(canonical_form(first), canonical_form(second), first)
+            self.assertNotEqual(fingerprint(first), fingerprint(second))
+
+    def test_different_equations_stay_apart(self):
+        self.assertNotEqual(canonical_form('a < b'), canonical_form('a \\le b'))
+        self.assertNotEqual(canonical_form('\\alpha b'), canonical_form('\\alphab'))
+        self.assertNotEqual(canonical_form('x^{2} y'), canonical_form('x^{2 y}'))
+
+    def test_document_macros_are_expanded(self):
+        macros = document_macros('\\newcommand{\\pmu}{\\partial_\\mu}\n'
+                                 '\\newcommand{\\avg}[2][t]{\\langle #2 \\rangle_{#1}}\n'
+                                 '\\def\\half{\\frac{1}{2}}\n')
+        self.assertEqual(canonical_form('\\half \\pmu \\phi', macros),
+                         canonical_form('\\frac12 \\partial_\\mu \\phi'))
+        self.assertEqual(canonical_form('\\avg{x} + \\avg[s]{y}', macros),
+                         canonical_form('\\langle x \\rangle_t + \\langle y \\rangle_s'))
+        # Without the macros the commands are left as written
+        self.assertNotEqual(canonical_form('\\half', macros), canonical_form('\\half'))
+
+
+if __name__ == '__main__':
+    unittest.main()
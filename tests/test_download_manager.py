@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from derive_eq.functions.download_manager import DownloadManager, TruncatedDownload
+from stand_in_server import StandInServer, paper_archive
+
+# Large enough that a third of it is sent in several reads
+PAPER = paper_archive({'main.tex': '\\begin{equation} a = b \\end{equation}\n%' + 'x' * 200000})
+
+
+class DownloadManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({'2001.00001': PAPER}).start()
+        self.url = self.server.url + '/e-print/2001.00001'
+        self.dir = tempfile.mkdtemp()
+        self.manager = DownloadManager(backoff=0.01)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as file:
+            return file.read()
+
+    def test_truncated_body_is_resumed_with_range(self):
+        self.server.truncate = 2
+        download = self.manager.fetch(self.url, self.path('paper.tar.gz'))
+        self.assertEqual(download.status, 200)
+        self.assertGreater(download.resumed_from, 0)
+        self.assertEqual(self.server.statuses(), [200, 206, 206])
+        self.assertEqual(self.read('paper.tar.gz'), PAPER)
+        # The partial file and its validators are gone once complete
+        self.assertEqual(os.listdir(self.dir), ['paper.tar.gz'])
+
+    def test_partial_file_of_earlier_run_is_resumed(self):
+        self.server.truncate = 1
+        with self.assertRaises(TruncatedDownload):
+            DownloadManager(retries=0).fetch(self.url, self.path('paper.tar.gz'))
+        self.assertGreater(os.path.getsize(self.path('paper.tar.gz.part')), 0)
+        download = self.manager.fetch(self.url, self.path('paper.tar.gz'))
+        self.assertEqual(self.server.statuses(), [200, 206])
+        self.assertEqual(self.server.log[-1][1]['If-Range'], download.validators['etag'])
+        self.assertEqual(self.read('paper.tar.gz'), PAPER)
+
+    def test_changed_body_is_fetched_whole(self):
+        self.server.truncate = 1
+        with self.assertRaises(TruncatedDownload):
+            DownloadManager(retries=0).fetch(self.url, self.path('paper.tar.gz'))
+        changed = PAPER + b'changed'
+        self.server.papers['2001.00001'] = changed
+        self.server.last_modified = 'Tue, 02 Jan 2024 00:00:00 GMT'
+        download = self.manager.fetch(self.url, self.path('paper.tar.gz'))
+        # If-Range no longer matches, so the whole new body is sent
+        self.assertIn('If-Range', self.server.log[-1][1])
+        self.assertEqual(self.server.statuses(), [200, 200])
+        self.assertEqual(download.resumed_from, 0)
+        self.assertEqual(self.read('paper.tar.gz'), changed)
+
+    def test_unchanged_copy_is_not_modified(self):
+        first = self.manager.fetch(self.url, self.path('paper.tar.gz'))
+        download = self.manager.fetch(self.url, self.path('again.tar.gz'), first.validators)
+        self.assertTrue(download.not_modified)
+        self.assertEqual(self.server.statuses(), [200, 304])
+        self.assertEqual(os.listdir(self.dir), ['paper.tar.gz'])
+
+    def test_missing_paper_leaves_no_file(self):
+        download = self.manager.fetch(self.server.url + '/e-print/2001.99999',
+                                      self.path('missing.tar.gz'))
+        self.assertIsNone(download)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_unavailable_server_is_retried(self):
+        self.server.unavailable = 2
+        download = self.manager.fetch(self.url, self.path('paper.tar.gz'))
+        self.assertEqual(download.status, 200)
+        self.assertEqual(self.server.statuses(), [503, 503, 200])
+
+
+if __name__ == '__main__':
+    unittest.main()
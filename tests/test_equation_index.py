@@ -0,0 +1,79 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from derive_eq.functions.equation_index import INDEX_VERSION, EquationIndex
+from derive_eq.functions.get_tex_eq_better import parse_equations
+
+SOURCE = ('\\begin{equation} E = m c^2 \\label{a} \\end{equation}\n'
+          '\\begin{equation} F = m a \\end{equation}\n')
+
+
+class EquationIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = EquationIndex(os.path.join(self.dir, 'equations.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def store(self, arxiv_id, file_hash, source=SOURCE, partial=None):
+        self.index.store(arxiv_id, list(parse_equations(source)), file_hash, partial=partial)
+
+    def set_parser_version(self, version):
+        conn = sqlite3.connect(self.index.path)
+        with conn:
+            conn.execute('UPDATE papers SET parser_version = ?', (version,))
+        conn.close()
+
+    def test_versions_are_stored_apart(self):
+        self.store('2301.00001v1', 'one')
+        self.store('2301.00001v2', 'two', '\\begin{equation} x = y \\end{equation}')
+        self.assertEqual(self.index.lookup('2301.00001v1', 1), ['E = m c^2'])
+        self.assertEqual(self.index.lookup('2301.00001v2', 1), ['x = y'])
+        self.assertEqual(self.index.equations('2301.00001v1'), [['1', 'E = m c^2'], ['2', 'F = m a']])
+        self.assertIsNone(self.index.equations('2301.00001'))
+        self.assertEqual(self.index.revisions('2301.00001'), ['2301.00001v1', '2301.00001v2'])
+
+    def test_current_depends_on_hash_and_version(self):
+        self.store('2301.00001', 'one')
+        self.assertTrue(self.index.is_current('2301.00001'))
+        self.assertTrue(self.index.is_current('2301.00001', 'one'))
+        self.assertFalse(self.index.is_current('2301.00001', 'two'))
+        # An index written by another parser is treated as missing
+        self.set_parser_version(INDEX_VERSION - 1)
+        self.assertFalse(self.index.is_current('2301.00001', 'one'))
+        self.assertFalse(self.index.is_indexed('2301.00001'))
+        self.assertIsNone(self.index.lookup('2301.00001', 1))
+        self.assertIsNone(self.index.equations('2301.00001'))
+
+    def test_partial_paper_is_served_but_not_current(self):
+        self.store('2301.00001', 'one', partial='time')
+        self.assertTrue(self.index.is_indexed('2301.00001'))
+        self.assertFalse(self.index.is_current('2301.00001', 'one'))
+        self.assertEqual(len(self.index.equations('2301.00001')), 2)
+        self.assertEqual(self.index.indexed_papers(), set())
+
+    def test_adopt_copies_a_version_with_the_same_sources(self):
+        self.store('2301.00001v1', 'one')
+        self.assertTrue(self.index.adopt('2301.00001v2', 'one'))
+        self.assertTrue(self.index.is_current('2301.00001v2', 'one'))
+        self.assertEqual(self.index.equations('2301.00001v2'), self.index.equations('2301.00001v1'))
+        self.assertEqual(self.index.fingerprints('2301.00001v2'),
+                         self.index.fingerprints('2301.00001v1'))
+
+    def test_adopt_needs_a_full_parse_of_the_same_sources(self):
+        self.store('2301.00001v1', 'one')
+        self.assertFalse(self.index.adopt('2301.00001v2', 'two'))
+        self.store('2301.00002v1', 'one', partial='time')
+        self.assertFalse(self.index.adopt('2301.00002v2', 'one'))
+        self.set_parser_version(INDEX_VERSION - 1)
+        self.assertFalse(self.index.adopt('2301.00001v2', 'one'))
+        self.assertIsNone(self.index.paper('2301.00001v2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from derive_eq.functions.canonical import fingerprint
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.functions.equation_search import EquationSearch, normalize_latex, search_indexes
+from derive_eq.functions.get_tex_eq_better import parse_equations
+
+PAPERS = {
+    '2201.00001': ['E = m c^2', 'p = m v', 'F = m a'],
+    '2201.00002': ['\\frac{1}{2} m v^2', 'E = \\hbar \\omega', 'x = y'],
+    '2201.00003': ['\\int d^4x \\sqrt{-g} R', 'E^2 = p^2 c^2 + m^2 c^4'],
+    '2201.00004': ['a = b', 'c = d', 'E = m c^2 + \\ldots'],
+}
+
+
+def paper(equations):
+    return '\n'.join(f'\\begin{{equation}} {equation} \\end{{equation}}' for equation in equations)
+
+
+class EquationSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def index(self, name, arxiv_ids):
+        index = EquationIndex(os.path.join(self.dir, name + '.sqlite'))
+        for arxiv_id in arxiv_ids:
+            index.store(arxiv_id, list(parse_equations(paper(PAPERS[arxiv_id]))), file_hash=arxiv_id)
+        EquationSearch(index).update()
+        return index
+
+    def test_shards_are_scored_as_one_index(self):
+        whole = self.index('whole', PAPERS)
+        shards = [self.index('first', list(PAPERS)[:1]), self.index('rest', list(PAPERS)[1:])]
+        for query in ('E = m c^2', 'm v', '\\hbar'):
+            self.assertEqual(search_indexes(shards, query), search_indexes([whole], query))
+
+    def test_search_does_not_index(self):
+        index = self.index('index', ['2201.00001'])
+        index.store('2201.00002', list(parse_equations(paper(PAPERS['2201.00002']))), file_hash='2')
+        search = EquationSearch(index)
+        self.assertEqual(search.search('\\hbar \\omega'), [])
+        self.assertEqual(search.update('2201.00002'), 1)
+        self.assertEqual(search.search('\\hbar \\omega')[0]['arxiv_id'], '2201.00002')
+
+    def test_dropped_paper_is_removed(self):
+        index = self.index('index', ['2201.00001', '2201.00004'])
+        search = EquationSearch(index)
+        index.invalidate('2201.00001')
+        # Equations gone from the equation index are skipped until update()
+        self.assertEqual({result['arxiv_id'] for result in search.search('E = m c^2')},
+                         {'2201.00004'})
+        self.assertEqual(search.update(), 1)
+        total, total_length, df = search.stats({'F': 1})
+        self.assertEqual(total, 3)
+        self.assertEqual(df, {})
+
+    def test_long_query(self):
+        index = self.index('index', PAPERS)
+        # Many times the terms of one IN (...) chunk or default SQLite parameter limit
+        query = ' '.join(f'\\zeta_{{{i}}}' for i in range(2000)) + ' \\hbar \\omega'
+        results = EquationSearch(index).search(query)
+        self.assertEqual(results[0]['latex'], 'E = \\hbar \\omega')
+
+    def test_variants_are_merged_as_in_fingerprints(self):
+        for first, second in (('\\varepsilon \\le x', '\\epsilon \\leq x'),
+                              ('a_1 \\cdots a_n', 'a_1 \\ldots a_n'),
+                              ('\\lvert x \\rvert', '| x |')):
+            self.assertEqual(normalize_latex(first), normalize_latex(second))
+            self.assertEqual(fingerprint(first), fingerprint(second))
+
+    def test_old_search_index_is_rebuilt(self):
+        index = self.index('index', PAPERS)
+        expected = EquationSearch(index).search('E = m c^2')
+        conn = sqlite3.connect(index.path)
+        with conn:
+            conn.execute("UPDATE search_terms SET term = 'stale ' || term")
+            conn.execute('UPDATE search_stats SET version = 0')
+        conn.close()
+        self.assertEqual(EquationSearch(index).search('E = m c^2'), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from derive_eq.derive_equation import get_equation
+from derive_eq.functions.async_download import AsyncDownloader
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.functions.get_tex_file import get_tex_file_path, load_paper_sources
+from derive_eq.functions.source_cache import SourceCache
+from stand_in_server import StandInServer, paper_archive
+
+
+def paper(*equations):
+    body = '\n'.join(f'\\begin{{equation}} {equation} \\end{{equation}}' for equation in equations)
+    return paper_archive({
+        'main.tex': f'\\documentclass{{article}}\n\\begin{{document}}\n{body}\n\\end{{document}}\n',
+        'figure.png': b'\x89PNG',
+    })
+
+
+class FetchPaperTest(unittest.TestCase):
+    '''The download path, from the arXiv ID to the index, against DERIVE_EQ_ARXIV_URL.'''
+
+    def setUp(self):
+        self.server = StandInServer({
+            '2101.00001v1': paper('a = b'),
+            '2101.00001': paper('a = b', 'c = d'),
+        }).start()
+        self.dir = tempfile.mkdtemp()
+        environment = mock.patch.dict(os.environ, {
+            'DERIVE_EQ_ARXIV_URL': self.server.url,
+            'DERIVE_EQ_CACHE_DIR': self.dir,
+        })
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.index = EquationIndex(os.path.join(self.dir, 'equations.sqlite'))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def paths(self):
+        return [path for path, headers, status in self.server.log]
+
+    def test_sources_are_fetched_once(self):
+        members = load_paper_sources('2101.00001v1', cache=SourceCache())
+        self.assertIn('main.tex', members)
+        self.assertNotIn('figure.png', members)
+        load_paper_sources('2101.00001v1', cache=SourceCache())
+        self.assertEqual(self.paths(), ['/e-print/2101.00001v1'])
+
+    def test_equation_is_fetched_and_indexed(self):
+        self.assertEqual(get_equation('2101.00001', 2, self.index), 'c = d')
+        self.assertEqual(get_equation('2101.00001v1', 1, self.index), 'a = b')
+        self.assertIsNone(get_equation('2101.00001v1', 2, self.index))
+        # Later lookups are answered from the index
+        self.assertEqual(get_equation('2101.00001', 1, self.index), 'a = b')
+        self.assertEqual(self.paths(), ['/e-print/2101.00001', '/e-print/2101.00001v1'])
+
+    def test_unversioned_paper_follows_the_latest_version(self):
+        self.assertEqual(get_equation('2101.00001', 2, self.index), 'c = d')
+        self.server.papers['2101.00001'] = paper('a = b', 'e = f')
+        with mock.patch.dict(os.environ, {'DERIVE_EQ_REVALIDATE_AFTER': '0'}):
+            self.assertEqual(get_equation('2101.00001', 2, self.index), 'e = f')
+            self.assertEqual(get_equation('2101.00001', 2, self.index), 'e = f')
+        self.assertEqual(self.server.statuses(), [200, 200, 304])
+
+    def test_cached_copy_outlives_a_failed_revalidation(self):
+        load_paper_sources('2101.00001', cache=SourceCache())
+        del self.server.papers['2101.00001']
+        with mock.patch.dict(os.environ, {'DERIVE_EQ_REVALIDATE_AFTER': '0'}):
+            members = load_paper_sources('2101.00001', cache=SourceCache())
+        self.assertIn('main.tex', members)
+        self.assertEqual(self.server.statuses(), [200, 404])
+
+    def test_new_version_is_indexed_without_a_backend(self):
+        self.server.papers['2101.00001v2'] = paper('a = b', 'c = d')
+        with mock.patch.dict(os.environ, {'DERIVE_EQ_BACKEND': 'none'}):
+            self.assertEqual(get_equation('2101.00001v1', 1, self.index), 'a = b')
+            # Derivations of v1 are not carried over, but v2 is still indexed
+            self.assertEqual(get_equation('2101.00001v2', 2, self.index), 'c = d')
+
+    def test_main_file_of_multi_file_paper(self):
+        self.server.papers['2101.00002'] = paper_archive({
+            'a_chapter.tex': '\\begin{equation} a = b \\end{equation}\n',
+            'paper.tex': '\\documentclass{article}\n\\begin{document}\n'
+                         '\\input{a_chapter}\n\\end{document}\n',
+            'figure.png': b'\x89PNG',
+        })
+        download_dir = os.path.join(self.dir, 'downloads')
+        path = get_tex_file_path('2101.00002', download_dir)
+        self.assertEqual(path, os.path.join(download_dir, '2101.00002', 'paper.tex'))
+        # Other files are left alone
+        self.assertTrue(os.path.exists(os.path.join(download_dir, '2101.00002', 'a_chapter.tex')))
+
+    def test_missing_paper(self):
+        self.assertIsNone(get_equation('2101.99999', 1, self.index))
+
+    def test_async_downloader(self):
+        async def fetch():
+            async with AsyncDownloader(requests_per_second=0) as downloader:
+                return await downloader.fetch_source('2101.00001v1')
+
+        self.assertEqual(asyncio.run(fetch()), self.server.papers['2101.00001v1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
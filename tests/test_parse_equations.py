@@ -0,0 +1,67 @@
+import unittest
+
+from derive_eq.functions.get_tex_eq_better import find_equation, parse_equations
+
+SOURCE = r'''\documentclass{article}
+\begin{document}
+Some text.
+\begin{equation} E = m c^2 \label{energy} \end{equation}
+\begin{align} a &= b \\ c &= d \nonumber \\ e &= f \end{align}
+\begin{equation}\begin{aligned} p &= q \\ r &= s \end{aligned}\end{equation}
+\begin{equation*} y = z \end{equation*}
+\end{document}
+'''
+
+
+class EquationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.equations = list(parse_equations(SOURCE))
+
+    def test_offsets_point_into_the_source(self):
+        first = self.equations[0]
+        self.assertEqual(SOURCE[first.start:first.end],
+                         r'\begin{equation} E = m c^2 \label{energy} \end{equation}')
+        # The rows of an align share the offsets of their environment
+        self.assertEqual({(equation.start, equation.end) for equation in self.equations[1:4]},
+                         {(SOURCE.index(r'\begin{align}'),
+                           SOURCE.index(r'\end{align}') + len(r'\end{align}'))})
+        nested = self.equations[4]
+        self.assertEqual([SOURCE[start:end].strip() for start, end in
+                          zip(nested.lines[::2], nested.lines[1::2])], ['p &= q', 'r &= s'])
+
+    def test_body_and_text(self):
+        self.assertEqual([equation.number for equation in self.equations],
+                         ['1', '2', None, '3', '4'])
+        self.assertEqual(self.equations[0].body(), ['E = m c^2'])
+        self.assertEqual(self.equations[1].body(), ['a & = b'])
+        nested = self.equations[4]
+        self.assertTrue(nested.nested)
+        self.assertEqual(nested.body(), [[None, 'p & = q'], [None, 'r & = s']])
+        self.assertEqual(nested.text, 'p & = q \\\\ r & = s')
+
+    def test_list_form(self):
+        nested = self.equations[4]
+        self.assertEqual(nested.to_list(), ['4', [None, 'p & = q'], [None, 'r & = s']])
+        self.assertEqual(len(nested), 3)
+        self.assertEqual(nested[0], '4')
+        self.assertEqual(nested[2], [None, 'r & = s'])
+
+    def test_find_equation(self):
+        for equations in (self.equations, iter(self.equations)):
+            before, entry, after = find_equation(equations, 2, window=2)
+            self.assertEqual([equation.number for equation in before + [entry] + after],
+                             ['1', '2', None, '3'])
+        self.assertIsNone(find_equation(self.equations, 7))
+
+    def test_lines_use_the_macros_defined_before_them(self):
+        source = (r'\def\sep{&}' '\n'
+                  r'\begin{align} u \sep= v \end{align}' '\n'
+                  r'\def\sep{}' '\n'
+                  r'\begin{align} u \sep= v \end{align}')
+        self.assertEqual([equation.body() for equation in parse_equations(source)],
+                         [['u & = v'], ['u = v']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from derive_eq.functions.backends import DerivationBackend, set_backend
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.prefetch import Prefetcher
+from stand_in_server import StandInServer, paper_archive
+
+
+def paper(*equations):
+    body = '\n'.join(f'\\begin{{equation}} {equation} \\end{{equation}}' for equation in equations)
+    return paper_archive({'main.tex': f'\\begin{{document}}\n{body}\n\\end{{document}}\n'})
+
+
+class GatedBackend(DerivationBackend):
+    '''Holds every derivation until the gate is opened, recording the equations in order.'''
+    model = 'gated'
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.derived = []
+
+    def derive(self, tex_eq):
+        self.derived.append(tex_eq)
+        self.started.set()
+        self.gate.wait(5)
+        return f'Derivation of {tex_eq}'
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer({
+            '2301.00001v1': paper('a = b', 'c = d', 'e = f', 'g = h'),
+            '2301.00002v1': paper('e = f'),
+        }).start()
+        self.dir = tempfile.mkdtemp()
+        environment = mock.patch.dict(os.environ, {
+            'DERIVE_EQ_ARXIV_URL': self.server.url,
+            'DERIVE_EQ_CACHE_DIR': self.dir,
+        })
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.backend = GatedBackend()
+        set_backend(self.backend)
+        self.addCleanup(set_backend, None)
+        # One worker, so derivations run one after the other in queue order
+        self.prefetcher = Prefetcher(workers=1, use_cache=False,
+                                     index=EquationIndex(os.path.join(self.dir, 'eq.sqlite')))
+
+    def tearDown(self):
+        self.backend.gate.set()
+        self.prefetcher.close()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def start(self, *arxiv_ids):
+        # The worker only starts once every paper is queued
+        with self.prefetcher.lock:
+            for arxiv_id in arxiv_ids:
+                self.prefetcher.prefetch(arxiv_id)
+        self.assertTrue(self.backend.started.wait(5))
+
+    def test_bumped_equation_is_derived_next(self):
+        self.start('2301.00001v1')
+        self.assertIsNone(self.prefetcher.bump('2301.00001v1', 9))
+        bumped = self.prefetcher.bump('2301.00001v1', '(4)')
+        self.backend.gate.set()
+        self.assertEqual(bumped.result(5), 'Derivation of g = h')
+        progress = self.prefetcher.wait('2301.00001v1', timeout=5)
+        self.assertEqual((progress['state'], progress['done']), ('finished', 4))
+        self.assertEqual(self.backend.derived, ['a = b', 'g = h', 'c = d', 'e = f'])
+        # Nothing is left waiting to be derived
+        self.assertIsNone(self.prefetcher.bump('2301.00001v1', 3))
+
+    def test_running_equation_is_not_queued_again(self):
+        self.start('2301.00001v1')
+        running = self.prefetcher.bump('2301.00001v1', 1)
+        self.backend.gate.set()
+        self.assertEqual(running.result(5), 'Derivation of a = b')
+        self.prefetcher.wait('2301.00001v1', timeout=5)
+        self.assertEqual(self.backend.derived, ['a = b', 'c = d', 'e = f', 'g = h'])
+
+    def test_cancel_keeps_shared_derivations(self):
+        self.start('2301.00001v1', '2301.00002v1')
+        running = self.prefetcher.bump('2301.00001v1', 1)
+        self.assertTrue(self.prefetcher.cancel('2301.00001v1'))
+        self.assertFalse(self.prefetcher.cancel('2301.00001v1'))
+        self.backend.gate.set()
+        # The running derivation finishes, e = f is still wanted by the other paper
+        self.assertEqual(running.result(5), 'Derivation of a = b')
+        other = self.prefetcher.wait('2301.00002v1', timeout=5)
+        self.assertEqual((other['state'], other['done']), ('finished', 1))
+        cancelled = self.prefetcher.progress('2301.00001v1')
+        self.assertEqual((cancelled['state'], cancelled['cancelled']), ('cancelled', 4))
+        self.assertEqual(self.backend.derived, ['a = b', 'e = f'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from derive_eq.functions.result_cache import ResultCache, result_key
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'results.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, **options):
+        return ResultCache(self.path, **options)
+
+    def test_disk_hit_is_promoted(self):
+        self.cache().put('a', 'derivation')
+        cache = self.cache()
+        self.assertEqual(cache.get('a'), 'derivation')
+        self.assertEqual(cache.get('a'), 'derivation')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.hits, {'memory': 1, 'disk': 1})
+        self.assertEqual(cache.misses, 1)
+
+    def test_expired_entries_are_misses(self):
+        cache = self.cache(ttl=0.05)
+        cache.put('a', 'derivation')
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(self.cache(ttl=0.05).get('a'))
+        # Without a ttl entries never expire
+        cache = self.cache(ttl=0)
+        cache.put('b', 'derivation')
+        time.sleep(0.1)
+        self.assertEqual(self.cache(ttl=0).get('b'), 'derivation')
+
+    def test_memory_drops_least_recently_used(self):
+        cache = self.cache(max_memory_items=2)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        cache.get('a')
+        cache.put('c', '3')
+        self.assertEqual(list(cache.memory), ['a', 'c'])
+        # What memory dropped is still found on disk
+        self.assertEqual(cache.get('b'), '2')
+        self.assertEqual(cache.hits['disk'], 1)
+
+    def test_disk_drops_least_recently_used(self):
+        cache = self.cache(max_memory_items=0, max_disk_bytes=10)
+        cache.put('a', 'aaaa')
+        cache.put('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        cache.put('c', 'cccc')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.get('c'), 'cccc')
+
+    def test_key_ignores_typesetting(self):
+        self.assertEqual(result_key('model', 'prompt', 'E = m c^2'),
+                         result_key('model', 'prompt', 'E=mc^{2}'))
+        self.assertNotEqual(result_key('model', 'prompt', 'E = m c^2'),
+                            result_key('other', 'prompt', 'E = m c^2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from derive_eq.functions.backends import SYSTEM_PROMPT, set_backend
+from derive_eq.functions.canonical import document_macros
+from derive_eq.functions.equation_index import EquationIndex
+from derive_eq.functions.get_tex_eq_better import parse_equations
+from derive_eq.functions.result_cache import ResultCache, result_key
+from derive_eq.functions.revisions import (
+    ADDED, CHANGED, REMOVED, RENUMBERED, UNCHANGED, carry_over, diff_revisions, previous_revision
+)
+
+FIRST = ('\\newcommand{\\half}{\\frac{1}{2}}', 'E = m c^2', '\\half m v^2', 'x = y', 'p = q')
+# Retypesets (1), adds an equation before (2), changes (3) and drops (4)
+SECOND = ('', 'E = mc^{2}', 'F = m a', '\\frac12 m v^2', 'x = z')
+
+
+def paper(preamble, *equations):
+    return preamble + '\n' + '\n'.join(f'\\begin{{equation}} {equation} \\end{{equation}}'
+                                       for equation in equations)
+
+
+class RevisionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = EquationIndex(os.path.join(self.dir, 'equations.sqlite'))
+        for arxiv_id, version in (('2301.00001v1', FIRST), ('2301.00001v2', SECOND)):
+            source = paper(*version)
+            self.index.store(arxiv_id, list(parse_equations(source)), arxiv_id,
+                             macros=document_macros(source))
+        self.cache = ResultCache(os.path.join(self.dir, 'results.sqlite'))
+        for patch in (mock.patch('derive_eq.functions.result_cache._default_cache', self.cache),
+                      mock.patch.dict(os.environ, {'DERIVE_EQ_BACKEND': 'mock'})):
+            patch.start()
+            self.addCleanup(patch.stop)
+        set_backend(None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_previous_revision(self):
+        self.assertEqual(previous_revision(self.index, '2301.00001v2'), '2301.00001v1')
+        self.assertEqual(previous_revision(self.index, '2301.00001v3'), '2301.00001v2')
+        self.assertIsNone(previous_revision(self.index, '2301.00001v1'))
+        self.assertIsNone(previous_revision(self.index, '2301.00001'))
+
+    def test_equations_are_matched_by_fingerprint(self):
+        diff = diff_revisions(self.index, '2301.00001v1', '2301.00001v2')
+        self.assertEqual([entry[:3] for entry in diff.entries], [
+            (UNCHANGED, '1', '1'),
+            (ADDED, None, '2'),
+            (RENUMBERED, '2', '3'),
+            (CHANGED, '3', '4'),
+            (REMOVED, '4', None),
+        ])
+        self.assertEqual(diff.to_derive(), ['2', '4'])
+        self.assertEqual(diff.count(REMOVED), 1)
+        self.assertIsNone(diff_revisions(self.index, '2301.00001v1', '2301.00001v3'))
+
+    def test_derivations_of_kept_equations_are_carried_over(self):
+        derivation = 'Derivation of the kinetic energy'
+        self.cache.put(result_key('mock', SYSTEM_PROMPT, '\\half m v^2'), derivation)
+        diff = diff_revisions(self.index, '2301.00001v1', '2301.00001v2')
+        self.assertEqual(carry_over(diff), 1)
+        self.assertEqual(self.cache.get(result_key('mock', SYSTEM_PROMPT, '\\frac12 m v^2')),
+                         derivation)
+        # Changed equations are derived again
+        self.assertIsNone(self.cache.get(result_key('mock', SYSTEM_PROMPT, 'x = z')))
+
+    def test_nothing_is_carried_over_without_a_backend(self):
+        diff = diff_revisions(self.index, '2301.00001v1', '2301.00001v2')
+        with mock.patch.dict(os.environ, {'DERIVE_EQ_BACKEND': 'none'}):
+            self.assertIsNone(carry_over(diff))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that only load once a command needs them, see benchmarks/bench_startup.py
+HEAVY = ('openai', 'rich', 'sqlite3', 'tarfile', 'feedparser', 'asyncio', 'urllib.request')
+
+
+def loaded_modules(code):
+    '''The HEAVY modules in sys.modules after running code in a fresh interpreter.'''
+    code += ('\nimport json, sys\n'
+             f'print(json.dumps([name for name in {HEAVY!r} if name in sys.modules]))\n')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            env=env, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_cli_import_is_light(self):
+        self.assertEqual(loaded_modules('import derive_eq.cli'), [])
+
+    def test_help_is_light(self):
+        code = ("import sys\n"
+                "sys.argv = ['derive_eq', '--help']\n"
+                "from derive_eq.cli import main\n"
+                "try:\n"
+                "    main()\n"
+                "except SystemExit:\n"
+                "    pass\n")
+        self.assertEqual(loaded_modules(code), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from derive_eq.functions.get_tex_eq_better import parse_equations
+
+
+def parse(source):
+    return [(equation.number, equation.env, source[equation.start:equation.end], equation.body())
+            for equation in parse_equations(source)]
+
+
+class MacroExpansionTest(unittest.TestCase):
+
+    def test_shortcuts_match_whole_names(self):
+        source = (r'\newcommand{\be}{\begin{equation}}\newcommand{\ee}{\end{equation}}' '\n'
+                  r'\beq a = b \eeq' '\n'
+                  r'\be c = d \ee')
+        self.assertEqual(parse(source), [('1', 'equation', r'\be c = d \ee', ['c = d'])])
+
+    def test_newcommand_with_arguments(self):
+        source = (r'\newcommand{\eqs}[2]{\begin{align}#1 \\ #2\end{align}}' '\n'
+                  r'\eqs{a &= b}{c &= d \nonumber}')
+        use = r'\eqs{a &= b}{c &= d \nonumber}'
+        self.assertEqual(parse(source), [('1', 'align', use, ['a & = b']),
+                                         (None, 'align', use, ['c & = d'])])
+
+    def test_optional_argument(self):
+        source = (r'\newcommand{\eqn}[2][x]{\begin{equation}#2\label{#1}\end{equation}}' '\n'
+                  r'\eqn{c = d} \eqn[y]{e = f}')
+        self.assertEqual(parse(source), [('1', 'equation', r'\eqn{c = d}', ['c = d']),
+                                         ('2', 'equation', r'\eqn[y]{e = f}', ['e = f'])])
+
+    def test_arguments_keep_their_offsets(self):
+        source = (r'\newcommand{\eqn}[1]{\begin{equation}#1\end{equation}}' '\n'
+                  r'\eqn{c = d}')
+        equation, = parse_equations(source)
+        start, end = equation.lines
+        self.assertEqual(source[start:end], 'c = d')
+
+    def test_let(self):
+        source = (r'\let\ba=\align \let\ea\endalign' '\n'
+                  r'\ba p &= q \\ r &= s \ea')
+        self.assertEqual([body for number, env, text, body in parse(source)],
+                         [['p & = q'], ['r & = s']])
+
+    def test_newenvironment(self):
+        source = (r'\newenvironment{myeq}[1]{\begin{equation}\label{#1}}{\end{equation}}' '\n'
+                  r'\begin{myeq}{x} m = n \end{myeq}' '\n'
+                  r'\renewenvironment{myeq}{\begin{align}}{\end{align}}' '\n'
+                  r'\begin{myeq} m &= n \\ o &= p \end{myeq}')
+        self.assertEqual([(number, env, body) for number, env, text, body in parse(source)],
+                         [('1', 'equation', ['m = n']), ('2', 'align', ['m & = n']),
+                          ('3', 'align', ['o & = p'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from derive_eq.functions.get_tex_eq_better import (
+    extract_equations_from_tex, get_tex_eq, iter_equations_from_tex
+)
+from derive_eq.functions.tex_project import TexSourceView
+
+
+def is_closed(data):
+    try:
+        len(data)
+    except ValueError:
+        return True
+    return False
+
+
+class TexSourceViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.write('main.tex', '\\begin{equation} a = b \\end{equation}\n\\input{part}\n')
+        self.write('part.tex', '\\begin{equation} c = d \\end{equation}\n')
+        self.write('single.tex', '\\begin{equation} e = f \\end{equation}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        with open(os.path.join(self.dir, name), 'w') as file:
+            file.write(text)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_files_are_unmapped_on_close(self):
+        with TexSourceView.from_file(self.path('main.tex')) as view:
+            self.assertEqual(view.reachable_files(), ['main.tex', 'part.tex'])
+            files = [data for data in view.files.values() if data is not None]
+            self.assertEqual(len(files), 2)
+            self.assertFalse(any(map(is_closed, files)))
+        self.assertTrue(all(map(is_closed, files)))
+
+    def test_records_are_usable_while_iterating(self):
+        equations = iter_equations_from_tex(self.path('single.tex'))
+        self.assertEqual([equation.body() for equation in equations], [['e = f']])
+
+    def test_extracted_records_outlive_the_files(self):
+        equations = extract_equations_from_tex(self.path('main.tex'))
+        self.assertEqual([equation.body() for equation in equations], [['a = b'], ['c = d']])
+        equations = extract_equations_from_tex(self.path('single.tex'))
+        self.assertEqual([equation.body() for equation in equations], [['e = f']])
+
+    def test_last_equation(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(get_tex_eq(self.path('main.tex'), 2), ['c = d'])
+            self.assertEqual(get_tex_eq(self.path('single.tex'), 1), ['e = f'])
+            self.assertIsNone(get_tex_eq(self.path('missing.tex'), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()